@@ -0,0 +1,134 @@
+"""Compares ways of rendering cachefrag templates from async views under uvicorn.
+
+Run from the repository root (requires uvicorn):
+
+    python benchmarks/cachefrag_asgi.py [REQUESTS] [CONCURRENCY] [LATENCY_MS]
+
+A page with several fragments is served three ways: rendered directly on the event loop, rendered in a thread via
+``sync_to_async``, and rendered with ``djangoat.cache.arender_to_string``. To stand in for a network cache like
+memcached or Redis, every cache call sleeps for LATENCY_MS, blocking its thread when called synchronously and yielding
+to other coroutines when awaited. All fragments are cached before timing begins, so that the numbers reflect how each
+approach waits on the cache.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import django
+from django.conf import settings
+
+LATENCY = (float(sys.argv[3]) if len(sys.argv) > 3 else 2) / 1000
+
+settings.configure(
+    ALLOWED_HOSTS=['*'],
+    CACHES={'default': {'BACKEND': '__main__.SlowCache'}},
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(tempfile.mkdtemp(), 'db.sqlite3')}},
+    INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes', 'djangoat'],
+    MIGRATION_MODULES={'djangoat': None},
+    ROOT_URLCONF='__main__',
+    SECRET_KEY='benchmark',
+    TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates'}],
+)
+
+from django.core.cache.backends.locmem import LocMemCache
+
+
+
+
+class SlowCache(LocMemCache):
+    # A local-memory cache with a fixed round trip per call, as with memcached or Redis
+    def get(self, *args, **kwargs):
+        time.sleep(LATENCY)
+        return super().get(*args, **kwargs)
+
+    def get_many(self, keys, version=None):
+        time.sleep(LATENCY)
+        return self.fetch_many(keys, version)
+
+    async def aget(self, *args, **kwargs):
+        await asyncio.sleep(LATENCY)
+        return super().get(*args, **kwargs)
+
+    async def aget_many(self, keys, version=None):
+        await asyncio.sleep(LATENCY)
+        return self.fetch_many(keys, version)
+
+    def fetch_many(self, keys, version=None):
+        found = {k: super(SlowCache, self).get(k, self, version) for k in keys}
+        return {k: v for k, v in found.items() if v is not self}
+
+
+django.setup()
+
+from asgiref.sync import sync_to_async
+from django.core.asgi import get_asgi_application
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.template import engines
+from django.urls import path
+
+from djangoat.cache import arender_to_string
+
+import uvicorn
+
+
+
+
+SOURCE = '{% load djangoat %}' + ''.join(f'{{% cachefrag "1h" frag{i} %}}fragment {i}{{% endcachefrag %}}' for i in range(8))
+TEMPLATE = engines['django'].from_string(SOURCE)
+
+
+async def on_loop(request):
+    return HttpResponse(TEMPLATE.render({}))
+
+
+async def in_thread(request):
+    return HttpResponse(await sync_to_async(TEMPLATE.render)({}))
+
+
+async def with_arender(request):
+    return HttpResponse(await arender_to_string('page'))
+
+
+urlpatterns = [path('loop', on_loop), path('thread', in_thread), path('arender', with_arender)]
+
+
+async def fetch(port, url, count):
+    for _ in range(count):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'GET /{url} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'.encode())
+        await writer.drain()
+        await reader.read()
+        writer.close()
+
+
+async def measure(port, url, requests, concurrency):
+    start = time.perf_counter()
+    await asyncio.gather(*(fetch(port, url, requests // concurrency) for _ in range(concurrency)))
+    return time.perf_counter() - start
+
+
+def main(requests, concurrency):
+    import django.template.loader
+    django.template.loader.get_template = lambda name, using=None: TEMPLATE  # serve SOURCE to arender_to_string
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    TEMPLATE.render({})  # populate the cache
+    server = uvicorn.Server(uvicorn.Config(get_asgi_application(), port=8765, log_level='error'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    print(f'{requests} requests, {concurrency} at a time, {LATENCY * 1000:g} ms per cache call\n')
+    for name, url in (('render on event loop', 'loop'), ('sync_to_async render', 'thread'), ('arender_to_string', 'arender')):
+        asyncio.run(measure(8765, url, concurrency, concurrency))  # warm up
+        seconds = asyncio.run(measure(8765, url, requests, concurrency))
+        print(f'{name:<24} {requests / seconds:8.1f} requests/s')
+    server.should_exit = True
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 400, int(sys.argv[2]) if len(sys.argv) > 2 else 20)
@@ -0,0 +1,61 @@
+"""Compares the per-hit overhead of the cachefrag tag with that of Django's built-in cache tag.
+
+Run from the repository root:
+
+    python benchmarks/cachefrag_hits.py [ITERATIONS]
+
+Both tags are rendered once to populate the cache, after which each template is rendered ITERATIONS times against a
+local-memory cache, so that the timings reflect tag overhead rather than network latency.
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import django
+from django.conf import settings
+
+settings.configure(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(tempfile.mkdtemp(), 'db.sqlite3')}},
+    INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes', 'djangoat'],
+    MIGRATION_MODULES={'djangoat': None},
+    SECRET_KEY='benchmark',
+    TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates'}],
+)
+django.setup()
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import call_command
+from django.template import engines
+from django.test import RequestFactory
+
+
+
+
+TEMPLATES = {
+    'cache (literal args)': '{% load cache %}{% cache 300 nav "a" 1 %}content{% endcache %}',
+    'cachefrag (literal args)': '{% load djangoat %}{% cachefrag 300 nav "a" 1 %}content{% endcachefrag %}',
+    'cachefrag (time string)': '{% load djangoat %}{% cachefrag "1d-12h" nav "a" 1 %}content{% endcachefrag %}',
+    'cache (variable args)': '{% load cache %}{% cache timeout nav token %}content{% endcache %}',
+    'cachefrag (variable args)': '{% load djangoat %}{% cachefrag timeout nav token %}content{% endcachefrag %}',
+}
+
+
+def main(iterations):
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    request = RequestFactory().get('/')
+    request.user = AnonymousUser()
+    context = {'request': request, 'timeout': 300, 'token': 'a'}
+    print(f'{iterations} hits per template\n')
+    for name, source in TEMPLATES.items():
+        template = engines['django'].from_string(source)
+        template.render(context)  # populate the cache
+        seconds = timeit.timeit(lambda: template.render(context), number=iterations)
+        print(f'{name:<28} {seconds / iterations * 1e6:8.2f} µs per hit')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
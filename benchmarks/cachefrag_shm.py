@@ -0,0 +1,152 @@
+"""Compares the shared-memory fragment cache with a local-memory cache and a Redis-like network cache.
+
+Run from the repository root (POSIX only):
+
+    python benchmarks/cachefrag_shm.py [GETS] [WORKERS] [FRAGMENT_BYTES]
+
+Each backend is filled with 100 fragments of FRAGMENT_BYTES, after which WORKERS processes forked from this one each
+fetch GETS of them at random. The network cache stands in for a Redis server on the same host: a separate process
+answering one request per round trip over a local TCP socket, which is how a worker talks to Redis. Since each worker
+has its own local-memory cache, that backend holds one copy of every fragment per worker, while the others hold one in
+all.
+"""
+import multiprocessing
+import os
+import pickle
+import random
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import django
+from django.conf import settings
+
+settings.configure(
+    CACHES={
+        'locmem': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'OPTIONS': {'MAX_ENTRIES': 1000}},
+        'shared': {
+            'BACKEND': 'djangoat.backends.SharedMemoryCache',
+            'LOCATION': os.path.join(tempfile.mkdtemp(), 'fragments'),
+            'OPTIONS': {'SIZE': 16 * 1024 * 1024},
+        },
+        'network': {'BACKEND': '__main__.SocketCache'},
+    },
+    INSTALLED_APPS=['djangoat'],
+    SECRET_KEY='benchmark',
+)
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+PORT = 8766
+MESSAGE = struct.Struct('>I')
+
+
+
+
+def receive(sock):
+    # Reads one length-prefixed message
+    size = MESSAGE.unpack(sock.recv(MESSAGE.size, socket.MSG_WAITALL))[0]
+    return sock.recv(size, socket.MSG_WAITALL)
+
+
+def send(sock, data):
+    sock.sendall(MESSAGE.pack(len(data)) + data)
+
+
+class SocketCache(BaseCache):
+    # A client for StoreHandler, with one round trip per call, as with Redis
+    def __init__(self, location, params):
+        super().__init__(params)
+        self.sock = None
+
+    def call(self, *args):
+        if self.sock is None or self.pid != os.getpid():
+            self.sock, self.pid = socket.create_connection(('127.0.0.1', PORT)), os.getpid()
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send(self.sock, pickle.dumps(args))
+        return pickle.loads(receive(self.sock))
+
+    def get(self, key, default=None, version=None):
+        value = self.call('get', self.make_and_validate_key(key, version=version))
+        return default if value is None else pickle.loads(value)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.call('set', self.make_and_validate_key(key, version=version), pickle.dumps(value))
+
+
+class StoreHandler(socketserver.BaseRequestHandler):
+    # Serves gets and sets of pickled values from a dict, standing in for a Redis server
+    store = {}
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            try:
+                op, *args = pickle.loads(receive(self.request))
+            except (struct.error, EOFError):
+                return
+            if op == 'get':
+                send(self.request, pickle.dumps(self.store.get(args[0])))
+            else:
+                self.store[args[0]] = args[1]
+                send(self.request, pickle.dumps(None))
+
+
+def serve():
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    socketserver.ThreadingTCPServer(('127.0.0.1', PORT), StoreHandler).serve_forever()
+
+
+def work(alias, gets, fragment, barrier, queue):
+    from django.core.cache import caches
+    cache = caches[alias]
+    if alias == 'locmem':  # each worker fills its own copy
+        for i in range(100):
+            cache.set(f'frag{i}', fragment)
+    keys = [f'frag{random.randrange(100)}' for _ in range(gets)]
+    barrier.wait()  # start all workers together
+    start = time.perf_counter()
+    for k in keys:
+        assert cache.get(k) is not None
+    queue.put(time.perf_counter() - start)
+
+
+def main(gets, workers, size):
+    django.setup()
+    from django.core.cache import caches
+    server = multiprocessing.get_context('fork').Process(target=serve, daemon=True)
+    server.start()
+    time.sleep(0.5)
+    fragment = os.urandom(size // 2).hex()
+    for alias in ('shared', 'network'):
+        for i in range(100):
+            caches[alias].set(f'frag{i}', fragment)
+    print(f'{workers} workers, {gets} gets each, {size} byte fragments\n')
+    for name, alias in (('LocMemCache', 'locmem'), ('SharedMemoryCache', 'shared'), ('local Redis stand-in', 'network')):
+        context = multiprocessing.get_context('fork')
+        barrier, queue = context.Barrier(workers), context.Queue()
+        processes = [context.Process(target=work, args=(alias, gets, fragment, barrier, queue)) for _ in range(workers)]
+        for p in processes:
+            p.start()
+        seconds = [queue.get() for _ in processes]
+        for p in processes:
+            p.join()
+        copies = workers if alias == 'locmem' else 1
+        print(
+            f'{name:<22} {sum(seconds) / (gets * workers) * 1e6:8.2f} µs per get '
+            f'{gets * workers / max(seconds):10.0f} gets/s   {copies} cop{"ies" if copies > 1 else "y"} of each fragment'
+        )
+    server.terminate()
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 20000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 4,
+        int(sys.argv[3]) if len(sys.argv) > 3 else 4096,
+    )
@@ -0,0 +1,115 @@
+"""Compares building CSV export rows field by field with building them from compiled per-field accessors.
+
+Run from the repository root:
+
+    python benchmarks/csv_rows.py [ROWS] [COLUMNS]
+
+To isolate the cost of building rows from that of the database, records are generated in memory in the forms in
+which ``iter_csv_rows_from_queryset`` receives them: tuples, as from ``values_list``, and model-like objects. "before"
+is the loop that previously built every row, checking for derived values, display maps, and methods in each cell;
+"after" is the row builder now compiled once per export.
+"""
+import os
+import sys
+import time
+
+from operator import attrgetter, itemgetter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import django
+from django.conf import settings
+
+settings.configure(INSTALLED_APPS=['djangoat'])
+django.setup()
+
+from djangoat.utils import _get_csv_row_builder, _get_values_getter
+
+
+
+
+class Record(object):
+    # Stands in for a model instance
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+
+def before_from_tuples(records, fields, df, maps, positions):
+    # The previous row loop, fed tuples from values_list
+    values = (([None if i is None else t[i] for i in positions], t[-1]) for t in records)
+    for values, pk in values:
+        row = []
+        for f, v in zip(fields, values):
+            if v is None and df:
+                m = df.get(f, None)
+                if m:
+                    v = m.get(pk, None)
+            m = maps.get(f, None)
+            row.append('' if v is None else (m.get(v, v) if m else v))
+        yield row
+
+
+def before_from_instances(records, fields, df, maps):
+    # The previous row loop, fed model instances
+    def get_values(d):
+        values = []
+        for f in fields:
+            v = getattr(d, f, None)
+            if callable(v):
+                v = v()
+            values.append(v)
+        return values
+    for values, pk in ((get_values(d), d.pk) for d in records):
+        row = []
+        for f, v in zip(fields, values):
+            if v is None and df:
+                m = df.get(f, None)
+                if m:
+                    v = m.get(pk, None)
+            m = maps.get(f, None)
+            row.append('' if v is None else (m.get(v, v) if m else v))
+        yield row
+
+
+def after(records, build, get_pk):
+    for r in records:
+        yield build(r, get_pk(r))
+
+
+def measure(rows):
+    start = time.perf_counter()
+    for _ in rows:
+        pass
+    return time.perf_counter() - start
+
+
+def main(count, columns):
+    fields = [f'f{i}' for i in range(columns)]
+    tuples = [tuple(None if (n + i) % 7 == 0 else n * i for i in range(columns)) + (n,) for n in range(count)]
+    positions = list(range(columns))
+    tuple_values = _get_values_getter(itemgetter(*positions), columns)
+    getters = [attrgetter(f) for f in fields]  # instances are only exported when some field isn't a plain column
+    instance_values = lambda d: [g(d) for g in getters]
+    mapped = {'f1': {0: 'zero'}, 'f2': {}}
+    derived = {'f3': {n: 'derived' for n in range(0, count, 3)}}
+    cases = (
+        ('plain columns', {}, {}),
+        ('with display and derived maps', mapped, derived),
+    )
+    print(f'{count} rows x {columns} columns\n')
+    for name, maps, df in cases:
+        build = _get_csv_row_builder(fields, tuple_values, df, maps)
+        b = measure(before_from_tuples(tuples, fields, df, maps, positions))
+        a = measure(after(tuples, build, itemgetter(-1)))
+        print(f'tuples, {name:<30} before {count / b:10.0f} rows/s   after {count / a:10.0f} rows/s   {b / a:5.2f}x')
+    instances = [Record({**dict(zip(fields, t)), 'pk': t[-1]}) for t in tuples]
+    del tuples
+    for name, maps, df in cases:
+        build = _get_csv_row_builder(fields, instance_values, df, maps)
+        b = measure(before_from_instances(instances, fields, df, maps))
+        a = measure(after(instances, build, attrgetter('pk')))
+        print(f'instances, {name:<27} before {count / b:10.0f} rows/s   after {count / a:10.0f} rows/s   {b / a:5.2f}x')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000, int(sys.argv[2]) if len(sys.argv) > 2 else 20)
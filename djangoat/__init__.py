@@ -3,10 +3,50 @@ from django.utils import timezone
 
 
 
+DJANGOAT_CACHE_FRAG = {
+    'access_interval': 60 * 60,  # min seconds between writes of a CacheFrag's last access time by each process
+    'access_sample': 0.1,  # the fraction of fragment renders considered for updating last access times
+    'beta': 1.0,  # XFetch weighting for early regeneration under "lock"; higher values regenerate sooner, 0 disables
+    'compress_level': 6,  # the zlib or zstd compression level for stored fragments
+    'compress_min': 1024,  # fragments of at least this many bytes are compressed before storage
+    'dependency_refresh': 60,  # max seconds before labels of models with dependent fragments are reread from the database
+    'etag_timeout': 24 * 60 * 60,  # seconds for which "cache_frag_etag" remembers the fragments making up a response
+    'flush_interval': 5,  # max seconds new CacheFrag records wait in memory before being written to the database
+    'flush_size': 500,  # pending CacheFrag records that trigger an immediate write to the database
+    'generation_cache': 'default',  # the cache holding fragment generation counters
+    'generations': (),  # groups whose fragments can be invalidated at once; any of "name", "site", and "user"
+    'local_check': 1,  # max seconds before fragments held in process memory notice they were cleared elsewhere
+    'local_size': 10 * 1024 * 1024,  # max bytes of fragments held in process memory for those using "local"
+    'lock_poll': 0.05,  # seconds between checks while waiting on another worker's regeneration
+    'lock_timeout': 60,  # seconds for which a "stale" fragment's background regeneration holds its lock
+    'lock_wait': 5,  # max seconds to wait on another worker's regeneration before rendering the fragment ourselves
+    'max_item_size': 1000 * 1000,  # max bytes per cache entry; larger fragments are split across several entries
+    'registry_cache': 'default',  # the cache through which processes share CacheFrag registrations
+    'registry_check': 60,  # max seconds before processes notice CacheFrag records pruned elsewhere
+    'registry_size': 10000,  # max CacheFrag lookups held in memory per process
+    'registry_timeout': 24 * 60 * 60,  # seconds for which shared CacheFrag registrations are kept
+    'stale_queue': 20,  # max background regenerations running or waiting at once; beyond this, stale content is served
+    'stale_workers': 2,  # threads available for background regeneration of "stale" fragments
+    'stats': True,  # whether to count hits, misses, sizes, and render times per fragment name
+    'stats_cache': 'default',  # the cache holding fragment stats totals
+    'stats_interval': 60,  # min seconds between flushes of each process's fragment stats to the stats cache
+    'stats_timeout': 30 * 24 * 60 * 60,  # seconds for which fragment stats totals are kept
+}
+
 DJANGOAT_DATA = {
     'now': lambda: timezone.now()
 }
 
+DJANGOAT_EXPORT = {
+    'backend': 'thread',  # how export jobs run: "thread", "process", "database", or the dotted path of a backend class
+    'chunk_size': 2000,  # records fetched from the database at a time while exporting
+    'path': 'djangoat/exports/',  # the directory within "storage" to which export files are saved
+    'poll': 5,  # seconds between checks for pending jobs by the "run_export_jobs" command
+    'progress_interval': 2,  # min seconds between writes of a running job's row count to the database
+    'storage': None,  # the alias of the storage (Django 4.2+) holding export files; defaults to the default storage
+    'workers': 2,  # threads or processes available to run export jobs in each web process
+}
+
 DJANGOAT_PAGER = {
     'items_per_page': 20,
     'next_text': 'Next »',
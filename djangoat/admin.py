@@ -1,21 +1,32 @@
 from django.contrib import admin
 from django.contrib import messages
-from django.core.cache import cache
+from django.contrib.auth import get_user_model
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q, QuerySet
+from django.http import FileResponse, Http404
+from django.template.defaultfilters import filesizeformat
+from django.urls import NoReverseMatch, path, reverse
+from django.utils.functional import cached_property
+from django.utils.html import format_html
 
-from .utils import get_csv_file, get_csv_rows_from_queryset
+from .cache import CHUNKS, CODEC_CHUNKED, HEADER, STATS_BUCKETS, get_cache_frag_stats, get_fragment_cache, get_generation_keys
+from .exports import queue_export_job
+from .models import ExportJob, get_stored_keys
+from .utils import get_csv_file, get_csv_rows_from_queryset, get_csv_stream, iter_csv_rows_from_queryset
 
 
 
 
 # FUNCTIONS
 def clear_cache_frags(modeladmin, request, queryset):
-    for cf in queryset:
-        cache.delete(cf.key)  # clear cache contents, so it can repopulate on next access
+    queryset.clear()  # clear cache contents, so it can repopulate on next access
 clear_cache_frags.short_description = 'Clear selected fragments'
 
 
 
-def csv_export_action(fields, filename, description='Export selected items to a CSV file', filter=None, callback=None, derived_fields=None, dynamic_columns=None, prettify_headers=True, agg_delimiter=', '):
+def csv_export_action(fields, filename, description='Export selected items to a CSV file', filter=None, callback=None, derived_fields=None, dynamic_columns=None, prettify_headers=True, agg_delimiter=', ', stream=True, select=None, prefetch=None, background=False):
     """
     Returns an export action for use in the Django admin.
 
@@ -47,6 +58,11 @@ def csv_export_action(fields, filename, description='Export selected items to a
     user should expect. This will generally be useful when report generation is expected to be long-running and when
     processing needs to be handed off to a task.
 
+    For long-running exports, we can instead pass ``background=True`` to hand the export off to `queue_export_job`_,
+    which records it as an `ExportJob`_ and runs it on the backend named by ``DJANGOAT_EXPORT["backend"]``, or on the
+    backend we name in place of True. The user is sent back to the list page at once, with a message linking to the
+    job in `ExportJobAdmin`_, if registered, where they can follow its progress and download the file once it's done.
+
     An example use of this function would be something like the following:
 
     ..  code-block:: python
@@ -89,6 +105,14 @@ def csv_export_action(fields, filename, description='Export selected items to a
         from `get_csv_rows_from_queryset`_ for more
     :param agg_delimiter: the delimiter on which to join many-to-many values; see the like-named argument
         from `get_csv_rows_from_queryset`_ for more
+    :param stream: if True, send the file as rows are fetched using `iter_csv_rows_from_queryset`_ and
+        `get_csv_stream`_; otherwise, build the whole file before sending it
+    :param select: lookups to pass to ``select_related`` beyond those detected; see the like-named argument from
+        `get_csv_rows_from_queryset`_ for more
+    :param prefetch: lookups to pass to ``prefetch_related`` beyond those detected; see the like-named argument from
+        `get_csv_rows_from_queryset`_ for more
+    :param background: if True, or the name of an export backend, export in the background with `queue_export_job`_
+        rather than responding with the file
     :return: the dynamically created export action
     """
     def export_action(modeladmin, request, queryset):
@@ -96,14 +120,80 @@ def csv_export_action(fields, filename, description='Export selected items to a
             queryset = filter(queryset, request, modeladmin)
         if callback:
             messages.success(request, callback(filename + '.csv', queryset, fields, derived_fields, dynamic_columns, prettify_headers, agg_delimiter) or 'Your request has been processed.')
+        elif background:  # record a job and leave the export to a backend
+            job = queue_export_job(
+                filename, queryset, fields, derived_fields, dynamic_columns, prettify_headers, agg_delimiter, select,
+                prefetch, request.user, None if background is True else background
+            )
+            try:
+                url = reverse(f'admin:{ExportJob._meta.app_label}_exportjob_change', args=(job.pk,))
+            except NoReverseMatch:  # ExportJobAdmin isn't registered
+                messages.success(request, f'Your export of {filename}.csv has been queued.')
+            else:
+                messages.success(request, format_html('Your export of {}.csv has been <a href="{}">queued</a>.', filename, url))
         else:  # return a CSV file download response
-            return get_csv_file(filename, get_csv_rows_from_queryset(queryset, fields, derived_fields, dynamic_columns, prettify_headers, agg_delimiter))
+            args = queryset, fields, derived_fields, dynamic_columns, prettify_headers, agg_delimiter
+            if stream:  # write rows as they're fetched
+                return get_csv_stream(filename, iter_csv_rows_from_queryset(*args, select=select, prefetch=prefetch))
+            return get_csv_file(filename, get_csv_rows_from_queryset(*args, select=select, prefetch=prefetch))
     export_action.short_description = description
     export_action.__name__ = filename
     return export_action
 
 
 
+def get_stats_seconds(obj, name):
+    # Formats a render time percentile attached to a CacheFrag by "CacheFragAdmin.get_changelist_instance"
+    stats = getattr(obj, 'stats', None)
+    if not stats or not stats['misses']:  # nothing has been rendered yet
+        return '-'
+    seconds = stats[name]
+    if seconds is None:
+        return f'> {STATS_BUCKETS[-1]}s'
+    return f'<= {seconds * 1000:g}ms' if seconds < 1 else f'<= {seconds:g}s'
+
+
+
+def get_user_lookups(*names):
+    # Returns "user__" lookups for the username field and any of the other named fields that the user model has
+    model = get_user_model()
+    fields = [model.USERNAME_FIELD] + [n for n in names if n != model.USERNAME_FIELD]
+    return tuple('user__' + n for n in fields if any(f.name == n for f in model._meta.get_fields()))
+
+
+
+def invalidate_cache_frags(modeladmin, request, queryset):
+    queryset.invalidate()  # bump the generations of all groups containing these, so every member repopulates
+invalidate_cache_frags.short_description = 'Invalidate all fragments grouped with those selected'
+
+
+
+
+# PAGINATORS
+class EstimatedCountPaginator(Paginator):
+    """A paginator that estimates the size of large, unfiltered tables on PostgreSQL rather than counting them.
+
+    ``COUNT(*)`` must visit every row, which on a table of millions can take seconds. When the queryset is unfiltered
+    and the database is PostgreSQL, we instead read the planner's estimate of the table's row count from
+    ``pg_class``, which is kept current by ``VACUUM`` and ``ANALYZE``. Estimates below ``exact_below`` are replaced by
+    an exact count, since small tables are cheap to count. Filtered querysets and other databases are always counted.
+    """
+    exact_below = 100000
+
+    @cached_property
+    def count(self):
+        """:meta private:"""
+        qs = self.object_list
+        if isinstance(qs, QuerySet) and not qs.query.where and connections[qs.db].vendor == 'postgresql':
+            with connections[qs.db].cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [qs.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] >= self.exact_below:  # tables never analyzed report -1
+                return int(row[0])
+        return super().count
+
+
+
 
 # ADMINS
 class CacheFragAdmin(admin.ModelAdmin):
@@ -117,10 +207,176 @@ class CacheFragAdmin(admin.ModelAdmin):
 
         admin.site.register(CacheFrag, CacheFragAdmin)
     """
-    actions = clear_cache_frags,
-    list_display = 'name', 'site_id', 'user', 'tokens'
+    actions = clear_cache_frags, invalidate_cache_frags
+    list_display = 'name', 'site_id', 'user', 'tokens', 'cached', 'hit_ratio', 'render_p50', 'render_p95', 'size'
     list_filter = 'name', 'site_id'
-    search_fields = 'user__email', 'user__first_name', 'user__last_name', 'tokens'
+    list_select_related = 'user',
+    search_fields = 'tokens',
+
+    def cached(self, obj):
+        """:meta private:"""
+        data = getattr(obj, 'cached_data', None)
+        if not isinstance(data, (bytes, str)):
+            return '-' if data is None else 'Yes'
+        if isinstance(data, bytes) and len(data) >= HEADER.size + CHUNKS.size and data[1] == CODEC_CHUNKED:
+            return f'{CHUNKS.unpack_from(data, HEADER.size)[1]} chunks'
+        return filesizeformat(len(data))
+    cached.short_description = 'Cached'
+
+    def get_changelist_instance(self, request):
+        """:meta private:"""
+        # Fetch stats for every fragment name and the content of every fragment on the page at once, and attach them
+        # to each record for display
+        cl = super().get_changelist_instance(request)
+        stats = get_cache_frag_stats({cf.name for cf in cl.result_list})
+        keys = get_stored_keys([(cf.key, get_generation_keys(cf.name, cf.site_id, cf.user_id)) for cf in cl.result_list])
+        found = get_fragment_cache().get_many(keys)
+        for cf, key in zip(cl.result_list, keys):
+            cf.stats = stats[cf.name]
+            cf.cached_data = found.get(key, None)
+        return cl
+
+    def get_search_fields(self, request):
+        """:meta private:"""
+        return get_user_lookups(get_user_model().get_email_field_name(), 'first_name', 'last_name') + self.search_fields
+
+    def hit_ratio(self, obj):
+        """:meta private:"""
+        stats = getattr(obj, 'stats', None)
+        if not stats or stats['hit_ratio'] is None:
+            return '-'
+        return f'{stats["hit_ratio"]:.1%} of {stats["hits"] + stats["misses"]}'
+    hit_ratio.short_description = 'Hit ratio'
+
+    def render_p50(self, obj):
+        """:meta private:"""
+        return get_stats_seconds(obj, 'render_p50')
+    render_p50.short_description = 'Render p50'
+
+    def render_p95(self, obj):
+        """:meta private:"""
+        return get_stats_seconds(obj, 'render_p95')
+    render_p95.short_description = 'Render p95'
+
+    def size(self, obj):
+        """:meta private:"""
+        stats = getattr(obj, 'stats', None)
+        return '-' if not stats or stats['bytes'] is None else filesizeformat(stats['bytes'])
+    size.short_description = 'Size'
+
+    def has_add_permission(self, request):
+        """:meta private:"""
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        """:meta private:"""
+        return False
+
+
+
+class LargeTableCacheFragAdmin(CacheFragAdmin):
+    """A `CacheFragAdmin`_ for tables holding millions of records, as when fragments vary by user.
+
+    ..  code-block:: python
+
+        from django.contrib import admin
+        from djangoat.models import CacheFrag
+        from djangoat.admin import LargeTableCacheFragAdmin
+
+        admin.site.register(CacheFrag, LargeTableCacheFragAdmin)
+
+    Compared to the standard admin, this:
+
+    - counts the unfiltered list using `EstimatedCountPaginator`_ and skips the second count of the full table
+    - drops the name and site filters, which require scanning the table for distinct values
+    - searches only in ways that can use an index: an exact CacheFrag key, a name prefix, an exact username, or a
+      user id
+    """
+    list_filter = ()
+    paginator = EstimatedCountPaginator
+    search_fields = 'key', 'name'
+    show_full_result_count = False
+
+    def get_search_fields(self, request):
+        """:meta private:"""
+        return self.search_fields + get_user_lookups()
+
+    def get_search_results(self, request, queryset, search_term):
+        """:meta private:"""
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        user_model = get_user_model()
+        try:  # look the user up first, since an OR across the join would scan the whole table
+            user_ids = list(user_model._default_manager.filter(**{user_model.USERNAME_FIELD: search_term}).values_list('pk', flat=True))
+        except (ValidationError, ValueError):
+            user_ids = []
+        if search_term.isdigit():
+            user_ids.append(int(search_term))
+        q = Q(key=search_term) | Q(name__startswith=search_term)
+        if user_ids:
+            q |= Q(user_id__in=user_ids)
+        return queryset.filter(q), False
+
+
+
+class ExportJobAdmin(admin.ModelAdmin):
+    """A premade admin for following `ExportJob`_ records and downloading their files. To register, add the following
+    somewhere in your project:
+
+    ..  code-block:: python
+
+        from django.contrib import admin
+        from djangoat.models import ExportJob
+        from djangoat.admin import ExportJobAdmin
+
+        admin.site.register(ExportJob, ExportJobAdmin)
+
+    Files are downloaded through the admin, rather than from their storage's URL, so that only staff allowed to view
+    jobs can get them. Exports often hold personal data, so it's best to point ``DJANGOAT_EXPORT["storage"]`` at a
+    storage that isn't served publicly. Deleting jobs deletes their files.
+    """
+    fields = 'name', 'user', 'status', 'backend', 'progress', 'download', 'error', 'date_created', 'date_started', 'date_finished'
+    list_display = 'name', 'user', 'status', 'progress', 'date_created', 'date_finished', 'download'
+    list_filter = 'status',
+    list_select_related = 'user',
+    readonly_fields = fields
+    search_fields = 'name',
+
+    def download(self, obj):
+        """:meta private:"""
+        if obj.status != ExportJob.DONE or not obj.file:
+            return '-'
+        url = reverse(f'admin:{obj._meta.app_label}_{obj._meta.model_name}_download', args=(obj.pk,), current_app=self.admin_site.name)
+        return format_html('<a href="{}">Download</a>', url)
+    download.short_description = 'File'
+
+    def download_view(self, request, pk):
+        """:meta private:"""
+        job = self.get_object(request, pk)
+        if job is None or not job.file:
+            raise Http404
+        if not self.has_view_permission(request, job):
+            raise PermissionDenied
+        return FileResponse(job.file.open('rb'), as_attachment=True, filename=job.name + '.csv')
+
+    def get_search_fields(self, request):
+        """:meta private:"""
+        return self.search_fields + get_user_lookups(get_user_model().get_email_field_name())
+
+    def get_urls(self):
+        """:meta private:"""
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            path('<path:pk>/download/', self.admin_site.admin_view(self.download_view), name='%s_%s_download' % info),
+        ] + super().get_urls()
+
+    def progress(self, obj):
+        """:meta private:"""
+        if not obj.total:
+            return f'{obj.rows} rows' if obj.status != ExportJob.PENDING else '-'
+        return f'{obj.rows} of {obj.total} rows ({min(obj.rows / obj.total, 1):.0%})'
+    progress.short_description = 'Progress'
 
     def has_add_permission(self, request):
         """:meta private:"""
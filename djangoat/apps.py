@@ -1,6 +1,6 @@
 from django.apps import AppConfig
-from django.conf import settings
-from django.db.models import Q
+from django.core.signals import request_finished
+from django.db.models.signals import m2m_changed, post_delete, post_save
 
 
 
@@ -10,10 +10,12 @@ class DjangoatConfig(AppConfig):
     name = 'djangoat'
 
     def ready(self):
-        # Read existing CacheFrag records into a dict, so we don't have to hit the database for existing keys
-        from .models import CACHE_FRAG_KEYS, CacheFrag
-        cfs = CacheFrag.objects.all()
-        if getattr(settings, 'SITE_ID', None):  # no reason to import frags for other sites
-            cfs = cfs.filter(Q(site_id=None) | Q(site_id=settings.SITE_ID))
-        # TODO below causes error with resolving auth.User; need to include this in settings somehow
-        # CACHE_FRAG_KEYS.update({f'{cf.name}|{cf.user_id or ""}|{cf.site_id or ""}|{cf.tokens}': cf.key for cf in cfs})
+        # Write CacheFrag records queued during a request once it finishes
+        from .cache import flush_cache_frags_in_background
+        request_finished.connect(flush_cache_frags_in_background, dispatch_uid='djangoat_flush_cache_frags')
+
+        # Clear fragments when the models on which they depend change
+        from .signals import invalidate_on_delete, invalidate_on_m2m_change, invalidate_on_save
+        post_delete.connect(invalidate_on_delete, dispatch_uid='djangoat_invalidate_on_delete')
+        m2m_changed.connect(invalidate_on_m2m_change, dispatch_uid='djangoat_invalidate_on_m2m_change')
+        post_save.connect(invalidate_on_save, dispatch_uid='djangoat_invalidate_on_save')
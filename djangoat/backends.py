@@ -0,0 +1,272 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+import stat
+import struct
+import threading
+import time
+
+from contextlib import contextmanager
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.exceptions import ImproperlyConfigured
+
+
+
+
+ENTRY = struct.Struct('<16sQIdQ')  # key digest, absolute data position, value length, expiry timestamp (0 for none), last use
+ENTRY_LENGTH, ENTRY_EXPIRES, ENTRY_USED = 24, 28, 36  # the offsets of the value length, expiry timestamp, and last use within an entry
+SEGMENT = struct.Struct('<8sIIQQQ')  # magic, buckets, ways, data size, next absolute data position, use clock
+SEGMENT_POSITION, SEGMENT_CLOCK = 24, 32  # the offsets of the next data position and use clock within the header
+SEGMENT_MAGIC = b'DJGTSHM1'
+
+_segments = {}  # the descriptor, thread lock, and mapping of each segment open in this process, keyed by path
+_segments_lock = threading.Lock()
+_segments_pid = None  # the process in which _segments were opened
+
+
+
+
+# CACHES
+class SharedMemoryCache(BaseCache):
+    """A cache backend that keeps values in a memory-mapped file shared by every process on a host.
+
+    With several workers per host, a local-memory cache holds a separate copy of every fragment in each worker, and a
+    network cache costs a round trip per lookup. This backend maps one file into every worker instead, so that a
+    fragment rendered by one is served to all at memory speed. Configure it as the "template_fragments" cache, which
+    the `cachefrag tag`_ uses by default, and give every process the same ``LOCATION`` and ``OPTIONS``:
+
+    ..  code-block:: python
+
+        CACHES = {
+            "default": {...},
+            "template_fragments": {
+                "BACKEND": "djangoat.backends.SharedMemoryCache",
+                "LOCATION": "/dev/shm/djangoat-fragments",
+                "OPTIONS": {"MAX_ENTRIES": 65536, "SIZE": 256 * 1024 * 1024},
+            },
+        }
+
+    ``SIZE`` is the number of bytes available for values, and ``MAX_ENTRIES`` the number of keys that can be indexed.
+    The file is created, or reset if its layout doesn't match, when first used. On Linux, locate it under ``/dev/shm``
+    so that it is never written to disk. Since values are unpickled as they're read, anyone able to write the file
+    could run code in every worker, so the file is never opened through a symbolic link, and an error is raised
+    unless it's a regular file owned by the current user and inaccessible to anyone else.
+
+    Keys are hashed into sets of 8 index entries, and when a set is full, its least recently used entry is replaced.
+    Values are written one after another around a ring, so that once the ring is full, the oldest values are
+    overwritten and the entries pointing to them dropped. Access is serialized with ``flock`` on the file, and is
+    therefore limited to a single host and to POSIX systems. Values larger than ``SIZE`` are not stored.
+    """
+    ways = 8
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        if not location:
+            raise ImproperlyConfigured('SharedMemoryCache requires LOCATION, the path of the file to share.')
+        self.path = location
+        self.size = int(options.get('SIZE', 64 * 1024 * 1024))
+        self.buckets = max(int(options.get('MAX_ENTRIES', 65536)) // self.ways, 1)
+        self.data_offset = SEGMENT.size + self.buckets * self.ways * ENTRY.size
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        digest = self.get_digest(key, version)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.locked() as m:
+            if self.find(m, digest, time.time()):
+                return False
+            return self.store(m, digest, data, self.get_backend_timeout(timeout))
+
+    def clear(self):
+        with self.locked() as m:
+            m[:self.data_offset] = bytes(self.data_offset)
+            SEGMENT.pack_into(m, 0, SEGMENT_MAGIC, self.buckets, self.ways, self.size, 0, 0)
+
+    def delete(self, key, version=None):
+        digest = self.get_digest(key, version)
+        with self.locked() as m:
+            found = self.find(m, digest, time.time())
+            if found:
+                m[found[0]:found[0] + ENTRY.size] = bytes(ENTRY.size)
+            return bool(found)
+
+    def find(self, m, digest, now):
+        """Returns the index offset, data position, and length of the live entry for a digest, or None.
+
+        An entry that has expired or whose value has been overwritten is dropped instead. The lock must be held.
+        """
+        start = self.get_bucket_offset(digest)
+        bucket = m[start:start + self.ways * ENTRY.size]
+        i = bucket.find(digest)
+        while i > 0 and i % ENTRY.size:  # matched across fields rather than at the start of an entry
+            i = bucket.find(digest, i + 1)
+        if i < 0:
+            return None
+        offset = start + i
+        d, p, length, expires, used = ENTRY.unpack_from(m, offset)
+        if not length:
+            return None
+        if (expires and expires <= now) or p < SEGMENT.unpack_from(m, 0)[4] - self.size:
+            m[offset:offset + ENTRY.size] = bytes(ENTRY.size)
+            return None
+        return offset, p, length
+
+    def get(self, key, default=None, version=None):
+        digest = self.get_digest(key, version)
+        with self.locked() as m:
+            data = self.read(m, digest, time.time())
+        return default if data is None else pickle.loads(data)
+
+    def get_bucket_offset(self, digest):
+        # Returns the offset of the first of the index entries among which a digest may be found
+        return SEGMENT.size + int.from_bytes(digest[:8], 'little') % self.buckets * self.ways * ENTRY.size
+
+    def get_digest(self, key, version=None):
+        # Returns the fixed-length digest under which a key is indexed
+        return hashlib.md5(self.make_and_validate_key(key, version=version).encode()).digest()
+
+    def get_many(self, keys, version=None):
+        digests = {k: self.get_digest(k, version) for k in keys}
+        found = {}
+        with self.locked() as m:
+            now = time.time()
+            for k, digest in digests.items():
+                data = self.read(m, digest, now)
+                if data is not None:
+                    found[k] = data
+        return {k: pickle.loads(v) for k, v in found.items()}
+
+    def has_key(self, key, version=None):
+        digest = self.get_digest(key, version)
+        with self.locked() as m:
+            return bool(self.find(m, digest, time.time()))
+
+    def incr(self, key, delta=1, version=None):
+        digest = self.get_digest(key, version)
+        with self.locked() as m:
+            data = self.read(m, digest, time.time())
+            if data is None:
+                raise ValueError("Key '%s' not found" % key)
+            value = pickle.loads(data) + delta
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            offset, position, length = self.find(m, digest, time.time())
+            if len(data) <= length:  # overwrite the value where it is, so that counters don't churn the ring
+                start = self.data_offset + position % self.size
+                m[start:start + len(data)] = data
+                struct.pack_into('<I', m, offset + ENTRY_LENGTH, len(data))
+            else:
+                self.store(m, digest, data, ENTRY.unpack_from(m, offset)[3] or None)
+        return value
+
+    @contextmanager
+    def locked(self):
+        """Holds the segment's lock, opening it first if this process hasn't already, and yields its mapping.
+
+        Since Django creates a cache instance per thread, segments are opened once per process and shared by all the
+        instances using them. They're opened anew after a fork, since ``flock`` doesn't exclude processes that share a
+        descriptor.
+        """
+        segment = _segments.get(self.path) if _segments_pid == os.getpid() else None
+        fd, lock, m = segment or self.open()
+        with lock:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield m
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def open(self):
+        # Maps the segment into this process, creating or resetting it if its layout doesn't match the options
+        global _segments, _segments_pid
+        with _segments_lock:
+            if _segments_pid != os.getpid():
+                _segments, _segments_pid = {}, os.getpid()
+            if self.path in _segments:
+                return _segments[self.path]
+            total = self.data_offset + self.size
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+            except OSError as e:
+                raise ImproperlyConfigured(f'SharedMemoryCache could not open {self.path!r}: {e}') from e
+            info = os.fstat(fd)
+            if not stat.S_ISREG(info.st_mode) or info.st_uid != os.geteuid() or info.st_mode & 0o077:
+                os.close(fd)
+                raise ImproperlyConfigured(
+                    f'SharedMemoryCache will not use {self.path!r}, since it must be a regular file owned by the '
+                    f'current user and inaccessible to other users.'
+                )
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size != total:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, total)
+                m = mmap.mmap(fd, total)
+                if SEGMENT.unpack_from(m, 0)[:4] != (SEGMENT_MAGIC, self.buckets, self.ways, self.size):
+                    m[:self.data_offset] = bytes(self.data_offset)
+                    SEGMENT.pack_into(m, 0, SEGMENT_MAGIC, self.buckets, self.ways, self.size, 0, 0)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            _segments[self.path] = fd, threading.Lock(), m
+            return _segments[self.path]
+
+    def read(self, m, digest, now):
+        """Returns the stored bytes for a digest, marking its entry as used, or None. The lock must be held."""
+        found = self.find(m, digest, now)
+        if not found:
+            return None
+        offset, position, length = found
+        clock = SEGMENT.unpack_from(m, 0)[5] + 1
+        struct.pack_into('<Q', m, SEGMENT_CLOCK, clock)
+        struct.pack_into('<Q', m, offset + ENTRY_USED, clock)
+        start = self.data_offset + position % self.size
+        return m[start:start + length]
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        digest = self.get_digest(key, version)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.locked() as m:
+            if not self.store(m, digest, data, self.get_backend_timeout(timeout)):
+                found = self.find(m, digest, time.time())
+                if found:  # don't leave an older value in place
+                    m[found[0]:found[0] + ENTRY.size] = bytes(ENTRY.size)
+
+    def store(self, m, digest, data, expires):
+        """Writes bytes to the ring and indexes them under a digest, returning whether they fit. The lock must be held.
+
+        The next position is advanced before the bytes are written, so that the entries whose values they overwrite
+        are already dead should the process die midway.
+        """
+        length = len(data)
+        if length > self.size:
+            return False
+        position, clock = SEGMENT.unpack_from(m, 0)[4:]
+        if position % self.size + length > self.size:  # wrap around rather than split the value
+            position += self.size - position % self.size
+        struct.pack_into('<QQ', m, SEGMENT_POSITION, position + length, clock + 1)
+        start = self.data_offset + position % self.size
+        m[start:start + length] = data
+        now = time.time()
+        target = target_used = None
+        bucket = self.get_bucket_offset(digest)
+        for offset in range(bucket, bucket + self.ways * ENTRY.size, ENTRY.size):
+            d, p, n, e, used = ENTRY.unpack_from(m, offset)
+            if d == digest or not n or (e and e <= now) or p < position + length - self.size:
+                target = offset
+                if d == digest:
+                    break
+                target_used = -1
+            elif target_used is None or used < target_used:
+                target, target_used = offset, used
+        ENTRY.pack_into(m, target, digest, position, length, expires or 0, clock + 1)
+        return True
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        digest = self.get_digest(key, version)
+        with self.locked() as m:
+            found = self.find(m, digest, time.time())
+            if found:
+                struct.pack_into('<d', m, found[0] + ENTRY_EXPIRES, self.get_backend_timeout(timeout) or 0)
+            return bool(found)
@@ -0,0 +1,964 @@
+import bisect
+import hashlib
+import json
+import logging
+import random
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, models, router, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import DJANGOAT_CACHE_FRAG
+from .models import CACHE_FRAG_KEYS, CacheFrag, CacheFragDependency
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+
+
+logger = logging.getLogger('djangoat')
+
+CACHE_FRAG_FORMAT = 2  # the version of the stored fragment format, which leads every stored value
+CODEC_CHUNKED, CODEC_NONE, CODEC_ZLIB, CODEC_ZSTD = range(4)
+HEADER = struct.Struct('>BBddI')  # format version, codec, render seconds, expiry timestamp (0 for none), content crc32
+CHUNKS = struct.Struct('>BHI')  # for chunked values, the codec of the joined chunks, the chunk count, and their crc32
+GENERATION_PREFIX = 'djangoat.gen.'
+ETAG_FRAGMENTS = ContextVar('djangoat_etag_fragments', default=None)  # fragments rendered under "cache_frag_etag"
+STATS_BUCKETS = 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10  # upper bounds of render time buckets, in seconds
+STATS_FIELDS = ('hits', 'misses', 'bytes') + tuple(f'le{b}' for b in STATS_BUCKETS) + ('inf',)
+STATS_PREFIX = 'djangoat.stats.'
+
+_accessed = {}  # the times at which CacheFrag accesses were last queued, keyed by CacheFrag key
+_accessed_lock = threading.Lock()
+_accessed_pending = set()  # keys of CacheFrags whose access has yet to be written to the database
+_dependency_labels = set()  # labels of models on which fragments are known to depend
+_dependency_labels_checked = 0  # when _dependency_labels was last refreshed from the database
+_dependency_table = False  # whether the CacheFragDependency table is known to exist
+_executor = None
+_executor_lock = threading.Lock()
+_executor_slots = None
+_pending = {}  # unsaved CacheFrag records keyed by CACHE_FRAG_KEYS key
+_pending_lock = threading.Lock()
+_pending_timer = None
+_stats = {}  # per fragment name, counts for each of STATS_FIELDS not yet flushed to the stats cache
+_stats_flushed = time.time()
+_stats_lock = threading.Lock()
+
+
+
+
+# LOCAL CACHES
+class LocalCacheFrags(object):
+    """A per-process, least-recently-used store of rendered fragments, checked before the fragment cache.
+
+    Fragments rendered with the ``local`` argument of the `cachefrag tag`_ are kept here for that many seconds, so
+    that the hottest fragments needn't make a trip to memcached or Redis on every request. Entries are discarded least
+    recently used first once their combined size exceeds ``DJANGOAT_CACHE_FRAG["local_size"]`` bytes.
+
+    Because each process holds its own copy, clearing a fragment from the shared cache can't reach these directly.
+    Instead, `clear`_ and `invalidate`_ bump a single generation counter in the
+    ``DJANGOAT_CACHE_FRAG["generation_cache"]`` cache, which we check at most every
+    ``DJANGOAT_CACHE_FRAG["local_check"]`` seconds, discarding everything held when it changes. Cleared content will
+    therefore stop being served within that many seconds. Generations folded into cache keys (see
+    `get_generation_keys`_) take effect immediately, since they change the key itself.
+    """
+    generation_key = GENERATION_PREFIX + 'local'
+
+    def __init__(self, size=None):
+        self.bytes = 0
+        self.checked = 0
+        self.entries = OrderedDict()
+        self.generation = None
+        self.lock = threading.Lock()
+        self.size = size
+
+    def __len__(self):
+        return len(self.entries)
+
+    def check(self):
+        """Discards all entries if the shared generation has changed since it was last checked."""
+        now = time.time()
+        if now - self.checked < DJANGOAT_CACHE_FRAG['local_check']:
+            return
+        self.checked = now
+        generation = get_generations([self.generation_key])[self.generation_key]
+        if generation != self.generation:
+            with self.lock:
+                self.entries.clear()
+                self.bytes = 0
+                self.generation = generation
+
+    def get(self, key):
+        """Returns the content stored under ``key`` or None if there is none or it has expired.
+
+        :param key: a (cache alias, cache key) tuple
+        :return: the content or None
+        """
+        self.check()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires, size = entry
+            if expires < time.time():
+                del self.entries[key]
+                self.bytes -= size
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        """Stores content for ``timeout`` seconds, evicting the least recently used entries as needed.
+
+        :param key: a (cache alias, cache key) tuple
+        :param value: the rendered content
+        :param timeout: seconds for which to keep the content
+        """
+        size = sys.getsizeof(value)
+        budget = self.size or DJANGOAT_CACHE_FRAG['local_size']
+        if size > budget:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self.entries[key] = value, time.time() + timeout, size
+            self.bytes += size
+            while self.bytes > budget:
+                self.bytes -= self.entries.popitem(last=False)[1][2]
+
+
+
+
+LOCAL_CACHE_FRAGS = LocalCacheFrags()  # rendered fragments held in process memory for those using "local"
+
+
+
+
+# FUNCTIONS
+async def aget_generations(keys):
+    """Does the same as `get_generations`_ using the cache's async API.
+
+    :param keys: generation keys, as returned by `get_generation_keys`_
+    :return: a dict of generations keyed by generation key
+    """
+    if not keys:
+        return {}
+    generation_cache = caches[DJANGOAT_CACHE_FRAG['generation_cache']]
+    generations = await generation_cache.aget_many(keys)
+    for k in keys:
+        if k not in generations:
+            g = get_new_generation()
+            generations[k] = g if await generation_cache.aadd(k, g, None) else await generation_cache.aget(k, g)
+    return generations
+
+
+
+async def arender_to_string(template_name, context=None, request=None):
+    """Renders a template from an async view, fetching its fragments without blocking the event loop.
+
+    Django renders templates synchronously, so the `cachefrag tag`_ and its variants can't await the cache
+    themselves. Instead, this looks up every fragment in the template that can be resolved up front, in the same way
+    as the `cachefrag_prefetch tag`_, and fetches them with the cache's ``aget_many`` before rendering begins.
+    Fragments rendered anew are written back with ``aset_many`` once rendering completes.
+
+    ..  code-block:: python
+
+        from djangoat.cache import arender_to_string
+        from django.http import HttpResponse
+
+
+        async def home(request):
+            return HttpResponse(await arender_to_string("home.html", {"posts": posts}, request))
+
+    Everything else that may block, from resolving fragment keys, which can query the database for ``vary_on``
+    querysets and consult ``CACHE_FRAG_KEYS``, to rendering the template itself, runs in a thread via
+    ``sync_to_async``. Even when every fragment hits, rendering still checks locks, generations, and the like with the
+    cache's synchronous API, so it's never done on the event loop.
+
+    :param template_name: the name of the template to render
+    :param context: a dict of context variables
+    :param request: the current request, needed for context processors and user-specific fragments
+    :return: the rendered template
+    """
+    from django.template.context import make_context
+    from django.template.loader import get_template
+    from .templatetags.djangoat import CACHE_FRAG_PREFETCH, CacheFragPrefetchNode
+    template = get_template(template_name)
+    node = getattr(template.template, 'djangoat_prefetch_node', None)
+    if node is None:  # templates are cached by the loader, so only find their fragments once
+        node = template.template.djangoat_prefetch_node = CacheFragPrefetchNode(template.template.nodelist)
+    context = make_context(context, request, autoescape=template.backend.engine.autoescape)
+    with context.bind_template(template.template):
+        prefetch = await node.aprefetch(context)
+        with context.push({CACHE_FRAG_PREFETCH: prefetch}):
+            output = await sync_to_async(template.template.render)(context)
+    await node.awrite(prefetch)
+    return output
+
+
+
+def bump_generations(keys):
+    """Increments the given generation counters, invalidating every fragment whose key includes them.
+
+    :param keys: generation keys, as returned by `get_generation_keys`_
+    """
+    generation_cache = caches[DJANGOAT_CACHE_FRAG['generation_cache']]
+    for k in keys:
+        try:
+            generation_cache.incr(k)
+        except ValueError:  # the counter doesn't exist yet or was evicted, so start a new one
+            if not generation_cache.add(k, get_new_generation(), None):
+                generation_cache.incr(k)
+
+
+
+def decode_cache_frag(data, fragment_cache=None, cache_key=None):
+    """Returns the content, render seconds, and expiry timestamp held in a value stored by `store_cache_frag`_.
+
+    Anything not led by the current format version, like plain strings stored by earlier versions of Djangoat, is
+    treated as missing. When a value was split into chunks, ``fragment_cache`` and ``cache_key`` are needed to fetch
+    the rest of it.
+
+    :param data: the value retrieved from the cache
+    :param fragment_cache: the cache in which the value is stored
+    :param cache_key: the key under which the value is stored
+    :return: a tuple of content, render seconds, and expiry timestamp or None, if the value is missing, incomplete,
+        or stored in an unknown format
+    """
+    if not isinstance(data, bytes) or len(data) < HEADER.size or data[0] != CACHE_FRAG_FORMAT:
+        return None
+    _, codec, delta, expiry, _ = HEADER.unpack_from(data)
+    payload = data[HEADER.size:]
+    if codec == CODEC_CHUNKED:
+        if fragment_cache is None:
+            return None
+        codec, count, crc = CHUNKS.unpack_from(payload)
+        keys = [f'{cache_key}.{i}' for i in range(count)]
+        chunks = fragment_cache.get_many(keys)
+        if len(chunks) < count:
+            return None
+        payload = b''.join(chunks[k] for k in keys)
+        if zlib.crc32(payload) != crc:  # chunks were overwritten by another store partway through
+            return None
+    try:
+        if codec == CODEC_ZLIB:
+            payload = zlib.decompress(payload)
+        elif codec == CODEC_ZSTD:
+            if not zstandard:
+                return None
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+    except Exception:
+        return None
+    return payload.decode(), delta, expiry or None
+
+
+
+def delete_cache_frags(fragment_cache, cache_keys):
+    """Deletes fragments stored by `store_cache_frag`_, including the chunks of any that were split.
+
+    The stored headers are fetched with one ``get_many``, so that the chunk keys of split values can be found, and
+    everything is then deleted with one ``delete_many``.
+
+    :param fragment_cache: the cache in which the fragments are stored
+    :param cache_keys: the keys under which the fragments are stored
+    """
+    keys = list(cache_keys)
+    for k, data in fragment_cache.get_many(keys).items():
+        if isinstance(data, bytes) and len(data) >= HEADER.size + CHUNKS.size and data[0] == CACHE_FRAG_FORMAT and data[1] == CODEC_CHUNKED:
+            _, count, _ = CHUNKS.unpack_from(data, HEADER.size)
+            keys.extend(f'{k}.{i}' for i in range(count))
+    fragment_cache.delete_many(keys)
+
+
+
+def encode_cache_frag(cache_key, value, delta=0, expiry=None):
+    """Returns the cache entries needed to store ``value`` under ``cache_key``.
+
+    Content is stored as bytes, prefixed by a header giving the format version, the compression used, the seconds
+    the content took to render, the time at which it expires, and the crc32 of the content, which lets
+    `fetch_cache_frag_etag`_ compare content without fetching or decompressing it. Content of at least
+    ``DJANGOAT_CACHE_FRAG["compress_min"]`` bytes is compressed with zstd, when the ``zstandard`` package is installed,
+    or zlib otherwise, provided compression actually makes it smaller. Should the result still exceed
+    ``DJANGOAT_CACHE_FRAG["max_item_size"]`` bytes, as memcached's 1 MB item limit might require, it is split into
+    chunks stored under "CACHE_KEY.0", "CACHE_KEY.1", etc., and ``cache_key`` holds only a header noting how many
+    chunks there are.
+
+    :param cache_key: the key under which the content will be stored
+    :param value: the rendered content
+    :param delta: the seconds taken to render the content
+    :param expiry: the timestamp at which the content should be considered expired, if any
+    :return: a dict of bytes keyed to cache keys
+    """
+    payload = value.encode()
+    codec, crc = CODEC_NONE, zlib.crc32(payload)
+    if len(payload) >= DJANGOAT_CACHE_FRAG['compress_min']:
+        if zstandard:
+            compressed, c = zstandard.ZstdCompressor(DJANGOAT_CACHE_FRAG['compress_level']).compress(payload), CODEC_ZSTD
+        else:
+            compressed, c = zlib.compress(payload, DJANGOAT_CACHE_FRAG['compress_level']), CODEC_ZLIB
+        if len(compressed) < len(payload):
+            payload, codec = compressed, c
+    max_size = DJANGOAT_CACHE_FRAG['max_item_size']
+    if len(payload) + HEADER.size <= max_size:
+        return {cache_key: HEADER.pack(CACHE_FRAG_FORMAT, codec, delta, expiry or 0, crc) + payload}
+    items = {f'{cache_key}.{i}': payload[s:s + max_size] for i, s in enumerate(range(0, len(payload), max_size))}
+    items[cache_key] = HEADER.pack(CACHE_FRAG_FORMAT, CODEC_CHUNKED, delta, expiry or 0, crc) + CHUNKS.pack(codec, len(items), zlib.crc32(payload))
+    return items
+
+
+
+def fetch_cache_frag(fragment_cache, cache_key):
+    """Returns the content, render seconds, and expiry timestamp of a fragment stored by `store_cache_frag`_.
+
+    :param fragment_cache: the cache in which the fragment is stored
+    :param cache_key: the key under which the fragment is stored
+    :return: a tuple of content, render seconds, and expiry timestamp or None if the fragment isn't cached
+    """
+    return decode_cache_frag(fragment_cache.get(cache_key), fragment_cache, cache_key)
+
+
+
+def fetch_cache_frag_etag(fragments):
+    """Returns the ETag that a response composed of the given fragments would have now, without rendering it.
+
+    Only the crc32 of each fragment's current content, which `encode_cache_frag`_ stores in its header, is compared,
+    with generations folded into its key, so that this matches `get_cache_frag_etag`_ for an identical render. Content
+    is neither decompressed nor, for fragments split into chunks, fetched. Headers are fetched with one ``get_many``
+    per cache.
+
+    :param fragments: (cache alias, CacheFrag key, generation keys) tuples, as recorded by `record_etag_fragment`_
+    :return: the ETag or None if any fragment is no longer cached
+    """
+    generations = get_generations(list({k for _, _, gks in fragments for k in gks}))
+    keys = [fold_generations(key, gks, generations) for _, key, gks in fragments]
+    found = {}
+    for cache_name in {f[0] for f in fragments}:
+        found[cache_name] = caches[cache_name].get_many([k for f, k in zip(fragments, keys) if f[0] == cache_name])
+    crcs = []
+    for (cache_name, _, _), k in zip(fragments, keys):
+        data = found[cache_name].get(k, None)
+        if not isinstance(data, bytes) or len(data) < HEADER.size or data[0] != CACHE_FRAG_FORMAT:
+            return None
+        crcs.append(HEADER.unpack_from(data)[4])
+    return get_cache_frag_etag([(*f, crc) for f, crc in zip(fragments, crcs)])
+
+
+
+def flush_cache_frag_accesses():
+    """Writes the access times queued by `record_cache_frag_access`_ to the ``date_accessed`` field of each CacheFrag.
+
+    Records are updated ``DJANGOAT_CACHE_FRAG["flush_size"]`` at a time, each batch with a single ``UPDATE``.
+
+    :return: the number of records updated
+    """
+    with _accessed_lock:
+        keys = list(_accessed_pending)
+        _accessed_pending.clear()
+    now = timezone.now()
+    size = DJANGOAT_CACHE_FRAG['flush_size']
+    for i in range(0, len(keys), size):
+        CacheFrag.objects.filter(key__in=keys[i:i + size]).update(date_accessed=now)
+    return len(keys)
+
+
+
+def flush_cache_frag_stats():
+    """Adds the hit, miss, size, and render time counts gathered by this process to the totals in the stats cache.
+
+    Counts are gathered in memory by `record_cache_frag_hit`_ and `record_cache_frag_miss`_ and flushed once a
+    request finishes if ``DJANGOAT_CACHE_FRAG["stats_interval"]`` seconds have passed since the last flush. Totals are
+    kept in the ``DJANGOAT_CACHE_FRAG["stats_cache"]`` cache via ``incr``, so that counts from every process
+    accumulate together, and may be read back via `get_cache_frag_stats`_.
+
+    Once flushed, the counts are also sent via the ``djangoat.signals.cache_frag_stats_flushed`` signal, whose
+    receivers get a ``stats`` dict of per-name dicts keyed by ``STATS_FIELDS``. Connect to it to export the numbers to
+    a metrics service:
+
+    ..  code-block:: python
+
+        from django.dispatch import receiver
+        from djangoat.signals import cache_frag_stats_flushed
+
+
+        @receiver(cache_frag_stats_flushed)
+        def export_cache_frag_stats(sender, stats, **kwargs):
+            for name, counts in stats.items():
+                statsd.incr(f"cachefrag.{name}.hits", counts["hits"])
+                statsd.incr(f"cachefrag.{name}.misses", counts["misses"])
+
+    :return: the counts flushed
+    """
+    global _stats_flushed
+    from .signals import cache_frag_stats_flushed
+    with _stats_lock:
+        stats = {name: dict(zip(STATS_FIELDS, counts)) for name, counts in _stats.items()}
+        _stats.clear()
+        _stats_flushed = time.time()
+    stats_cache = caches[DJANGOAT_CACHE_FRAG['stats_cache']]
+    for name, counts in stats.items():
+        for field, n in counts.items():
+            if n:
+                key = f'{STATS_PREFIX}{name}.{field}'
+                try:
+                    stats_cache.incr(key, n)
+                except ValueError:  # the counter doesn't exist yet or was evicted, so start a new one
+                    if not stats_cache.add(key, n, DJANGOAT_CACHE_FRAG['stats_timeout']):
+                        stats_cache.incr(key, n)
+    if stats:
+        cache_frag_stats_flushed.send(sender=None, stats=stats)
+    return stats
+
+
+
+def flush_cache_frags():
+    """Writes all CacheFrag records queued by `queue_cache_frag`_ to the database.
+
+    Records and their dependencies are written via ``bulk_create`` calls that ignore conflicts, so records created in
+    the meantime by other processes are simply skipped, and are then shared with other processes via
+    ``CACHE_FRAG_KEYS`` (see `CacheFragRegistry`_). Should a batch fail, its records are written one at a time, and
+    those that still fail are logged to the "djangoat" logger and dropped from ``CACHE_FRAG_KEYS``, so that they will
+    be queued again the next time they're rendered.
+
+    This is normally called from a background thread, but it may also be called directly, as in a management command
+    that needs all records to be present before proceeding.
+
+    :return: the number of records written
+    """
+    global _pending_timer
+    with _pending_lock:
+        pending = dict(_pending)
+        _pending.clear()
+        if _pending_timer:
+            _pending_timer.cancel()
+            _pending_timer = None
+    if not pending:
+        return 0
+    try:
+        _write_cache_frags(pending)
+        return len(pending)
+    except Exception:
+        pass
+    written = 0
+    for k, entry in pending.items():  # write records one at a time, so that one bad record can't sink the rest
+        try:
+            _write_cache_frags({k: entry})
+            written += 1
+        except Exception:
+            logger.exception('Failed to write CacheFrag %s', entry[0].key)
+            CACHE_FRAG_KEYS.pop(k, None)
+    return written
+
+
+
+def flush_cache_frags_in_background(**kwargs):
+    """Starts a thread to run `flush_cache_frags`_ and `flush_cache_frag_accesses`_ if anything is queued.
+
+    This is connected to Django's ``request_finished`` signal, so that records and accesses queued during a request
+    are written once it completes rather than while it's being rendered.
+    """
+    if _pending or _accessed_pending:
+        threading.Thread(target=_flush_cache_frags, name='djangoat-flush', daemon=True).start()
+    if _stats and time.time() - _stats_flushed >= DJANGOAT_CACHE_FRAG['stats_interval']:
+        threading.Thread(target=flush_cache_frag_stats, name='djangoat-stats', daemon=True).start()
+
+
+
+def _write_cache_frags(pending):
+    # Writes queued records and their dependencies, sharing their keys once written
+    with transaction.atomic(using=router.db_for_write(CacheFrag)):
+        CacheFrag.objects.bulk_create([cf for cf, _ in pending.values()], batch_size=DJANGOAT_CACHE_FRAG['flush_size'], ignore_conflicts=True)
+        CacheFragDependency.objects.bulk_create(
+            [CacheFragDependency(cache_frag_id=cf.key, model=m, object_id=o) for cf, deps in pending.values() for m, o in deps or ()],
+            batch_size=DJANGOAT_CACHE_FRAG['flush_size'],
+            ignore_conflicts=True
+        )
+    CACHE_FRAG_KEYS.share({k: cf.key for k, (cf, _) in pending.items()})
+
+
+
+def _flush_cache_frags():
+    try:
+        flush_cache_frags()
+        flush_cache_frag_accesses()
+    finally:
+        connections.close_all()
+
+
+
+def fold_generations(cache_key, keys, generations):
+    """Returns ``cache_key`` with the current values of its generation counters appended.
+
+    :param cache_key: the key of a CacheFrag
+    :param keys: the generation keys that apply to the fragment
+    :param generations: a dict of generations keyed by generation key, including all members of ``keys``
+    :return: the key under which the fragment's content is currently stored
+    """
+    return f'{cache_key}.g' + '.'.join(str(generations[k]) for k in keys) if keys else cache_key
+
+
+
+def get_cache_frag_etag(fragments):
+    """Returns an ETag representing the given fragments and their content.
+
+    :param fragments: (cache alias, CacheFrag key, generation keys, content crc32) tuples, as recorded by
+        `record_etag_fragment`_
+    :return: a hex digest
+    """
+    return hashlib.md5(repr(fragments).encode()).hexdigest()
+
+
+
+def get_cache_frag_stats(names):
+    """Returns hit, miss, size, and render time figures for the given fragment names, as flushed by all processes.
+
+    Render times are estimated from the histogram buckets in ``STATS_BUCKETS``, so percentiles are given as the upper
+    bound of the bucket in which they fall, or None if that's the unbounded final bucket.
+
+    :param names: fragment names
+    :return: a dict keyed by name of dicts containing "hits", "misses", "hit_ratio", "render_p50", "render_p95", and
+        "bytes", the average size of stored content; figures that can't yet be computed are None
+    """
+    names = list(names)
+    found = caches[DJANGOAT_CACHE_FRAG['stats_cache']].get_many([f'{STATS_PREFIX}{n}.{f}' for n in names for f in STATS_FIELDS])
+    stats = {}
+    for name in names:
+        hits, misses, size, *buckets = (found.get(f'{STATS_PREFIX}{name}.{f}', 0) for f in STATS_FIELDS)
+        stats[name] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / (hits + misses) if hits + misses else None,
+            'render_p50': get_percentile(buckets, 0.5),
+            'render_p95': get_percentile(buckets, 0.95),
+            'bytes': size // misses if misses else None,
+        }
+    return stats
+
+
+
+def get_dependencies(value):
+    """Returns the dependencies represented by ``value`` as (model label, object id) tuples.
+
+    ``value`` may be a model instance, a model class, a queryset, a model label like "app.Model", a comma-separated
+    string of such labels, or any iterable of these. Instances yield a dependency on that one instance, while all
+    others yield a dependency on every instance of their model, represented by an empty object id.
+
+    :param value: the models, instances, querysets, or labels on which a fragment depends
+    :return: a set of (lowercase model label, object id) tuples
+    """
+    if value is None or value == '':
+        return set()
+    if isinstance(value, models.Model):
+        return {(value._meta.label_lower, str(value.pk))}
+    if isinstance(value, type) and issubclass(value, models.Model):
+        return {(value._meta.label_lower, '')}
+    if isinstance(value, models.QuerySet):
+        return {(value.model._meta.label_lower, '')}
+    if isinstance(value, str):
+        return {(apps.get_model(v.strip())._meta.label_lower, '') for v in value.split(',') if v.strip()}
+    try:
+        return set().union(*(get_dependencies(v) for v in value))
+    except TypeError:
+        raise ValueError(f'Cannot derive a fragment dependency from {value!r}')
+
+
+
+def get_fragment_cache():
+    """Returns the cache in which fragments are stored when no ``using`` argument is given to the cachefrag tags.
+
+    With several workers per host, consider `SharedMemoryCache`_ for the "template_fragments" cache.
+
+    :return: the "template_fragments" cache if one is configured and the default cache otherwise
+    """
+    return caches['template_fragments' if 'template_fragments' in settings.CACHES else 'default']
+
+
+
+def get_generation_keys(name, site_id=None, user_id=None):
+    """Returns the keys of the generation counters that apply to a fragment.
+
+    By default, fragments are cleared one key at a time. But when a fragment varies by user, there may be hundreds of
+    thousands of keys for a single fragment name. To make clearing such groups instant, we may fold a generation
+    counter into each fragment's cache key. Incrementing the counter changes the key of every fragment in its group,
+    so that all of their old content is simply never read again and ages out of the cache.
+
+    The groups that receive counters are set by ``DJANGOAT_CACHE_FRAG["generations"]``, which may contain any of
+    "name", "site", and "user". With "name", each fragment name gets a counter. With "site" or "user", each name gets
+    a counter per site or user. For example, the following will allow us to invalidate a fragment by name or by name
+    and user:
+
+    ..  code-block:: python
+
+        from djangoat import DJANGOAT_CACHE_FRAG
+
+        DJANGOAT_CACHE_FRAG["generations"] = ("name", "user")
+
+    Counters are kept in the ``DJANGOAT_CACHE_FRAG["generation_cache"]`` cache and cost one additional ``get_many``
+    per fragment render, which is why they are disabled by default. To invalidate groups, see `bump_generations`_
+    and `CacheFragQuerySet.invalidate`_.
+
+    :param name: the fragment name
+    :param site_id: the id of the fragment's site, if any
+    :param user_id: the id of the fragment's user, if any
+    :return: a list of generation keys, which will be empty when generations are disabled
+    """
+    scopes = DJANGOAT_CACHE_FRAG['generations']
+    keys = []
+    if scopes:
+        if 'name' in scopes:
+            keys.append(f'{GENERATION_PREFIX}{name}')
+        if site_id and 'site' in scopes:
+            keys.append(f'{GENERATION_PREFIX}{name}.s{site_id}')
+        if user_id and 'user' in scopes:
+            keys.append(f'{GENERATION_PREFIX}{name}.u{user_id}')
+    return keys
+
+
+
+def get_generations(keys):
+    """Returns the current value of each generation counter in ``keys``, starting any that don't yet exist.
+
+    New counters start from the current time in milliseconds rather than from zero, so that a counter evicted from the
+    cache can never restart at a value whose old content might still be cached.
+
+    :param keys: generation keys, as returned by `get_generation_keys`_
+    :return: a dict of generations keyed by generation key
+    """
+    if not keys:
+        return {}
+    generation_cache = caches[DJANGOAT_CACHE_FRAG['generation_cache']]
+    generations = generation_cache.get_many(keys)
+    for k in keys:
+        if k not in generations:
+            g = get_new_generation()
+            generations[k] = g if generation_cache.add(k, g, None) else generation_cache.get(k, g)
+    return generations
+
+
+
+def get_new_generation():
+    return int(time.time() * 1000)
+
+
+
+def get_percentile(buckets, percentile):
+    """Returns the upper bound of the ``STATS_BUCKETS`` bucket holding the given percentile of render times.
+
+    :param buckets: counts for each of ``STATS_BUCKETS`` plus one for renders beyond the last
+    :param percentile: a fraction between 0 and 1
+    :return: seconds, or None if there are no counts or the percentile falls in the final, unbounded bucket
+    """
+    total = sum(buckets)
+    if not total:
+        return None
+    seen = 0
+    for bound, n in zip(STATS_BUCKETS, buckets):
+        seen += n
+        if seen >= total * percentile:
+            return bound
+    return None
+
+
+
+def get_vary_on_token(value):
+    """Returns a short, stable token representing a ``vary_on`` value of the `cachefrag tag`_ in its cache key.
+
+    Values are normalized as follows, so that fragments built from models change key, and so repopulate, whenever
+    the models they display are edited ("key-based" or "Russian doll" caching):
+
+    - objects with a ``cache_key`` method contribute whatever it returns
+    - model instances contribute their label, primary key, and version, where the version is the value of the field
+      named by the model's ``cache_version_field`` attribute, or else of its ``updated_at`` field, if any
+    - querysets contribute their model label along with a count and the latest version (or highest primary key)
+      among their members, fetched with a single aggregate query; sliced querysets are counted within the slice
+    - lists and tuples contribute the tokens of their members
+    - strings, numbers, and None are used as is, and anything else is converted to a string
+
+    For example, given a ``Post`` model with an ``updated_at`` field, ``{% cachefrag "1d" post post %}`` will be keyed
+    by something like "blog.post.12.1718035200.0", and saving the post will cause the fragment to render anew.
+
+    :param value: the resolved ``vary_on`` value
+    :return: a string, a list of tokens, or ``value`` itself if it needs no normalizing
+    """
+    if isinstance(value, (str, int)):
+        return value
+    cache_key = getattr(value, 'cache_key', None)
+    if callable(cache_key):
+        return str(cache_key())
+    if isinstance(value, models.Model):
+        field = get_version_field(value)
+        token, version = f'{value._meta.label_lower}.{value.pk}', getattr(value, field) if field else None
+    elif isinstance(value, models.QuerySet):
+        if not value.query.is_sliced:  # a slice depends on the ordering, which must then be kept
+            value = value.order_by()
+        fingerprint = value.aggregate(count=models.Count('pk'), version=models.Max(get_version_field(value.model) or 'pk'))
+        token, version = f'{value.model._meta.label_lower}.{fingerprint["count"]}', fingerprint['version']
+    elif isinstance(value, (list, tuple)):
+        return [get_vary_on_token(v) for v in value]
+    elif value is None or isinstance(value, float):
+        return value
+    else:  # anything else as a string, so that it can be stored in CacheFrag tokens
+        return str(value)
+    if version is None:
+        return token
+    return f'{token}.{version.timestamp() if hasattr(version, "timestamp") else version}'  # datetimes as timestamps
+
+
+
+def get_version_field(model):
+    """Returns the name of the field whose value changes whenever instances of ``model`` are edited, if any.
+
+    :param model: a model class or instance
+    :return: the value of the model's ``cache_version_field`` attribute, "updated_at" if the model has such a field, or
+        None
+    """
+    field = getattr(model, 'cache_version_field', None)
+    if field is None and any(f.name == 'updated_at' for f in model._meta.concrete_fields):
+        field = 'updated_at'
+    return field
+
+
+
+def invalidate_dependents(dependencies):
+    """Clears every fragment that depends on any of the given models or instances.
+
+    :param dependencies: a collection of (model label, object id) tuples, where an empty object id represents a change
+        to the model as a whole, such that all of its dependents should be cleared
+    """
+    by_label = {}
+    for m, o in dependencies:
+        by_label.setdefault(m, {''}).add(o)  # fragments depending on the model as a whole are always affected
+    q = Q()
+    for m, ids in by_label.items():
+        q |= Q(model=m, object_id__in=ids)
+    if q:
+        CacheFrag.objects.filter(key__in=CacheFragDependency.objects.filter(q).values('cache_frag_id')).clear()
+
+
+
+def _has_dependency_table():
+    # Returns whether the CacheFragDependency table exists, which it won't while migrations are still being applied
+    global _dependency_table
+    if not _dependency_table:
+        connection = connections[router.db_for_read(CacheFragDependency)]
+        _dependency_table = CacheFragDependency._meta.db_table in connection.introspection.table_names()
+    return _dependency_table
+
+
+
+def is_dependency(label):
+    """Returns whether any fragment is known to depend on the model with the given label.
+
+    This is checked on every save and delete, so known labels are held in memory and refreshed from the database at
+    most every ``DJANGOAT_CACHE_FRAG["dependency_refresh"]`` seconds. Labels registered by this process are known
+    immediately. Until the `CacheFragDependency`_ table exists, as while ``migrate`` runs on a fresh database, the
+    database isn't consulted, since a failed query would also break the migration's transaction.
+
+    :param label: a lowercase model label
+    :return: True if some fragment may depend on the model
+    """
+    global _dependency_labels_checked
+    if time.time() - _dependency_labels_checked > DJANGOAT_CACHE_FRAG['dependency_refresh']:
+        _dependency_labels_checked = time.time()
+        if _has_dependency_table():
+            _dependency_labels.update(CacheFragDependency.objects.values_list('model', flat=True).distinct())
+    return label in _dependency_labels
+
+
+
+def queue_cache_frag(key, cf, dependencies=None):
+    """Queues an unsaved CacheFrag record for creation, so that it can be written without delaying the render.
+
+    The record is added to ``CACHE_FRAG_KEYS`` immediately, so that it won't be queued twice. Queued records are then
+    written in bulk by `flush_cache_frags`_ on a background thread, either once ``DJANGOAT_CACHE_FRAG["flush_size"]``
+    records have accumulated, ``DJANGOAT_CACHE_FRAG["flush_interval"]`` seconds after the first was queued, or when
+    the current request finishes, whichever comes first.
+
+    :param key: the ``CACHE_FRAG_KEYS`` key under which to store ``cf.key``
+    :param cf: an unsaved CacheFrag; any ``tokens`` that JSON can't hold are converted to strings
+    :param dependencies: a set of (model label, object id) tuples, as returned by `get_dependencies`_, for which to
+        create `CacheFragDependency`_ records
+    """
+    global _pending_timer
+    if cf.tokens is not None:  # as they'll be read back from the JSONField, with dates and the like as strings
+        cf.tokens = json.loads(json.dumps(cf.tokens, default=str))
+    CACHE_FRAG_KEYS[key] = cf.key
+    if dependencies:
+        _dependency_labels.update(m for m, _ in dependencies)
+    with _pending_lock:
+        _pending[key] = cf, dependencies
+        if len(_pending) >= DJANGOAT_CACHE_FRAG['flush_size']:
+            flush_now = True
+        else:
+            flush_now = False
+            if not _pending_timer:
+                _pending_timer = threading.Timer(DJANGOAT_CACHE_FRAG['flush_interval'], _flush_cache_frags)
+                _pending_timer.daemon = True
+                _pending_timer.start()
+    if flush_now:
+        flush_cache_frags_in_background()
+
+
+
+def queue_invalidation(label, object_ids, using):
+    """Queues the dependents of a model instance or instances for invalidation once the current transaction commits.
+
+    Invalidations queued within the same transaction are cleared together by a single call to
+    `invalidate_dependents`_. Outside of a transaction, this happens immediately. Pending invalidations are held on
+    the connection, which belongs to the current thread, so that one thread's commit never clears fragments for
+    changes another has yet to commit.
+
+    :param label: the lowercase label of the changed model
+    :param object_ids: the primary keys of the changed instances
+    :param using: the alias of the database in which the change was made
+    """
+    connection = connections[using]
+    pending = connection.__dict__.setdefault('djangoat_invalidations', set())
+    pending.update((label, str(o)) for o in object_ids)
+
+    def invalidate():
+        dependencies = connection.__dict__.pop('djangoat_invalidations', None)
+        if dependencies:  # an earlier callback from the same transaction may already have handled everything
+            invalidate_dependents(dependencies)
+    transaction.on_commit(invalidate, using=using)
+
+
+
+def record_cache_frag_access(key):
+    """Queues an update to the last access time of a CacheFrag, to be written by `flush_cache_frag_accesses`_.
+
+    To keep this cheap for fragments rendered on every request, only a ``DJANGOAT_CACHE_FRAG["access_sample"]``
+    fraction of accesses are considered, and each process queues a given record at most once every
+    ``DJANGOAT_CACHE_FRAG["access_interval"]`` seconds. Access times are therefore approximate, which is all that's
+    needed to find records that have gone unused for days or weeks (see the `prune_cache_frags command`_).
+
+    :param key: the CacheFrag key
+    """
+    if random.random() >= DJANGOAT_CACHE_FRAG['access_sample']:
+        return
+    now = time.time()
+    if now - _accessed.get(key, 0) < DJANGOAT_CACHE_FRAG['access_interval']:
+        return
+    with _accessed_lock:
+        if len(_accessed) >= DJANGOAT_CACHE_FRAG['registry_size']:  # keep memory flat; at worst, some are queued early
+            _accessed.clear()
+        _accessed[key] = now
+        _accessed_pending.add(key)
+
+
+
+def record_cache_frag_hit(name):
+    """Counts a cache hit for the named fragment. See `flush_cache_frag_stats`_.
+
+    :param name: the fragment name
+    """
+    if DJANGOAT_CACHE_FRAG['stats']:
+        with _stats_lock:
+            counts = _stats.get(name)
+            if counts is None:
+                counts = _stats[name] = [0] * len(STATS_FIELDS)
+            counts[0] += 1
+
+
+
+def record_cache_frag_miss(name, seconds, size):
+    """Counts a cache miss for the named fragment, along with its render time and stored size. See
+    `flush_cache_frag_stats`_.
+
+    :param name: the fragment name
+    :param seconds: the time taken to render the fragment
+    :param size: the number of bytes stored
+    """
+    if DJANGOAT_CACHE_FRAG['stats']:
+        bucket = bisect.bisect_left(STATS_BUCKETS, seconds)
+        with _stats_lock:
+            counts = _stats.get(name)
+            if counts is None:
+                counts = _stats[name] = [0] * len(STATS_FIELDS)
+            counts[1] += 1
+            counts[2] += size
+            counts[3 + bucket] += 1
+
+
+
+def record_etag_fragment(cache_name, cache_key, generation_keys, value):
+    """Notes a rendered fragment for the ETag of the current response, if it's being built by `cache_frag_etag`_.
+
+    :param cache_name: the alias of the cache holding the fragment
+    :param cache_key: the CacheFrag key
+    :param generation_keys: the fragment's generation keys, as returned by `get_generation_keys`_
+    :param value: the fragment's content
+    """
+    fragments = ETAG_FRAGMENTS.get()
+    if fragments is not None:
+        fragments.append((cache_name, cache_key, tuple(generation_keys), zlib.crc32(value.encode())))
+
+
+
+def store_cache_frag(fragment_cache, cache_key, value, timeout, delta=0, expiry=None):
+    """Stores a fragment in the format described in `encode_cache_frag`_.
+
+    :param fragment_cache: the cache in which to store the fragment
+    :param cache_key: the key under which to store the fragment
+    :param value: the rendered content
+    :param timeout: the cache timeout in seconds
+    :param delta: the seconds taken to render the content
+    :param expiry: the timestamp at which the content should be considered expired, if any
+    :return: the number of bytes stored
+    """
+    items = encode_cache_frag(cache_key, value, delta, expiry)
+    if len(items) == 1:
+        fragment_cache.set(cache_key, items[cache_key], timeout)
+    else:
+        fragment_cache.set_many(items, timeout)
+    return sum(len(v) for v in items.values())
+
+
+
+def submit_cache_frag_task(func, *args):
+    """Hands ``func`` off to a bounded pool of background threads.
+
+    The pool is created on first use and holds ``DJANGOAT_CACHE_FRAG["stale_workers"]`` threads. At most
+    ``DJANGOAT_CACHE_FRAG["stale_queue"]`` tasks may be running or waiting at any one time, so that a burst of
+    expiring fragments can never pile up an unbounded backlog of renders. When the pool is saturated, the task is
+    refused, and the caller should simply try again later.
+
+    Because each background thread gets its own database connection, connections are closed as each task finishes.
+
+    :param func: the function to call
+    :param args: arguments to pass to ``func``
+    :return: True if the task was accepted or False if the pool is saturated
+    """
+    global _executor, _executor_slots
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor_slots = threading.BoundedSemaphore(DJANGOAT_CACHE_FRAG['stale_queue'])
+                _executor = ThreadPoolExecutor(DJANGOAT_CACHE_FRAG['stale_workers'], 'djangoat')
+    if not _executor_slots.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            func(*args)
+        finally:
+            connections.close_all()
+            _executor_slots.release()
+    _executor.submit(run)
+    return True
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import time
+
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache.utils import make_template_fragment_key
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils import timezone
+from django.utils.cache import quote_etag
+from django.utils.http import parse_etags
+
+from . import DJANGOAT_CACHE_FRAG
+from .cache import (ETAG_FRAGMENTS, fetch_cache_frag, fetch_cache_frag_etag, fold_generations, get_cache_frag_etag,
+                    get_fragment_cache, get_generation_keys, get_generations, queue_cache_frag, record_cache_frag_access,
+                    record_cache_frag_hit, record_cache_frag_miss, store_cache_frag)
+from .models import CACHE_FRAG_KEYS, CacheFrag
+from .templatetags.djangoat import get_cache_frag_seconds
+
+
+
+
+# FUNCTIONS
+def decode_page(entry):
+    # Returns a response from a page stored by "cache_frag_page" or None if the entry holds anything else
+    if entry is None:
+        return None
+    meta, _, content = entry[0].partition('\n')
+    try:
+        status, headers = json.loads(meta)
+        return HttpResponse(content, status=status, headers=headers)
+    except (TypeError, ValueError):
+        return None
+
+
+
+def encode_page(response):
+    # Returns a response as a string for "store_cache_frag", with its status and headers on the first line, or None
+    # if its content isn't text in the response's charset
+    try:
+        content = response.content.decode(response.charset)
+    except (LookupError, UnicodeDecodeError):
+        return None
+    return json.dumps([response.status_code, dict(response.items())]) + '\n' + content
+
+
+
+def get_etag_manifest_key(request):
+    # Returns the cache key under which the fragments making up the response to this request are listed
+    user = getattr(request, 'user', None)
+    token = f'{request.get_host()}|{request.get_full_path()}|{user.pk if user is not None and user.is_authenticated else ""}'
+    return 'djangoat.etag.' + hashlib.md5(token.encode()).hexdigest()
+
+
+
+
+# DECORATORS
+def cache_frag_page(timeout, name=None, query=()):
+    """Caches whole responses to anonymous users under keys registered as `CacheFrag`_ records.
+
+    This does for pages what the `cachefrag tag`_ does for fragments. Each distinct page gets a record named ``name``,
+    which defaults to the view's name, with the current ``SITE_ID`` and, as its tokens, the request path followed by
+    the values of whichever query parameters are listed in ``query``. Other query parameters, like those added by ad
+    campaigns, don't affect the key. Pages can then be found and cleared in `CacheFragAdmin`_ or via `clear`_ and
+    `invalidate`_, just like fragments:
+
+    ..  code-block:: python
+
+        from djangoat.decorators import cache_frag_page
+
+
+        @cache_frag_page("1h", query=("page",))
+        def article_list(request):
+            ...
+
+        CacheFrag.objects.filter(name="article_list").clear()
+
+    Cached pages are returned without calling the view, so no templates are rendered. Only GET and HEAD requests from
+    anonymous users are served from or stored in the cache, and only responses with status 200 that aren't marked
+    private are stored. Responses are also never stored when they may differ between visitors: when the view sets a
+    cookie, reads or changes the session, or uses a CSRF token, as any page with a ``{% csrf_token %}`` form does. The
+    cookies that the CSRF and session middleware add after the view has run would otherwise be missing from the
+    cached page, so that a second visitor would get the first one's token, and their POST would fail. Pages are kept
+    in the same cache and format as fragments (see `encode_cache_frag`_), so that clearing, compression, and chunking
+    work the same for both, and only those whose content decodes as text in the response's charset are stored.
+
+    :param timeout: seconds, or a ``DJANGOAT_TIMES`` value like "1h", for which to cache each page
+    :param name: the CacheFrag name; defaults to the name of the view function
+    :param query: names of the query parameters whose values should distinguish one cached page from another
+    :return: a decorator
+    """
+    timeout = get_cache_frag_seconds(timeout)
+
+    def decorator(view):
+        frag_name = name or view.__name__
+
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            user = getattr(request, 'user', None)
+            if request.method not in ('GET', 'HEAD') or (user is not None and user.is_authenticated):
+                return view(request, *args, **kwargs)
+            site = getattr(settings, 'SITE_ID', None) or ''
+            tokens = [request.path] + [f'{k}={v}' for k in sorted(query) for v in request.GET.getlist(k)]
+            lookup = f'{frag_name}||{site}|{tokens}'
+            cache_key = CACHE_FRAG_KEYS.get(lookup, None)
+            if not cache_key:
+                cache_key = make_template_fragment_key(frag_name, ['', site] + tokens)
+                path = request.get_full_path()
+                queue_cache_frag(lookup, CacheFrag(
+                    key=cache_key,
+                    name=frag_name,
+                    site_id=site or None,
+                    tokens=tokens,
+                    path=path if len(path) <= CacheFrag._meta.get_field('path').max_length else None,
+                    date_set=timezone.now(),
+                    date_accessed=timezone.now()
+                ))
+            else:
+                record_cache_frag_access(cache_key)
+            generation_keys = get_generation_keys(frag_name, site)
+            stored_key = fold_generations(cache_key, generation_keys, get_generations(generation_keys))
+            page_cache = get_fragment_cache()
+            cached = decode_page(fetch_cache_frag(page_cache, stored_key))
+            if cached is not None:
+                record_cache_frag_hit(frag_name)
+                return cached
+            session = getattr(request, 'session', None)
+            if session is not None:  # only the view's use of the session counts, not the user lookup above
+                accessed, session.accessed = session.accessed, False
+            start = time.time()
+            response = view(request, *args, **kwargs)
+            if callable(getattr(response, 'render', None)) and not response.is_rendered:  # a TemplateResponse
+                response.render()
+            if session is not None:
+                personal, session.accessed = session.accessed or session.modified, session.accessed or accessed
+            else:
+                personal = False
+            if (
+                response.status_code == 200 and not response.streaming and not response.cookies and not personal
+                and not request.META.get('CSRF_COOKIE_NEEDS_UPDATE') and not request.META.get('CSRF_COOKIE_USED')
+                and 'private' not in response.get('Cache-Control', '')
+            ):
+                page = encode_page(response)
+                if page is not None:
+                    delta = time.time() - start
+                    record_cache_frag_miss(frag_name, delta, store_cache_frag(page_cache, stored_key, page, timeout, delta))
+            return response
+        return wrapped
+    return decorator
+
+
+
+def cache_frag_etag(view):
+    """Answers conditional GET requests for pages built from cachefrag fragments with "304 Not Modified".
+
+    Even when every fragment on a page is cached, the view and template still run, and the whole page is sent to
+    clients that already have it. With this decorator, the content of every fragment rendered in the response by the
+    `cachefrag tag`_ and its variants is fingerprinted to produce an ``ETag``, and the fragments are listed in the
+    fragment cache. When a later request arrives bearing that ETag in ``If-None-Match``, the hashes stored alongside
+    the listed fragments are fetched with one ``get_many`` and compared, without fetching or decompressing their
+    content (see `fetch_cache_frag_etag`_). If nothing has changed, a 304 is returned without calling the view.
+
+    ..  code-block:: python
+
+        from djangoat.decorators import cache_frag_etag
+
+
+        @cache_frag_etag
+        def home(request):
+            return render(request, "home.html")
+
+    Fragments are listed separately for each host, path, query string, and logged in user. Since only fragments are
+    fingerprinted, use this only for views whose output is otherwise fixed for a given URL and user; anything rendered
+    outside of a fragment, like a CSRF token or a timestamp, will not be reflected in the ETag. Responses that already
+    have an ETag or that contain no fragments are left untouched, and only GET and HEAD requests are affected.
+    Listings are kept for ``DJANGOAT_CACHE_FRAG["etag_timeout"]`` seconds.
+
+    :param view: the view function
+    :return: the decorated view
+    """
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+        manifest_key = get_etag_manifest_key(request)
+        etags = parse_etags(request.headers.get('If-None-Match', ''))
+        if etags:
+            manifest = get_fragment_cache().get(manifest_key)
+            if manifest and quote_etag(manifest['etag']) in etags and fetch_cache_frag_etag(manifest['fragments']) == manifest['etag']:
+                response = HttpResponseNotModified()
+                response['ETag'] = quote_etag(manifest['etag'])
+                return response
+        token = ETAG_FRAGMENTS.set([])
+        try:
+            response = view(request, *args, **kwargs)
+            if callable(getattr(response, 'render', None)) and not response.is_rendered:  # a TemplateResponse
+                response.render()
+            fragments = ETAG_FRAGMENTS.get()
+        finally:
+            ETAG_FRAGMENTS.reset(token)
+        if response.status_code == 200 and fragments and not response.has_header('ETag'):
+            etag = get_cache_frag_etag(fragments)
+            response['ETag'] = quote_etag(etag)
+            get_fragment_cache().set(
+                manifest_key,
+                {'etag': etag, 'fragments': [f[:3] for f in fragments]},
+                DJANGOAT_CACHE_FRAG['etag_timeout']
+            )
+        return response
+    return wrapped
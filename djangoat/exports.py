@@ -0,0 +1,255 @@
+import multiprocessing
+import pickle
+import threading
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from tempfile import NamedTemporaryFile
+
+import django
+from django.apps import apps
+from django.core.files import File
+from django.db import connections, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import DJANGOAT_EXPORT
+from .models import ExportJob
+from .utils import iter_csv_content, iter_csv_rows_from_queryset
+
+
+
+
+_executors = {}  # the pool of each backend class, created on first use
+_executors_lock = threading.Lock()
+
+
+
+
+# BACKENDS
+class ExportBackend(object):
+    """The base class of export job backends, which decide where and when an `ExportJob`_ runs.
+
+    Subclasses implement ``submit``, which is called once the job has been committed to the database. A backend whose
+    ``serialize`` attribute is True runs jobs outside of the process that queued them, so the export's arguments are
+    pickled into the job's ``spec`` when it's queued. To use a custom backend, set ``DJANGOAT_EXPORT["backend"]`` to
+    its dotted path.
+    """
+    serialize = True
+
+    def submit(self, job, args):
+        """Arranges for a pending job to be run by `run_export_job`_.
+
+        :param job: the `ExportJob`_
+        :param args: the arguments of the export as passed to `queue_export_job`_, or None when ``serialize`` is True
+        """
+        raise NotImplementedError
+
+
+
+class DatabaseExportBackend(ExportBackend):
+    """Leaves jobs in the database for the `run_export_jobs command`_ to pick up.
+
+    This is the most robust option, since jobs survive restarts of the web processes and run on whichever machines the
+    command runs on, but it requires that the command be kept running, as under a process supervisor.
+    """
+    def submit(self, job, args):
+        pass
+
+
+
+class ProcessExportBackend(ExportBackend):
+    """Runs jobs in a pool of ``DJANGOAT_EXPORT["workers"]`` processes started alongside each web process.
+
+    Worker processes are spawned rather than forked, so that they never share the parent's database connections, and
+    each sets up Django anew from the ``DJANGO_SETTINGS_MODULE`` environment variable. Exports therefore don't compete
+    with requests for the web process's interpreter lock, but jobs still in the pool are lost if the web process exits.
+    """
+    def submit(self, job, args):
+        _get_executor(self).submit(_run_export_job, job.pk)
+
+    def get_executor(self):
+        """:meta private:"""
+        context = multiprocessing.get_context('spawn')
+        return ProcessPoolExecutor(DJANGOAT_EXPORT['workers'], mp_context=context, initializer=django.setup)
+
+
+
+class ThreadExportBackend(ExportBackend):
+    """Runs jobs in a pool of ``DJANGOAT_EXPORT["workers"]`` threads within each web process.
+
+    This is the default, since it needs no setup, and since arguments are passed along in memory, lambdas and closures
+    may be used in ``fields``, ``derived_fields``, and ``dynamic_columns``. Jobs still running or waiting are lost if
+    the web process exits, however, and exports share the web process's interpreter lock with requests.
+    """
+    serialize = False
+
+    def submit(self, job, args):
+        _get_executor(self).submit(_run_export_job, job.pk, args)
+
+    def get_executor(self):
+        """:meta private:"""
+        return ThreadPoolExecutor(DJANGOAT_EXPORT['workers'], 'djangoat-export')
+
+
+
+EXPORT_BACKENDS = {
+    'database': DatabaseExportBackend,
+    'process': ProcessExportBackend,
+    'thread': ThreadExportBackend,
+}
+
+
+
+
+# FUNCTIONS
+def _dump_export_args(args):
+    # Pickles the arguments of an export, replacing the queryset, which would be evaluated if pickled, with its query
+    # and whatever else values() and values_list() set on it
+    queryset, *rest = args
+    lookups = queryset._prefetch_related_lookups
+    values = queryset._iterable_class, queryset._fields
+    return pickle.dumps((queryset.model._meta.label, queryset.db, queryset.query, lookups, values, rest))
+
+
+
+def _get_executor(backend):
+    # Returns the pool of a backend, creating it on first use
+    cls = type(backend)
+    if cls not in _executors:
+        with _executors_lock:
+            if cls not in _executors:
+                _executors[cls] = backend.get_executor()
+    return _executors[cls]
+
+
+
+def _load_export_args(spec):
+    # Reverses _dump_export_args
+    label, db, query, lookups, values, rest = pickle.loads(spec)
+    queryset = apps.get_model(label)._default_manager.db_manager(db).all()
+    queryset.query = query
+    queryset._iterable_class, queryset._fields = values
+    if lookups:
+        queryset = queryset.prefetch_related(*lookups)
+    return [queryset] + rest
+
+
+
+def _run_export_job(pk, args=None):
+    # Runs a job in a pool, closing the connections it opened once it's done
+    try:
+        run_export_job(pk, args)
+    finally:
+        connections.close_all()
+
+
+
+def _track_rows(job, rows):
+    # Passes rows through, counting those after the header row in "job.rows" and periodically saving the count
+    updated = time.time()
+    for i, row in enumerate(rows):
+        yield row
+        job.rows = i
+        if time.time() - updated >= DJANGOAT_EXPORT['progress_interval']:
+            ExportJob.objects.filter(pk=job.pk).update(rows=i)
+            updated = time.time()
+
+
+
+def get_export_backend(name=None):
+    """Returns an instance of the export backend with the given name or dotted path.
+
+    :param name: "thread", "process", "database", or the dotted path of an `ExportBackend`_ subclass; defaults to
+        ``DJANGOAT_EXPORT["backend"]``
+    :return: an `ExportBackend`_
+    """
+    name = name or DJANGOAT_EXPORT['backend']
+    return (EXPORT_BACKENDS.get(name) or import_string(name))()
+
+
+
+def queue_export_job(filename, queryset, fields, derived_fields=None, dynamic_columns=None, prettify_headers=True, agg_delimiter=', ', select=None, prefetch=None, user=None, backend=None):
+    """Creates an `ExportJob`_ for a CSV export and hands it off to a backend to be run in the background.
+
+    All arguments but ``filename``, ``user``, and ``backend`` take the same form as the like-named arguments of
+    `get_csv_rows_from_queryset`_. The job is submitted once the current transaction commits, so that it can never
+    run before its record is visible to other connections.
+
+    ..  code-block:: python
+
+        job = queue_export_job("Orders", Order.objects.filter(paid=True), ("number", "total", "customer__email"))
+
+    Backends other than "thread" run jobs in other processes, and the arguments are pickled into the job's ``spec``
+    so that they can be rebuilt there. Functions passed in ``fields``, ``derived_fields``, and ``dynamic_columns``
+    must then be defined at the top level of a module, since lambdas and closures can't be pickled. The queryset is
+    stored as its query, so annotations, filters, and any ``values()`` or ``values_list()`` carry over, but it will be
+    of the model's default manager.
+
+    :param filename: the name of the CSV file, without the ".csv" extension
+    :param queryset: the queryset to export
+    :param user: the user who requested the export, if any
+    :param backend: the name or dotted path of the backend that should run the job; defaults to
+        ``DJANGOAT_EXPORT["backend"]``
+    :return: the new ExportJob
+    """
+    name = backend or DJANGOAT_EXPORT['backend']
+    backend = get_export_backend(name)
+    args = queryset, fields, derived_fields, dynamic_columns, prettify_headers, agg_delimiter, select, prefetch
+    spec = None
+    if backend.serialize:
+        try:
+            spec = _dump_export_args(args)
+        except (AttributeError, TypeError, pickle.PicklingError) as e:
+            raise ValueError(
+                f'Export "{filename}" cannot be run by the "{name}" backend, since its arguments cannot be pickled '
+                f'({e}). Use functions defined at the top level of a module, or the "thread" backend.'
+            ) from e
+    job = ExportJob.objects.create(name=filename, user=user, backend=name, spec=spec)
+    transaction.on_commit(lambda: backend.submit(job, None if backend.serialize else args), using=job._state.db)
+    return job
+
+
+
+def run_export_job(pk, args=None):
+    """Runs a pending `ExportJob`_, writing its CSV to storage, and returns whether the job was run.
+
+    The job is claimed by switching its status from pending to running in a single update, so that when several
+    workers try to run the same job, only one will. Records are fetched ``DJANGOAT_EXPORT["chunk_size"]`` at a time
+    with `iter_csv_rows_from_queryset`_ and written through `iter_csv_content`_ to a temporary file, which is then
+    saved to storage. The job's ``rows`` is updated every ``DJANGOAT_EXPORT["progress_interval"]`` seconds along the
+    way, and should the export fail, the job is marked as failed, with the traceback in ``error``.
+
+    This is called by the backends and by the `run_export_jobs command`_, but it may also be called directly, as from
+    a task queue.
+
+    :param pk: the primary key of the job
+    :param args: the arguments of the export, as passed to `queue_export_job`_; if None, they're loaded from the
+        job's ``spec``
+    :return: True if the job was run, whether or not it succeeded, or False if it wasn't pending
+    """
+    if not ExportJob.objects.filter(pk=pk, status=ExportJob.PENDING).update(status=ExportJob.RUNNING, date_started=timezone.now()):
+        return False
+    job = ExportJob.objects.get(pk=pk)
+    try:
+        queryset, fields, derived_fields, dynamic_columns, prettify_headers, agg_delimiter, select, prefetch = (
+            args or _load_export_args(job.spec)
+        )
+        job.total = queryset.count()
+        ExportJob.objects.filter(pk=pk).update(total=job.total)
+        rows = iter_csv_rows_from_queryset(
+            queryset, fields, derived_fields, dynamic_columns, prettify_headers, agg_delimiter,
+            DJANGOAT_EXPORT['chunk_size'], select, prefetch
+        )
+        with NamedTemporaryFile(suffix='.csv') as f:
+            for chunk in iter_csv_content(_track_rows(job, rows)):
+                f.write(chunk.encode())
+            f.seek(0)
+            job.file.save(job.name + '.csv', File(f), save=False)
+        job.status = ExportJob.DONE
+    except Exception:
+        job.error, job.status = traceback.format_exc(), ExportJob.FAILED
+    job.date_finished = timezone.now()
+    job.save(update_fields=['file', 'rows', 'total', 'status', 'error', 'date_finished'])
+    return True
@@ -0,0 +1,68 @@
+import time
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from ...models import CACHE_FRAG_KEYS, CacheFrag
+
+
+
+
+class Command(BaseCommand):
+    """Deletes `CacheFrag`_ records that haven't been accessed recently.
+
+    Fragments that vary by user or by object create a record for every combination rendered, and records for users or
+    objects that are no longer around are never accessed again. Left alone, these pile up by the million, slowing the
+    admin and the registry's warm-up query. Access times are maintained approximately by `record_cache_frag_access`_,
+    so we can delete records unused for some number of days:
+
+    ..  code-block:: bash
+
+        python manage.py prune_cache_frags --days 30
+
+    Records are found and deleted ``--chunk-size`` at a time, in primary key order, with a pause of ``--sleep``
+    seconds between chunks, so that no single statement holds locks on much of the table for long. Each chunk picks up
+    where the last left off, so the whole run reads the table only once. Records predating access tracking
+    are judged by ``date_set`` where it's available and are otherwise left alone unless ``--include-unknown`` is given.
+    Deleted records are evicted from ``CACHE_FRAG_KEYS`` in every process (see `CacheFragRegistry`_) once the run
+    finishes, so any that are rendered again will simply be recreated. Cached content is not cleared and will expire as usual.
+
+    This is safe to run regularly, as from cron.
+    """
+    help = 'Deletes CacheFrag records that have not been accessed within the given number of days.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='The number of records to delete at a time.')
+        parser.add_argument('--days', type=int, default=30, help='Delete records not accessed for this many days.')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the records that would be deleted.')
+        parser.add_argument('--include-unknown', action='store_true', help='Also delete records with no access or set date.')
+        parser.add_argument('--sleep', type=float, default=0.1, help='Seconds to pause between chunks.')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        stale = Q(date_accessed__lt=cutoff) | Q(date_accessed=None, date_set__lt=cutoff)
+        if options['include_unknown']:
+            stale |= Q(date_accessed=None, date_set=None)
+        cfs = CacheFrag.objects.filter(stale)
+        if options['dry_run']:
+            self.stdout.write(f'{cfs.count()} records would be deleted.')
+            return
+        deleted, last = 0, ''
+        cfs = cfs.order_by('key').values_list('key', 'name', 'user_id', 'site_id', 'tokens')
+        while True:
+            chunk = list(cfs.filter(key__gt=last)[:options['chunk_size']])
+            if not chunk:
+                break
+            last = chunk[-1][0]
+            CacheFrag.objects.filter(key__in=[c[0] for c in chunk]).delete()
+            CACHE_FRAG_KEYS.evict([f'{n}|{u or ""}|{s or ""}|{t or []}' for _, n, u, s, t in chunk], notify=False)
+            deleted += len(chunk)
+            if options['verbosity'] > 1:
+                self.stdout.write(f'Deleted {deleted} records...')
+            time.sleep(options['sleep'])
+        if deleted:  # tell other processes to drop their entries for the deleted records
+            CACHE_FRAG_KEYS.evict((), notify=True)
+        self.stdout.write(f'Deleted {deleted} records.')
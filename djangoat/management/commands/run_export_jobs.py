@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ... import DJANGOAT_EXPORT
+from ...exports import run_export_job
+from ...models import ExportJob
+
+
+
+
+class Command(BaseCommand):
+    """Runs `ExportJob`_ records queued for the "database" backend as they arrive.
+
+    With ``DJANGOAT_EXPORT["backend"]`` set to "database", web processes only record export jobs, and this command
+    does the work, so that exports run on whichever machines we choose and survive restarts of the web processes. Keep
+    it running under a process supervisor:
+
+    ..  code-block:: bash
+
+        python manage.py run_export_jobs
+
+    Pending jobs are run one at a time, oldest first, and when none are left, the database is checked again every
+    ``--sleep`` seconds. Any number of workers may run at once, since each job is claimed by a single update that only
+    one can win. With ``--once``, the command exits as soon as no jobs are pending, as when run from cron. Jobs left
+    running by a worker that died are not retried; delete them and export again.
+    """
+    help = 'Runs export jobs queued for the database backend.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit once no jobs are pending rather than waiting for more.')
+        parser.add_argument('--sleep', type=float, default=DJANGOAT_EXPORT['poll'], help='Seconds to wait between checks for pending jobs.')
+
+    def handle(self, *args, **options):
+        jobs = ExportJob.objects.filter(status=ExportJob.PENDING, backend='database').order_by('date_created', 'pk')
+        while True:
+            close_old_connections()
+            pk = jobs.values_list('pk', flat=True).first()
+            if pk is None:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+            elif run_export_job(pk) and options['verbosity'] > 1:
+                self.stdout.write(f'Ran export job #{pk}.')
@@ -0,0 +1,111 @@
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.core.management.base import BaseCommand
+from django.core.signals import request_finished
+from django.db import connections
+from django.db.models import Q
+from django.test import Client
+
+from ...cache import flush_cache_frag_accesses, flush_cache_frags, flush_cache_frags_in_background
+from ...models import CacheFrag
+
+
+
+
+class Command(BaseCommand):
+    """Repopulates the cache by requesting the paths recorded on `CacheFrag`_ records.
+
+    After a deploy or a cache flush, every fragment is cold, and the first wave of traffic would otherwise render them
+    all at once. Running this beforehand requests each distinct path on which fragments were first rendered, through
+    Django's test client, so that they're already cached when traffic arrives:
+
+    ..  code-block:: bash
+
+        python manage.py warm_cache_frags --concurrency 8 --name nav --name footer
+
+    Requests are made ``--concurrency`` at a time, each with the host of the record's site, if the Sites framework is
+    installed, or else ``--host``. Fragments specific to a user are skipped unless ``--users`` is given, in which case
+    each is requested with a session of its user. Sessions are made directly rather than by logging in, so that users'
+    last login times are left alone and login signals aren't sent, and are deleted once their requests complete.
+    Paths with a query string are skipped unless ``--query-strings`` is given, since those are likelier to be searches
+    or other requests with side effects. Since the test client bypasses the web server, the command should be run on a
+    machine that shares the production cache. New `CacheFrag`_ records are written before the command exits.
+    """
+    help = 'Requests the paths on which CacheFrags were rendered, so that they are cached before traffic arrives.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4, help='The number of requests to make at once.')
+        parser.add_argument('--host', help='The host for requests whose site is unknown; defaults to the first of ALLOWED_HOSTS.')
+        parser.add_argument('--limit', type=int, help='The max number of paths to request.')
+        parser.add_argument('--name', action='append', dest='names', help='Only warm fragments with this name; may be repeated.')
+        parser.add_argument('--query-strings', action='store_true', help='Also request paths that have a query string.')
+        parser.add_argument('--site', type=int, help='Only warm fragments for this site id.')
+        parser.add_argument('--users', action='store_true', help='Also warm user-specific fragments, logging in as each user.')
+
+    def handle(self, *args, **options):
+        cfs = CacheFrag.objects.exclude(path=None).exclude(path='')
+        if not options['query_strings']:
+            cfs = cfs.exclude(path__contains='?')
+        if options['names']:
+            cfs = cfs.filter(name__in=options['names'])
+        if options['site'] is not None:
+            cfs = cfs.filter(Q(site_id=options['site']) | Q(site_id=None))
+        if not options['users']:
+            cfs = cfs.filter(user=None)
+        requests = cfs.values_list('path', 'site_id', 'user_id').distinct().order_by('site_id', 'user_id', 'path')
+        if options['limit']:
+            requests = requests[:options['limit']]
+        requests = list(requests)
+        hosts = self.get_hosts(options['host'])
+        results = {}
+        request_finished.disconnect(dispatch_uid='djangoat_flush_cache_frags')  # flushed below, as threads may not finish
+        try:
+            with ThreadPoolExecutor(max_workers=max(options['concurrency'], 1)) as executor:
+                for path, status in executor.map(lambda r: self.request(*r, hosts), requests):
+                    results[status] = results.get(status, 0) + 1
+                    if status != 200 and options['verbosity'] > 1:
+                        self.stderr.write(f'{status} {path}')
+        finally:
+            request_finished.connect(flush_cache_frags_in_background, dispatch_uid='djangoat_flush_cache_frags')
+            flush_cache_frags()
+            flush_cache_frag_accesses()
+        self.stdout.write(f'Requested {len(requests)} paths: ' + ', '.join(f'{n} x {s}' for s, n in sorted(results.items(), key=str)))
+
+    def get_hosts(self, host):
+        # Returns a dict of hosts keyed by site id, with None for requests whose site is unknown
+        hosts = {None: host or next((h.lstrip('.') for h in settings.ALLOWED_HOSTS if h != '*'), 'testserver')}
+        if apps.is_installed('django.contrib.sites'):
+            from django.contrib.sites.models import Site
+            hosts.update(Site.objects.values_list('id', 'domain'))
+        return hosts
+
+    def request(self, path, site_id, user_id, hosts):
+        # Requests a single path, returning it along with the response's status code or the name of the error raised
+        client = Client(raise_request_exception=False)
+        session = None
+        try:
+            if user_id:
+                session = self.start_session(client, get_user_model().objects.get(pk=user_id))
+            return path, client.get(path, HTTP_HOST=hosts.get(site_id, hosts[None])).status_code
+        except Exception as e:
+            return path, type(e).__name__
+        finally:
+            if session is not None:
+                session.delete()
+            connections.close_all()
+
+    def start_session(self, client, user):
+        # Saves a session authenticated as user and gives its cookie to client, as "force_login" does, but without
+        # sending "user_logged_in", which would update the user's last login and trigger any login auditing
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        if hasattr(user, 'get_session_auth_hash'):
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        return session
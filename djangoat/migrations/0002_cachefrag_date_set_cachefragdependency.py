@@ -0,0 +1,30 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djangoat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachefrag',
+            name='date_set',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='CacheFragDependency',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('object_id', models.CharField(blank=True, default='', max_length=100)),
+                ('cache_frag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dependencies', to='djangoat.cachefrag')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['model', 'object_id'], name='djangoat_ca_model_f784c5_idx')],
+                'unique_together': {('cache_frag', 'model', 'object_id')},
+            },
+        ),
+    ]
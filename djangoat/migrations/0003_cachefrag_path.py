@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djangoat', '0002_cachefrag_date_set_cachefragdependency'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachefrag',
+            name='path',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
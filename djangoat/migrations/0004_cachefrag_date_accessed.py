@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djangoat', '0003_cachefrag_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachefrag',
+            name='date_accessed',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
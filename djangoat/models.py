@@ -1,18 +1,216 @@
+import hashlib
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
 from django.conf import settings
-from django.core.cache import cache
+from django.core.cache import caches
+from django.core.files.storage import default_storage
 from django.db import models
+from django.db.models import Q
+
+from . import DJANGOAT_CACHE_FRAG, DJANGOAT_EXPORT
+
+
+
+
+# REGISTRIES
+class CacheFragRegistry(object):
+    """A size-capped, least-recently-used map of CacheFrag lookup strings to cache keys.
+
+    The `cachefrag tag`_ and its variants use this to learn whether a fragment already has a `CacheFrag`_ record
+    without having to hit the database. Lookup strings take the form "NAME|USER_ID|SITE_ID|TOKENS", and the registry
+    holds at most ``DJANGOAT_CACHE_FRAG["registry_size"]`` of them, discarding those used least recently once full.
+    This keeps worker memory flat, even when fragments vary per user. To see how much memory it's using, call
+    `memory_usage`_.
+
+    Because evicted or never-seen entries would otherwise send each worker to the database, registrations are also
+    shared via the ``DJANGOAT_CACHE_FRAG["registry_cache"]`` cache. When an entry isn't held locally, we check there
+    before assuming the fragment is new. On first use, the registry also warms itself from a snapshot of recently
+    registered keys kept in that same cache. Only when no snapshot exists will a single query be made to build one,
+    so that new worker processes needn't each query `CacheFrag`_ on startup.
+    """
+    shared_prefix = 'djangoat.cfk.'
+
+    def __init__(self, size=None):
+        self.checked = time.time()
+        self.entries = OrderedDict()
+        self.generation = None
+        self.lock = threading.Lock()
+        self.size = size
+        self.warmed = False
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > (self.size or DJANGOAT_CACHE_FRAG['registry_size']):
+                self.entries.popitem(last=False)
+
+    def check(self):
+        """Discards all local entries if records have been pruned by any process since this was last called.
+
+        Pruning bumps a generation counter in the shared cache (see `evict`_), which every process checks at most
+        every ``DJANGOAT_CACHE_FRAG["registry_check"]`` seconds. Entries that remain registered are simply found again
+        in the shared cache as needed.
+        """
+        self.checked = time.time()
+        generation_key = self.shared_prefix + 'gen'
+        generation = self.get_shared_cache().get(generation_key)
+        if generation is None:
+            self.get_shared_cache().add(generation_key, 0, None)
+            generation = self.get_shared_cache().get(generation_key, 0)
+        if self.generation is not None and generation != self.generation:
+            with self.lock:
+                self.entries.clear()
+        self.generation = generation
+
+    def evict(self, keys, notify=True):
+        """Removes lookup strings from this registry and from the shared cache, and tells other processes to do the same.
+
+        Call this after deleting the records to which ``keys`` refer, so that they'll be registered again should they
+        be rendered. Other processes discard their local entries within ``DJANGOAT_CACHE_FRAG["registry_check"]``
+        seconds. Since that makes every process start its registry anew, callers evicting in batches should pass
+        ``notify=False`` for all but the last.
+
+        :param keys: lookup strings of the form "NAME|USER_ID|SITE_ID|TOKENS"
+        :param notify: whether to tell other processes to discard their local entries
+        """
+        with self.lock:
+            for k in keys:
+                self.entries.pop(k, None)
+        shared = self.get_shared_cache()
+        shared.delete_many([self.shared_prefix + hashlib.md5(k.encode()).hexdigest() for k in keys])
+        if not notify:
+            return
+        shared.delete(self.shared_prefix + 'warm')
+        try:
+            shared.incr(self.shared_prefix + 'gen')
+        except ValueError:  # the counter doesn't exist yet or was evicted, so start a new one
+            shared.add(self.shared_prefix + 'gen', 1, None)
+
+    def get(self, key, default=None):
+        """Returns the cache key for ``key``, checking the shared cache when it isn't held locally.
+
+        :param key: a lookup string of the form "NAME|USER_ID|SITE_ID|TOKENS"
+        :param default: the value to return when ``key`` is not registered
+        :return: the associated cache key or ``default``
+        """
+        if not self.warmed:
+            self.warm()
+        if time.time() - self.checked > DJANGOAT_CACHE_FRAG['registry_check']:
+            self.check()
+        with self.lock:
+            value = self.entries.get(key, None)
+            if value is not None:
+                self.entries.move_to_end(key)
+                return value
+        value = self.get_shared_cache().get(self.shared_prefix + hashlib.md5(key.encode()).hexdigest())
+        if value is None:
+            return default
+        self[key] = value
+        return value
+
+    def get_shared_cache(self):
+        return caches[DJANGOAT_CACHE_FRAG['registry_cache']]
+
+    def memory_usage(self):
+        """Returns the approximate number of bytes held by the registry's keys and values.
+
+        :return: bytes
+        """
+        with self.lock:
+            return sys.getsizeof(self.entries) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in self.entries.items())
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.entries.pop(key, default)
+
+    def share(self, entries):
+        """Records lookup string / cache key pairs in the shared cache, so other processes can find them.
+
+        :param entries: a dict of cache keys keyed by lookup string
+        """
+        self.get_shared_cache().set_many(
+            {self.shared_prefix + hashlib.md5(k.encode()).hexdigest(): v for k, v in entries.items()},
+            DJANGOAT_CACHE_FRAG['registry_timeout']
+        )
+
+    def warm(self):
+        """Loads recently registered entries, preferably from the shared cache snapshot.
+
+        This runs automatically the first time the registry is used. Should no snapshot exist, the most recently set
+        records for the current site are read from the database, and a snapshot is saved for other processes. If
+        another process is already building the snapshot, we simply start empty.
+        """
+        self.warmed = True
+        self.check()  # note the current generation, so that later pruning can be detected
+        shared = self.get_shared_cache()
+        size = self.size or DJANGOAT_CACHE_FRAG['registry_size']
+        entries = shared.get(self.shared_prefix + 'warm')
+        if entries is None:
+            if not shared.add(self.shared_prefix + 'warm.lock', 1, 60):  # another process is already building one
+                return
+            cfs = CacheFrag.objects.order_by(models.F('date_set').desc(nulls_last=True))
+            if getattr(settings, 'SITE_ID', None):  # no reason to import frags for other sites
+                cfs = cfs.filter(Q(site_id=None) | Q(site_id=settings.SITE_ID))
+            entries = [
+                (f'{n}|{u or ""}|{s or ""}|{t or []}', k)
+                for k, n, u, s, t in cfs.values_list('key', 'name', 'user_id', 'site_id', 'tokens')[:size]
+            ]
+            shared.set(self.shared_prefix + 'warm', entries, DJANGOAT_CACHE_FRAG['registry_timeout'])
+        with self.lock:
+            for k, v in reversed(entries[:size]):  # oldest first, so the most recent end up least likely to be evicted
+                self.entries.setdefault(k, v)
+
+
+
+
+CACHE_FRAG_KEYS = CacheFragRegistry()  # store cache keys by CacheFrag name / site / user / token strings to save database hits for lookups
+
+
 
 
+# FUNCTIONS
+def get_export_path(instance, filename):
+    # Returns the path within the export storage to which an ExportJob's file is saved
+    return DJANGOAT_EXPORT['path'] + filename
 
 
-CACHE_FRAG_KEYS = {}  # store cache keys by CacheFrag name / site / user / token strings to save database hits for lookups
+
+def get_export_storage():
+    # Returns the storage to which ExportJob files are saved
+    if not DJANGOAT_EXPORT['storage']:
+        return default_storage
+    from django.core.files.storage import storages
+    return storages[DJANGOAT_EXPORT['storage']]
+
+
+
+def get_stored_keys(cfs):
+    """Returns the keys under which content is currently stored for each CacheFrag key.
+
+    :param cfs: a list of (CacheFrag key, generation keys) tuples
+    :return: a list of cache keys with generations folded in
+    """
+    from .cache import fold_generations, get_generations
+    generations = get_generations(list({k for _, gks in cfs for k in gks}))
+    return [fold_generations(key, gks, generations) for key, gks in cfs]
 
 
 
 
 # QUERYSETS
 class CacheFragQuerySet(models.QuerySet):
-    def clear(self):
+    def clear(self, chunk_size=1000):
         """Clears associated content from the cache.
 
         For example, to clear all CacheFrags associated with a given user, we might use the following.
@@ -21,12 +219,72 @@ class CacheFragQuerySet(models.QuerySet):
 
             CacheFrag.object.filter(user_id=12345).clear()
 
+        Keys are read from the database ``chunk_size`` at a time and deleted from the fragment cache with
+        `delete_cache_frags`_, which also deletes the pieces of any content that was split into chunks. To clear an entire group of fragments at once, regardless of how many there are,
+        see `invalidate`_. Copies held in process memory (see `LocalCacheFrags`_) are discarded shortly after.
+
+        :param chunk_size: the number of keys to read and delete at a time
         :return: the queryset
         """
-        for cf in self.all():
-            cache.delete(cf.key)
+        from .cache import LocalCacheFrags, bump_generations, delete_cache_frags, get_fragment_cache, get_generation_keys
+        fragment_cache = get_fragment_cache()
+        cleared = False
+        chunk = []
+        for key, name, site_id, user_id in self.values_list('key', 'name', 'site_id', 'user_id').iterator(chunk_size=chunk_size):
+            chunk.append((key, get_generation_keys(name, site_id, user_id)))
+            if len(chunk) == chunk_size:
+                delete_cache_frags(fragment_cache, get_stored_keys(chunk))
+                cleared = True
+                chunk = []
+        if chunk:
+            delete_cache_frags(fragment_cache, get_stored_keys(chunk))
+            cleared = True
+        if cleared:
+            bump_generations([LocalCacheFrags.generation_key])
         return self
 
+    def invalidate(self):
+        """Invalidates every group of fragments containing a member of the queryset.
+
+        This relies on the generation counters described in `get_generation_keys`_. Each record is assigned to its
+        narrowest group among those enabled in ``DJANGOAT_CACHE_FRAG["generations"]``, that being the group of its
+        user, then its site, then its name, and that group's counter is incremented. For example, with "name"
+        enabled, the following will instantly invalidate every "nav" fragment, however many there are:
+
+        ..  code-block:: python
+
+            CacheFrag.objects.filter(name="nav").invalidate()
+
+        Where generations are disabled or don't apply to a record, it is cleared via `clear`_ instead.
+
+        :return: the queryset
+        """
+        from .cache import LocalCacheFrags, bump_generations, get_generation_keys
+        scopes = DJANGOAT_CACHE_FRAG['generations']
+        keys = {LocalCacheFrags.generation_key}
+        for name, site_id, user_id in self.values_list('name', 'site_id', 'user_id').distinct().iterator():
+            gks = get_generation_keys(name, site_id, user_id)
+            if gks:
+                keys.add(gks[-1])  # keys run from broadest to narrowest
+        bump_generations(keys)
+        if 'name' not in scopes:  # clear records that belong to no group
+            ungrouped = Q()
+            if 'site' in scopes:
+                ungrouped &= Q(site_id=None)
+            if 'user' in scopes:
+                ungrouped &= Q(user=None)
+            self.filter(ungrouped).clear()
+        return self
+
+
+
+class ExportJobQuerySet(models.QuerySet):
+    def delete(self):
+        """Deletes the selected jobs along with their files."""
+        for job in self.exclude(file=''):
+            job.file.delete(save=False)
+        return super().delete()
+
 
 
 
@@ -45,8 +303,7 @@ class CacheFrag(models.Model):
 
 
         def clear_cache_frags(modeladmin, request, queryset):
-            for cf in queryset:
-                cache.delete(cf.key)  # clear cache contents, so it can repopulate on next access
+            queryset.clear()  # clear cache contents, so it can repopulate on next access
         clear_cache_frags.short_description = 'Clear selected fragments'
 
 
@@ -66,6 +323,9 @@ class CacheFrag(models.Model):
     On the CacheFrag list page, we will now be able to search for and filter on CacheFrag records and clear them
     individually via the cache key associated with each.
 
+    Each record also stores the path, including any query string, of the request during which it was first rendered,
+    so that the `warm_cache_frags command`_ can request it again after a deploy or cache flush.
+
     Note that we will also have the option of deleting these records, but deleting a CacheFrag will NOT affect the
     cache, and the record will simply repopulate the next time it's accessed from a template. We should only delete
     CacheFrag records that are no longer in use, so as to declutter the list.
@@ -74,8 +334,10 @@ class CacheFrag(models.Model):
     name = models.CharField(max_length=100, db_index=True)
     site_id = models.PositiveSmallIntegerField(null=True, blank=True, db_index=True)  # use an int field, so as not to require the Sites framework
     user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.CASCADE)
-    args = models.CharField(max_length=500, null=True, blank=True)  # a list of args, converted to strings and joined together by "|"; corresponds to "vary_on" in "make_template_fragment_key"
+    tokens = models.JSONField(null=True, blank=True)  # corresponds to "vary_on" in "make_template_fragment_key"
     date_set = models.DateTimeField(null=True, blank=True)
+    date_accessed = models.DateTimeField(null=True, blank=True, db_index=True)  # approximate; see "record_cache_frag_access"
+    path = models.CharField(max_length=255, null=True, blank=True)  # the path of the request that first rendered it
 
     objects = CacheFragQuerySet.as_manager()
 
@@ -88,3 +350,66 @@ class CacheFrag(models.Model):
         if self.tokens:
             r.append('Tokens: ' + str(self.tokens))
         return ' | '.join(r)
+
+
+
+class CacheFragDependency(models.Model):
+    """Records a model or model instance on which the content of a `CacheFrag`_ depends.
+
+    These are created from the ``depends`` argument of the `cachefrag tag`_ and its variants. Whenever a dependency is
+    saved or deleted, or its many-to-many relations change, the fragments that depend upon it are cleared. An empty
+    ``object_id`` means that the fragment depends on every instance of the model.
+    """
+    cache_frag = models.ForeignKey(CacheFrag, on_delete=models.CASCADE, related_name='dependencies')
+    model = models.CharField(max_length=100)  # a lowercase model label, e.g. "auth.user"
+    object_id = models.CharField(max_length=100, blank=True, default='')
+
+    class Meta:
+        indexes = [models.Index(fields=['model', 'object_id'])]
+        unique_together = 'cache_frag', 'model', 'object_id'
+
+    def __str__(self):
+        return f'{self.model} #{self.object_id}' if self.object_id else self.model
+
+
+
+class ExportJob(models.Model):
+    """Tracks a CSV export running in the background, along with the file it produces.
+
+    Jobs are created by `queue_export_job`_, usually via the ``background`` argument of `csv_export_action`_, and run
+    by `run_export_job`_ on whichever backend ``DJANGOAT_EXPORT["backend"]`` names, so that large exports never tie up
+    a web worker or run into request timeouts. While a job runs, ``rows`` is updated every few seconds, and once it
+    finishes, ``file`` holds the CSV in the storage named by ``DJANGOAT_EXPORT["storage"]``. To follow jobs and
+    download their files in the admin, register `ExportJobAdmin`_.
+
+    ``spec`` holds the pickled arguments of the export for backends that run it outside of the process that queued
+    it, and is empty for those that don't. Deleting a job, whether singly or via a queryset, also deletes its file.
+    """
+    DONE, FAILED, PENDING, RUNNING = 'done', 'failed', 'pending', 'running'
+    STATUSES = (PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')
+
+    name = models.CharField(max_length=100)  # the name of the CSV file, without the ".csv" extension
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING, db_index=True)
+    backend = models.CharField(max_length=100)  # the backend that runs it; see "DJANGOAT_EXPORT"
+    spec = models.BinaryField(null=True, blank=True)
+    file = models.FileField(upload_to=get_export_path, storage=get_export_storage, max_length=255, blank=True)
+    rows = models.PositiveIntegerField(default=0)  # the number of rows written so far, excluding headers
+    total = models.PositiveIntegerField(null=True, blank=True)  # the number of records being exported
+    error = models.TextField(blank=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_started = models.DateTimeField(null=True, blank=True)
+    date_finished = models.DateTimeField(null=True, blank=True)
+
+    objects = ExportJobQuerySet.as_manager()
+
+    class Meta:
+        ordering = '-date_created',
+
+    def __str__(self):
+        return f'{self.name}.csv ({self.get_status_display()})'
+
+    def delete(self, *args, **kwargs):
+        if self.file:
+            self.file.delete(save=False)
+        return super().delete(*args, **kwargs)
@@ -0,0 +1,50 @@
+from django.dispatch import Signal
+
+from .cache import is_dependency, queue_invalidation
+
+
+
+
+# SIGNALS
+cache_frag_stats_flushed = Signal()  # sent with "stats" by "flush_cache_frag_stats"
+
+
+
+
+# FUNCTIONS
+def get_related_pks(through, instance, reverse, model, using):
+    # Returns the primary keys of the "model" instances related to "instance" via a many-to-many "through" model
+    field = next(f for f in (model if reverse else type(instance))._meta.many_to_many if f.remote_field.through is through)
+    source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    if reverse:
+        source, target = target, source
+    return list(through._default_manager.using(using).filter(**{source: instance.pk}).values_list(target, flat=True))
+
+
+
+
+# RECEIVERS
+def invalidate_on_delete(sender, instance, using, **kwargs):
+    """Clears fragments depending on a deleted instance or its model."""
+    if sender._meta.managed and is_dependency(sender._meta.label_lower):
+        queue_invalidation(sender._meta.label_lower, [instance.pk], using)
+
+
+
+def invalidate_on_m2m_change(sender, instance, action, reverse, model, pk_set, using, **kwargs):
+    """Clears fragments depending on either side of a changed many-to-many relation."""
+    if action not in ('post_add', 'post_remove', 'pre_clear'):  # "post_clear" doesn't say which instances were removed
+        return
+    if is_dependency(instance._meta.label_lower):
+        queue_invalidation(instance._meta.label_lower, [instance.pk], using)
+    if is_dependency(model._meta.label_lower):
+        if action == 'pre_clear':  # "clear" runs in a transaction, so this waits until the rows are gone
+            pk_set = get_related_pks(sender, instance, reverse, model, using)
+        queue_invalidation(model._meta.label_lower, pk_set, using)
+
+
+
+def invalidate_on_save(sender, instance, raw, using, **kwargs):
+    """Clears fragments depending on a saved instance or its model."""
+    if not raw and sender._meta.managed and is_dependency(sender._meta.label_lower):  # skip fixtures and unmanaged models
+        queue_invalidation(sender._meta.label_lower, [instance.pk], using)
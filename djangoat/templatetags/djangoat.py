@@ -1,26 +1,44 @@
 import math
+import random
+import re
+import time
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.utils import timezone
 from django.utils.safestring import mark_safe
-from django.core.cache import InvalidCacheBackendError, caches
+from django.core.cache import caches
 from django.core.cache.utils import make_template_fragment_key
 from django.db.models.fields.files import ImageFieldFile
-from django.template import Library, Node, TemplateSyntaxError, VariableDoesNotExist
+from django.template.defaulttags import ForNode
+from django.template import Library, Node, TemplateDoesNotExist, TemplateSyntaxError, Variable, VariableDoesNotExist
 
-from .. import (DJANGOAT_DATA, DJANGOAT_PAGER, DJANGOAT_THUMB_GET_URL, DJANGOAT_THUMB_TYPE_HTML,
+from .. import (DJANGOAT_CACHE_FRAG, DJANGOAT_DATA, DJANGOAT_PAGER, DJANGOAT_THUMB_GET_URL, DJANGOAT_THUMB_TYPE_HTML,
                 DJANGOAT_THUMB_TYPE_URLS, DJANGOAT_TIMES)
 
+from ..cache import (CODEC_CHUNKED, LOCAL_CACHE_FRAGS, aget_generations, decode_cache_frag, encode_cache_frag,
+                     fetch_cache_frag, fold_generations, get_dependencies, get_generation_keys, get_generations,
+                     get_vary_on_token, queue_cache_frag, record_cache_frag_access, record_cache_frag_hit,
+                     record_cache_frag_miss, record_etag_fragment, store_cache_frag, submit_cache_frag_task)
 from ..models import CACHE_FRAG_KEYS, CacheFrag
 
 register = Library()
 
+CACHE_FRAG_HOLES = 'djangoat_cache_frag_holes'  # the context variable holding the nocache holes of the outermost fragment being rendered
+CACHE_FRAG_OPTIONS = 'beta', 'depends', 'local', 'lock', 'stale', 'using'  # keyword arguments accepted at the end of cachefrag tags
+CACHE_FRAG_PREFETCH = 'djangoat_cache_frag_prefetch'  # the context variable holding cachefrag_prefetch results
+MANAGED_CACHE_FRAG_OPTIONS = {'lock', 'stale'}  # options whose fragments manage their own fetching and storage
+NOCACHE_NODES = {}  # the latest nocache nodes compiled for templates loaded by name, keyed by (hole id, template name)
+NOCACHE_PLACEHOLDER = re.compile(r'<!--djangoat-nocache:(\d+):(.*?)-->')  # marks where nocache content goes in cached content
+NOT_LITERAL = object()  # marks cachefrag arguments that must be resolved at render time
+
 
 
 
 # The following cache tags are based upon the original Django cache tag, located at the address below:
 # https://github.com/django/django/blob/main/django/templatetags/cache.py
 class CacheFragNode(Node):
-    def __init__(self, nodelist, expire_time_var, fragment_name, vary_on, cache_name, site=None, user=False):
+    def __init__(self, nodelist, expire_time_var, fragment_name, vary_on, cache_name, site=None, user=False, options=None):
         self.nodelist = nodelist
         self.expire_time_var = expire_time_var
         self.fragment_name = fragment_name
@@ -28,64 +46,359 @@ class CacheFragNode(Node):
         self.cache_name = cache_name
         self.site = site
         self.user = user
+        self.options = options or {}  # option name / FilterExpression pairs, excluding "using"
+
+        # Resolve literal arguments now, so that renders needn't repeat the work
+        self.expire_time = get_filter_literal(expire_time_var)
+        if self.expire_time is not NOT_LITERAL:
+            self.expire_time = get_cache_frag_seconds(self.expire_time)
+        if cache_name is None:
+            self.cache_alias = 'template_fragments' if 'template_fragments' in settings.CACHES else 'default'
+        else:
+            self.cache_alias = get_filter_literal(cache_name)
+            if self.cache_alias is not NOT_LITERAL and self.cache_alias not in settings.CACHES:
+                raise TemplateSyntaxError('Invalid cache name specified for "cachefrag" tag (or variant): ' + repr(self.cache_alias))
+        self.dependencies = get_filter_literal(self.options['depends']) if 'depends' in self.options else None
+        if self.dependencies is not NOT_LITERAL:
+            try:
+                self.dependencies = get_dependencies(self.dependencies)
+            except (LookupError, ValueError) as e:
+                raise TemplateSyntaxError('Invalid "depends" argument for "cachefrag" tag (or variant): ' + str(e))
+        self.holes = {n.key: n for n in nodelist.get_nodes_by_type(NoCacheNode)}  # those in this template
+        self.vary_on_literal = [get_filter_literal(v) for v in vary_on]
+        if any(v is NOT_LITERAL for v in self.vary_on_literal):
+            self.vary_on_literal = None
+        self.get_key = self.compile_key()
+
+    def compile_key(self):
+        """Returns a function that takes the template context and returns the CACHE_FRAG_KEYS lookup string, user id,
+        and vary_on values for the fragment.
+
+        Whatever can be known at compile time is baked into the function, so that a fragment whose ``vary_on`` values
+        are all literals needs no resolving, formatting, or hashing at render time. Its lookup string is built once
+        or, for user-specific fragments, from a precomputed prefix and suffix.
+        """
+        site = self.site or ''
+        if self.vary_on_literal is None:
+            def get_key(context):
+                user = context['request'].user.id or '' if self.user else ''
+                vary_on = [get_vary_on_token(v.resolve(context)) for v in self.vary_on]
+                return f'{self.fragment_name}|{user}|{site}|{vary_on}', user, vary_on
+            return get_key
+        vary_on = self.vary_on_literal
+        prefix, suffix = f'{self.fragment_name}|', f'|{site}|{vary_on}'
+        if self.user:
+            def get_user_key(context):
+                user = context['request'].user.id or ''
+                return f'{prefix}{user}{suffix}', user, vary_on
+            return get_user_key
+        key = prefix + suffix
+        return lambda context: (key, '', vary_on)
+
+    def resolve_option(self, name, context, default=None):
+        if name not in self.options:
+            return default
+        try:
+            return self.options[name].resolve(context)
+        except VariableDoesNotExist:
+            raise TemplateSyntaxError(f'"cachefrag" tag (or variant) got an unknown variable for "{name}": ' + repr(self.options[name].var))
+
+    def render_managed(self, context, cache_name, cache_key, expire_time):
+        """Returns the fragment, allowing only one worker at a time to regenerate it.
+
+        Content is stored along with the seconds it took to render and the time at which it expires. With ``lock``, we
+        use these on each hit to decide whether to regenerate a little ahead of expiry, with the odds rising as expiry
+        nears and as render cost grows (the "XFetch" approach to stampede prevention). Only the worker that wins the
+        lock, taken via ``add`` on the fragment cache, regenerates; everyone else keeps serving the current content.
+        When the fragment is missing entirely, workers that lose the lock wait briefly for the winner's content.
+
+        With ``stale``, the fragment remains in the cache for that many seconds beyond its expiry. Requests arriving in
+        this window receive the stale content immediately, while the lock winner hands regeneration off to a
+        background thread.
+        """
+        fragment_cache = caches[cache_name]
+        lock = self.resolve_option('lock', context)
+        stale = get_cache_frag_seconds(self.resolve_option('stale', context))
+        beta = float(self.resolve_option('beta', context, DJANGOAT_CACHE_FRAG['beta'] if lock else 0))
+        lock_timeout = get_cache_frag_seconds(lock) or DJANGOAT_CACHE_FRAG['lock_timeout']
+        lock_key = cache_key + '.lock'
+        entry = fetch_cache_frag(fragment_cache, cache_key)
+        if entry is not None:
+            record_cache_frag_hit(self.fragment_name)  # whatever happens below, this request is served from the cache
+            value, delta, expiry = entry
+            if expiry is None or time.time() - delta * beta * math.log(1 - random.random()) < expiry:
+                return value
+            if not fragment_cache.add(lock_key, 1, lock_timeout):  # another worker is already regenerating
+                return value
+            if stale:
+                if not submit_cache_frag_task(self.regenerate, context.new(context.flatten()), cache_name, cache_key, expire_time, stale, lock_key):
+                    fragment_cache.delete(lock_key)  # the pool is saturated, so leave regeneration to a later request
+                return value
+        elif not lock:
+            lock_key = None
+        elif not fragment_cache.add(lock_key, 1, lock_timeout):
+            deadline = time.time() + DJANGOAT_CACHE_FRAG['lock_wait']
+            while time.time() < deadline:
+                time.sleep(DJANGOAT_CACHE_FRAG['lock_poll'])
+                entry = fetch_cache_frag(fragment_cache, cache_key)
+                if entry is not None:
+                    record_cache_frag_hit(self.fragment_name)
+                    return entry[0]
+            return self.render_nodelist(context)  # the lock holder is taking too long, so don't keep the user waiting
+        return self.regenerate(context, cache_name, cache_key, expire_time, stale, lock_key)
+
+    def regenerate(self, context, cache_name, cache_key, expire_time, stale=None, lock_key=None):
+        # Renders and stores content for "render_managed", which may call this from a background thread
+        fragment_cache = caches[cache_name]
+        try:
+            start = time.time()
+            value = self.render_nodelist(context)
+            now = time.time()
+            size = store_cache_frag(
+                fragment_cache,
+                cache_key,
+                value,
+                None if expire_time is None else expire_time + (stale or 0),
+                now - start,
+                None if expire_time is None else now + expire_time
+            )
+            record_cache_frag_miss(self.fragment_name, now - start, size)
+        finally:
+            if lock_key:
+                fragment_cache.delete(lock_key)
+        return value
+
+    def fill_holes(self, context, value):
+        """Returns the fragment's content with the placeholders left by nocache tags replaced by their content.
+
+        Placeholders name the template and number of their hole, so that those left by fragments in included templates
+        can be filled as well, loading the template first if this process has yet to. Each hole is rendered once for
+        the current request, however many times its placeholder appears. Placeholders for holes that no longer exist,
+        as when cached content outlives a template change, are removed.
+        """
+        if '<!--djangoat-nocache:' not in value:
+            return value
+        rendered = {}
+
+        def fill(match):
+            key = int(match.group(1)), match.group(2)
+            if key not in rendered:
+                hole = self.holes.get(key, None) or NOCACHE_NODES.get(key, None)
+                if hole is None and key[1] and context.template is not None:
+                    try:
+                        context.template.engine.get_template(key[1])  # which registers its holes
+                    except TemplateDoesNotExist:
+                        pass
+                    hole = NOCACHE_NODES.get(key, None)
+                rendered[key] = hole.nodelist.render(context) if hole else ''
+            return rendered[key]
+        return mark_safe(NOCACHE_PLACEHOLDER.sub(fill, value))
+
+    def get_cache_key(self, context, register=True):
+        """Returns the fragment's CACHE_FRAG_KEYS lookup string, its CacheFrag key, and its generation keys.
+
+        When ``register`` is True, a `CacheFrag`_ record is queued for the fragment if it has yet to be registered, or
+        its access is recorded if it has (see `record_cache_frag_access`_).
+        The key under which content is actually stored is the CacheFrag key with the current values of the generation
+        keys folded in (see `get_generation_keys`_).
+        """
+        key, user, vary_on = self.get_key(context)
+        site = self.site or ''
+        cache_key = CACHE_FRAG_KEYS.get(key, None)
+        if not cache_key:  # queue this for the db, storing it in keys immediately to prevent unnecessary calls
+            cache_key = make_template_fragment_key(self.fragment_name, [user, site] + vary_on)
+            if register:
+                request = context.get('request', None)
+                path = request.get_full_path() if request is not None else None  # so warm_cache_frags can replay it
+                queue_cache_frag(key, CacheFrag(
+                    key=cache_key,
+                    name=self.fragment_name,
+                    site_id=site or None,
+                    user_id=user or None,
+                    tokens=vary_on or None,
+                    path=path if path and len(path) <= CacheFrag._meta.get_field('path').max_length else None,
+                    date_set=timezone.now(),
+                    date_accessed=timezone.now()
+                ), self.get_dependencies(context))
+        elif register:
+            record_cache_frag_access(cache_key)
+        return key, cache_key, get_generation_keys(self.fragment_name, site, user)
+
+    def get_dependencies(self, context):
+        if self.dependencies is not NOT_LITERAL:
+            return self.dependencies
+        try:
+            return get_dependencies(self.resolve_option('depends', context))
+        except (LookupError, ValueError) as e:
+            raise TemplateSyntaxError('Invalid "depends" argument for "cachefrag" tag (or variant): ' + str(e))
 
-    def render(self, context):
+    def get_cache_name(self, context):
+        if self.cache_alias is not NOT_LITERAL:
+            return self.cache_alias
+        try:
+            cache_name = self.cache_name.resolve(context)
+        except VariableDoesNotExist:
+            raise TemplateSyntaxError('"cachefrag" tag (or variant) got an unknown variable: ' + repr(self.cache_name.var))
+        if cache_name not in settings.CACHES:
+            raise TemplateSyntaxError('Invalid cache name specified for "cachefrag" tag (or variant): ' + repr(cache_name))
+        return cache_name
+
+    def get_expire_time(self, context):
+        if self.expire_time is not NOT_LITERAL:
+            return self.expire_time
         try:
-            expire_time = self.expire_time_var.resolve(context)
+            return get_cache_frag_seconds(self.expire_time_var.resolve(context))
         except VariableDoesNotExist:
             raise TemplateSyntaxError('"cachefrag" (or variant) tag got an unknown variable: ' + repr(self.expire_time_var.var))
-        if expire_time is not None and isinstance(expire_time, str):
-            if expire_time.isnumeric():
-                expire_time = int(expire_time)
-            else:
-                et = 0
-                for t in expire_time.split('-'):
-                    et += DJANGOAT_TIMES.get(t, 0)  # TIMES holds seconds for predefined periods (i.e. 1d, 2h, 4m, etc.)
-                if not et:
-                    raise TemplateSyntaxError('"cachefrag" tag (or variant) got a non-integer timeout value not in DJANGOAT_TIMES: ' + repr(expire_time))
-                expire_time = et
-        if self.cache_name:
-            try:
-                cache_name = self.cache_name.resolve(context)
-            except VariableDoesNotExist:
-                raise TemplateSyntaxError('"cachefrag" tag (or variant) got an unknown variable: ' + repr(self.cache_name.var))
-            try:
-                fragment_cache = caches[cache_name]
-            except InvalidCacheBackendError:
-                raise TemplateSyntaxError('Invalid cache name specified for "cachefrag" tag (or variant): ' + repr(cache_name))
-        else:
-            try:
-                fragment_cache = caches['template_fragments']
-            except InvalidCacheBackendError:
-                fragment_cache = caches['default']
-        vary_on = [v.resolve(context) for v in self.vary_on]
+
+    def render(self, context):
+        expire_time = self.get_expire_time(context)
+        cache_name = self.get_cache_name(context)
 
         # Custom code to interact with CacheFrag
-        user = context['request'].user.id or '' if self.user else ''
-        site = self.site or ''
-        key = f'{self.fragment_name}|{user}|{site}|{vary_on}'
-        cache_key = CACHE_FRAG_KEYS.get(key, None)
-        if not cache_key:  # make sure this is in the db, but store in keys to prevent unnecessary calls
-            cf, created = CacheFrag.objects.get_or_create(key=make_template_fragment_key(self.fragment_name, [user, site] + vary_on))
-            if created:
-                cf.name = self.fragment_name
-                if user:
-                    cf.user_id = user
-                if site:
-                    cf.site_id = site
-                if vary_on:
-                    cf.tokens = vary_on
-                cf.save()
-            CACHE_FRAG_KEYS[key] = cache_key = cf.key  # save, so we don't have to hit the database
-        if settings.DEBUG:
-            print(f'CACHE FRAG "{key}" (expires in {seconds_to_units(expire_time)})')
-
-        # Resume original code
-        value = fragment_cache.get(cache_key)
+        key, frag_key, generation_keys = self.get_cache_key(context)
+        prefetch = context.get(CACHE_FRAG_PREFETCH, None)
+        cache_key = frag_key
+        if generation_keys:
+            generations = prefetch.generations if prefetch and generation_keys[0] in prefetch.generations else get_generations(generation_keys)
+            cache_key = fold_generations(frag_key, generation_keys, generations)
+
+        # Check the copy held in process memory, if any, before making a trip to the cache
+        local = get_cache_frag_seconds(self.resolve_option('local', context))
+        value = LOCAL_CACHE_FRAGS.get((cache_name, cache_key)) if local else None
         if value is None:
-            value = self.nodelist.render(context)
-            fragment_cache.set(cache_key, value, expire_time)
-        return str(value)
+            value = self.render_shared(context, cache_name, cache_key, expire_time, prefetch)
+            if local:
+                LOCAL_CACHE_FRAGS.set((cache_name, cache_key), value, local if expire_time is None else min(local, expire_time))
+        else:
+            record_cache_frag_hit(self.fragment_name)
+        record_etag_fragment(cache_name, frag_key, generation_keys, value)  # for "cache_frag_etag"
+        if CACHE_FRAG_HOLES not in context:  # this isn't nested in another fragment that will fill them
+            value = self.fill_holes(context, value)
+        return value
+
+    def render_nodelist(self, context):
+        # Renders the fragment's content, leaving placeholders for nocache holes, including those of included templates
+        if CACHE_FRAG_HOLES in context:  # nested, so the outermost fragment fills them
+            return self.nodelist.render(context)
+        with context.push({CACHE_FRAG_HOLES: self.holes}):
+            return self.nodelist.render(context)
+
+    def render_shared(self, context, cache_name, cache_key, expire_time, prefetch=None):
+        # Returns the fragment from the shared cache, rendering and storing it if necessary
+        if self.options.keys() & MANAGED_CACHE_FRAG_OPTIONS:
+            return str(self.render_managed(context, cache_name, cache_key, expire_time))
+        if prefetch is not None and (cache_name, cache_key) in prefetch.values:  # fetched by cachefrag_prefetch
+            entry = prefetch.values[(cache_name, cache_key)]
+            if entry is None:
+                start = time.time()
+                value = self.render_nodelist(context)
+                delta = time.time() - start
+                items = encode_cache_frag(cache_key, value)
+                prefetch.pending.setdefault((cache_name, expire_time), {}).update(items)
+                record_cache_frag_miss(self.fragment_name, delta, sum(len(v) for v in items.values()))
+                return value
+            record_cache_frag_hit(self.fragment_name)
+            return entry[0]
+        fragment_cache = caches[cache_name]  # backends are per thread, so only the alias can be resolved in advance
+        entry = fetch_cache_frag(fragment_cache, cache_key)
+        if entry is None:
+            start = time.time()
+            value = self.render_nodelist(context)
+            delta = time.time() - start
+            record_cache_frag_miss(self.fragment_name, delta, store_cache_frag(fragment_cache, cache_key, value, expire_time))
+            return value
+        record_cache_frag_hit(self.fragment_name)
+        return entry[0]
+
+
+
+class CacheFragPrefetchNode(Node):
+    def __init__(self, nodelist):
+        self.nodelist = nodelist
+        self.cache_frag_nodes = list(get_prefetchable_cache_frag_nodes(nodelist))
+
+    async def aprefetch(self, context):
+        """Returns a CacheFragPrefetch holding the fragments fetched for ``context`` using the cache's async API.
+
+        Keys are resolved in a thread, since ``vary_on`` querysets and the registry may need the database or a
+        synchronous cache call. Fragments stored in chunks are left for their nodes to fetch as usual.
+        """
+        prefetch = CacheFragPrefetch()
+        frags = await sync_to_async(self.get_frags)(context)
+        prefetch.generations = await aget_generations(list({k for f in frags for k in f[2]}))
+        for cache_name, cache_keys in self.get_keys(frags, prefetch.generations).items():
+            found = await caches[cache_name].aget_many(cache_keys)
+            for k in cache_keys:
+                data = found.get(k, None)
+                if isinstance(data, bytes) and data[1:2] == bytes([CODEC_CHUNKED]):
+                    continue
+                prefetch.values[(cache_name, k)] = decode_cache_frag(data)
+        return prefetch
+
+    async def awrite(self, prefetch):
+        # Writes the fragments rendered for misses back to the cache using its async API
+        for (cache_name, expire_time), values in prefetch.pending.items():
+            await caches[cache_name].aset_many(values, expire_time)
+
+    def get_frags(self, context):
+        # Returns the cache alias, CacheFrag key, and generation keys of each fragment that can be resolved up front
+        frags = []
+        for node in self.cache_frag_nodes:
+            try:
+                frags.append((node.get_cache_name(context), *node.get_cache_key(context, False)[1:]))
+            except (KeyError, TemplateSyntaxError):  # this fragment can't be resolved out here, so leave it to fetch its own content
+                continue
+        return frags
+
+    def get_keys(self, frags, generations):
+        # Returns the cache keys to fetch, grouped by cache alias
+        keys = {}
+        for cache_name, cache_key, generation_keys in frags:
+            keys.setdefault(cache_name, set()).add(fold_generations(cache_key, generation_keys, generations))
+        return keys
+
+    def render(self, context):
+        prefetch = CacheFragPrefetch()
+        frags = self.get_frags(context)
+        prefetch.generations = get_generations(list({k for f in frags for k in f[2]}))
+        for cache_name, cache_keys in self.get_keys(frags, prefetch.generations).items():
+            fragment_cache = caches[cache_name]
+            found = fragment_cache.get_many(cache_keys)
+            prefetch.values.update({(cache_name, k): decode_cache_frag(found.get(k, None), fragment_cache, k) for k in cache_keys})
+        with context.push({CACHE_FRAG_PREFETCH: prefetch}):
+            output = self.nodelist.render(context)
+        for (cache_name, expire_time), values in prefetch.pending.items():
+            caches[cache_name].set_many(values, expire_time)
+        return output
+
+
+
+class CacheFragPrefetch(object):
+    # Holds fragments fetched by a CacheFragPrefetchNode, keyed by cache alias and cache key, with None for misses, the
+    # encoded entries rendered for those misses, grouped by cache alias and timeout for writing back, and generations
+    def __init__(self):
+        self.generations = {}
+        self.pending = {}
+        self.values = {}
+
+
+
+class NoCacheNode(Node):
+    def __init__(self, nodelist, hole_id, template_name=''):
+        self.nodelist = nodelist
+        self.hole_id = hole_id  # numbered in the order in which the template's nocache tags appear
+        self.key = hole_id, template_name or ''  # the name is empty for templates not loaded by name
+        if template_name:
+            NOCACHE_NODES[self.key] = self
+
+    def render(self, context):
+        holes = context.get(CACHE_FRAG_HOLES, None)
+        if holes is None:  # not within a fragment
+            return self.nodelist.render(context)
+        if not self.key[1] and holes.get(self.key, None) is not self:
+            raise TemplateSyntaxError('"nocache" tag in a template not loaded by name must appear within the template of the cachefrag tag containing it.')
+        return f'<!--djangoat-nocache:{self.key[0]}:{self.key[1]}-->'
 
 
 
@@ -96,23 +409,65 @@ def get_cache_frag_node(parser, token, endcache, site=None, user=False):
     tokens = token.split_contents()
     if len(tokens) < 3:
         raise TemplateSyntaxError("'%r' tag requires at least 2 arguments." % tokens[0])
-    if len(tokens) > 3 and tokens[-1].startswith('using='):
-        cache_name = parser.compile_filter(tokens[-1][len('using='):])
-        tokens = tokens[:-1]
-    else:
-        cache_name = None
+    options = {}
+    while len(tokens) > 3 and tokens[-1].split('=', 1)[0] in CACHE_FRAG_OPTIONS and '=' in tokens[-1]:
+        k, v = tokens.pop().split('=', 1)
+        if k in options:
+            raise TemplateSyntaxError(f"'{tokens[0]}' tag received '{k}' more than once.")
+        options[k] = parser.compile_filter(v)
     return CacheFragNode(
         nodelist,
         parser.compile_filter(tokens[1]),  # expiry
         tokens[2],  # fragment_name
         [parser.compile_filter(t) for t in tokens[3:]],  # vary on
-        cache_name,
+        options.pop('using', None),  # cache_name
         site,
-        user
+        user,
+        options
     )
 
 
 
+def get_prefetchable_cache_frag_nodes(nodelist):
+    # Yields the outermost CacheFragNodes in nodelist whose keys may be resolved before it renders, skipping those in
+    # loops, whose keys will generally depend on the loop, those that manage their own fetching, and those held in
+    # process memory, which would gain nothing from a trip to the cache
+    for node in nodelist:
+        if isinstance(node, CacheFragNode):
+            if not node.options.keys() & MANAGED_CACHE_FRAG_OPTIONS and 'local' not in node.options:
+                yield node
+        elif not isinstance(node, ForNode):
+            for attr in node.child_nodelists:
+                yield from get_prefetchable_cache_frag_nodes(getattr(node, attr, None) or [])
+
+
+
+def get_filter_literal(fe):
+    # Returns the constant held by a FilterExpression with no filters or NOT_LITERAL if it must be resolved in context
+    if fe.filters:
+        return NOT_LITERAL
+    if isinstance(fe.var, Variable):
+        return NOT_LITERAL if fe.var.literal is None else fe.var.literal
+    return fe.var
+
+
+
+def get_cache_frag_seconds(value):
+    # Converts a cachefrag timeout, which may be an int, a numeric string, or a DJANGOAT_TIMES combination like
+    # "1d-12h", into seconds
+    if value is not None and isinstance(value, str):
+        if value.isnumeric():
+            return int(value)
+        s = 0
+        for t in value.split('-'):
+            s += DJANGOAT_TIMES.get(t, 0)  # TIMES holds seconds for predefined periods (i.e. 1d, 2h, 4m, etc.)
+        if not s:
+            raise TemplateSyntaxError('"cachefrag" tag (or variant) got a non-integer timeout value not in DJANGOAT_TIMES: ' + repr(value))
+        return s
+    return value
+
+
+
 
 # FILTERS
 @register.filter
@@ -638,7 +993,22 @@ def cachefrag(parser, token):
 
     For this call, a `CacheFrag`_ record will be created with the ``name`` FRAG_NAME and a ``tokens`` value of
     :python:`["token1", "token2", "tokens3"]`. The tokens will be stored in a ``tokens`` `JSONField`_, so that it can
-    easily be queried.
+    easily be queried. So as not to slow the render, new records are queued in memory and written to the database in
+    bulk shortly after (see `queue_cache_frag`_).
+
+    Tokens need not be strings. Model instances, querysets, and objects with a ``cache_key`` method are reduced to
+    short tokens that change whenever the underlying data is edited, so that fragments keyed by them repopulate on
+    their own.
+
+    ..  code-block:: django
+
+        {% cachefrag "1d" post_detail post %}
+            {{ post.title }}
+            {% cachefrag "1d" post_comments post.comments.all %}...{% endcachefrag %}
+        {% endcachefrag %}
+
+    See `get_vary_on_token`_ for how each kind of value is reduced. Since each edit produces a new key, and so a new
+    record, records for outdated versions accumulate and may be deleted periodically.
 
     Also worth noting is that the values of the ``DJANGOAT_TIMES`` dict are automatically available in the seconds
     slot of this tag. We do not immediately know how many seconds are in 6 minutes or 6 hours or 6 days, so rather than
@@ -655,11 +1025,158 @@ def cachefrag(parser, token):
     This ability to combine times should serve most all your needs, but should you need a value that is not available
     by default, simply update the ``DJANGOAT_TIMES`` dict, and your custom time will become available for use with
     this tag.
+
+    When a popular fragment expires, every request that arrives before it is repopulated will render it anew. For
+    expensive fragments under heavy traffic, this can mean dozens of identical renders and a flood of queries all at
+    once. To prevent this, we may pass a ``lock`` argument giving the number of seconds (or a ``DJANGOAT_TIMES`` value)
+    for which one worker may hold the right to regenerate the fragment.
+
+    ..  code-block:: django
+
+        {% cachefrag "1h" FRAG_NAME "token1" lock=30 %}
+            Expensive content
+        {% endcachefrag %}
+
+    Only the worker that acquires the lock will render the fragment, while the others continue to serve the current
+    content or, if there is none, wait up to ``DJANGOAT_CACHE_FRAG["lock_wait"]`` seconds for it to appear. In this
+    mode, regeneration will also begin a little before the fragment expires, with the likelihood increasing as expiry
+    approaches and as render time grows. The optional ``beta`` argument scales this behavior; larger values
+    regenerate sooner, and ``beta=0`` disables early regeneration entirely. The default is available in
+    ``DJANGOAT_CACHE_FRAG["beta"]``.
+
+    Even with ``lock``, the worker that regenerates a fragment still makes its user wait for the render. When slightly
+    outdated content is acceptable, we may instead pass ``stale``, giving the seconds for which content may be served
+    past its expiry.
+
+    ..  code-block:: django
+
+        {% cachefrag "1h" FRAG_NAME "token1" stale="10m" %}
+            Expensive content that may be up to 10 minutes out of date
+        {% endcachefrag %}
+
+    Here, content expires after an hour but remains in the cache for another 10 minutes. Any request arriving in that
+    window receives the stale content right away, while one worker hands regeneration off to a background thread. The
+    number of such threads and the number of regenerations that may be waiting on them are set by
+    ``DJANGOAT_CACHE_FRAG["stale_workers"]`` and ``DJANGOAT_CACHE_FRAG["stale_queue"]``. When all are busy, the stale
+    content continues to be served until a later request can hand it off. Note that background renders receive a copy
+    of the template context as it was at the time of the request, so fragments should not depend on anything that
+    can't outlive the request. Only when content has passed the end of its stale window will a request render it
+    directly. ``stale`` may be combined with ``lock``.
+
+    Rather than waiting for content to expire, we may also clear it whenever the data it displays changes. The
+    ``depends`` argument takes a model label like "blog.Post", a comma-separated string of labels, or a variable
+    holding a model instance, model class, queryset, or list of these.
+
+    ..  code-block:: django
+
+        {% cachefrag "1d" post_detail post.pk depends=post %}
+            {{ post.title }}
+        {% endcachefrag %}
+
+        {% cachefrag "1d" recent_posts depends="blog.Post,blog.Category" %}
+            ...
+        {% endcachefrag %}
+
+    Each dependency is recorded as a `CacheFragDependency`_ when the fragment is registered. Saving or deleting an
+    instance, or changing its many-to-many relations, clears every fragment that depends on that instance or on its
+    model as a whole, once the surrounding transaction commits. Since dependencies are only recorded once per
+    fragment, a fragment that depends on an instance should also vary on it, as above.
+
+    For the hottest fragments, like navigation and footers, even a trip to the cache on every request adds up. Passing
+    ``local`` keeps a copy of the rendered fragment in each process's memory for the given seconds (or
+    ``DJANGOAT_TIMES`` value), checked before the cache is.
+
+    ..  code-block:: django
+
+        {% cachefrag "1d" nav local="1m" %}
+            ...
+        {% endcachefrag %}
+
+    Memory use is capped by ``DJANGOAT_CACHE_FRAG["local_size"]``. When fragments are cleared, copies in memory are
+    discarded within ``DJANGOAT_CACHE_FRAG["local_check"]`` seconds (see `LocalCacheFrags`_), but content that simply
+    expires in the cache may be served from memory for up to ``local`` seconds longer, so keep it short.
+
+    When only a small part of a fragment varies by user, there's no need to cache the whole fragment per user with
+    the `usercachefrag tag`_. Instead, leave a hole for that part with the `nocache tag`_.
+
+    Any of these arguments, along with ``using``, may be passed to each of the cachefrag variants below and should
+    follow all other arguments.
+
+    Content is stored as versioned, and for larger fragments compressed, bytes rather than as pickled strings, and
+    fragments too large for a single cache entry are split across several. See `encode_cache_frag`_ for details.
+
+    Hits, misses, render times, and stored sizes are counted per fragment name and shown in `CacheFragAdmin`_, to help
+    decide which fragments are worth caching and for how long. See `flush_cache_frag_stats`_ to export them elsewhere
+    or ``DJANGOAT_CACHE_FRAG["stats"]`` to turn them off.
     """
     return get_cache_frag_node(parser, token, 'endcachefrag')
 
 
 
+@register.tag
+def cachefrag_prefetch(parser, token):
+    """Fetches the content of all enclosed cachefrag tags at once.
+
+    Each `cachefrag tag`_ normally makes its own trip to the cache, so a page with 15 fragments makes 15 round trips
+    to memcached or Redis. Wrapping them in this tag gathers their keys up front and fetches them all with a single
+    ``get_many`` per cache. Fragments then render from the fetched content, and any that were missing are rendered
+    as usual and written back together with ``set_many`` once the block completes.
+
+    ..  code-block:: django
+
+        {% cachefrag_prefetch %}
+            {% cachefrag "1d" nav %}...{% endcachefrag %}
+            {% sitecachefrag "1h" sidebar %}...{% endsitecachefrag %}
+            {% usercachefrag "5m" account_links %}...{% endusercachefrag %}
+        {% endcachefrag_prefetch %}
+
+    Because keys are resolved before the block renders, only fragments whose arguments are available at that point
+    can be prefetched. Fragments inside ``for`` loops, fragments nested within other fragments, fragments in included
+    templates, and fragments using ``lock`` or ``stale`` fetch their own content as they normally would. When using
+    template inheritance, place this tag inside the child template's blocks rather than around them in the parent.
+    To do the same from an async view without blocking the event loop, see `arender_to_string`_.
+    """
+    nodelist = parser.parse(('endcachefrag_prefetch',))
+    parser.delete_first_token()
+    if len(token.split_contents()) > 1:
+        raise TemplateSyntaxError("'cachefrag_prefetch' tag takes no arguments.")
+    return CacheFragPrefetchNode(nodelist)
+
+
+
+@register.tag
+def nocache(parser, token):
+    """Leaves a hole in cached content, to be rendered anew on every request.
+
+    When most of a fragment is the same for everyone but a small part varies by user, there's no need to cache the
+    whole fragment per user. Wrap the part that varies in this tag, and the fragment is cached once with a placeholder
+    in its place, which is filled on each request, whether the fragment came from the cache or not.
+
+    ..  code-block:: django
+
+        {% sitecachefrag "1h" header %}
+            <nav>...</nav>
+            {% nocache %}
+                {% if request.user.is_authenticated %}Hi, {{ request.user.first_name }}{% endif %}
+            {% endnocache %}
+        {% endsitecachefrag %}
+
+    Holes are rendered in the context of the outermost `cachefrag tag`_ enclosing them, so they shouldn't depend on
+    variables set within the fragment, like those of a ``for`` loop or an ``include``. Fragments nested within others,
+    whether directly or in included templates, leave their holes for the outermost fragment to fill, so that no
+    hole's content is ever cached as part of an enclosing fragment. Holes may appear in included templates as long as
+    those are loaded by name. Outside of any fragment, this tag simply renders its content. Holes are not reflected
+    in the ETags produced by `cache_frag_etag`_.
+    """
+    nodelist = parser.parse(('endnocache',))
+    parser.delete_first_token()
+    if len(token.split_contents()) > 1:
+        raise TemplateSyntaxError("'nocache' tag takes no arguments.")
+    parser.djangoat_holes = getattr(parser, 'djangoat_holes', 0) + 1
+    return NoCacheNode(nodelist, parser.djangoat_holes, getattr(parser.origin, 'template_name', None))
+
+
+
 @register.tag
 def sitecachefrag(parser, token):
     """Create a `CacheFrag`_ record for the current site, if needed, and return cached content.
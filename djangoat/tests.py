@@ -0,0 +1,502 @@
+import os
+import shutil
+import tempfile
+import time
+
+from contextlib import redirect_stdout
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from django.conf import settings
+from django.contrib.admin import site
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.contrib.sessions.models import Session
+from django.core.cache.utils import make_template_fragment_key
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.http import HttpResponse
+from django.template import engines, loader
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import path
+from django.utils import timezone
+
+from .admin import LargeTableCacheFragAdmin
+from .backends import SharedMemoryCache
+from . import DJANGOAT_CACHE_FRAG
+from .cache import (arender_to_string, decode_cache_frag, encode_cache_frag, fetch_cache_frag, flush_cache_frags,
+                    flush_cache_frags_in_background, get_fragment_cache, get_generation_keys, store_cache_frag)
+from .decorators import cache_frag_etag, cache_frag_page
+from .exports import queue_export_job
+from .models import CacheFrag, ExportJob, get_stored_keys
+from .templatetags.djangoat import NOCACHE_NODES
+from .utils import get_csv_rows_from_queryset
+
+
+
+
+# VIEWS
+calls = []  # the names of the views below, as they're called
+
+
+def account_page(request):
+    calls.append('account_page')
+    template = engines['django'].from_string('{% load djangoat %}{% usercachefrag 60 account %}{{ request.user }}{% endusercachefrag %}')
+    return HttpResponse(template.render(request=request))
+
+
+@cache_frag_page(60)
+def binary_page(request):
+    calls.append('binary_page')
+    return HttpResponse(b'\xff\xfe\x00', content_type='application/octet-stream')
+
+
+@cache_frag_etag
+def etag_page(request):
+    calls.append('etag_page')
+    template = engines['django'].from_string('{% load djangoat %}{% cachefrag 60 etag %}{{ n }}{% endcachefrag %}')
+    return HttpResponse(template.render({'n': len(calls)}, request))
+
+
+@cache_frag_page(60)
+def form_page(request):
+    calls.append('form_page')
+    template = engines['django'].from_string('<form method="post">{% csrf_token %}</form>')
+    return HttpResponse(template.render(request=request))
+
+
+@cache_frag_page(60)
+def latin_page(request):
+    calls.append('latin_page')
+    return HttpResponse('café', content_type='text/plain; charset=latin-1', headers={'X-Page': 'latin'})
+
+
+@cache_frag_page(60)
+def plain_page(request):
+    calls.append('plain_page')
+    return HttpResponse('plain')
+
+
+@cache_frag_page(60)
+def session_page(request):
+    calls.append('session_page')
+    return HttpResponse(request.session.get('greeting', 'hello'))
+
+
+urlpatterns = [
+    path('account/', account_page),
+    path('binary/', binary_page),
+    path('etag/', etag_page),
+    path('form/', form_page),
+    path('latin/', latin_page),
+    path('plain/', plain_page),
+    path('session/', session_page),
+]
+
+
+
+
+# TESTS
+@override_settings(TEMPLATES=[{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'OPTIONS': {'loaders': [('django.template.loaders.locmem.Loader', {
+        'users.html': '{% load djangoat %}{% cachefrag 60 users users %}{{ users|length }} {{ note }}{% endcachefrag %}',
+    })]},
+}])
+class ARenderToStringTests(TestCase):
+    def setUp(self):
+        request_finished.disconnect(dispatch_uid='djangoat_flush_cache_frags')
+        self.addCleanup(request_finished.connect, flush_cache_frags_in_background, dispatch_uid='djangoat_flush_cache_frags')
+        self.addCleanup(flush_cache_frags)
+        get_fragment_cache().clear()
+        get_user_model().objects.create(username='a')
+
+    async def test_renders_queryset_fragments_off_the_event_loop(self):
+        users = get_user_model().objects.all()
+        self.assertEqual(await arender_to_string('users.html', {'users': users, 'note': 'miss'}), '1 miss')
+        self.assertEqual(await arender_to_string('users.html', {'users': users, 'note': 'hit'}), '1 miss')
+
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class CacheFragEtagTests(TestCase):
+    def setUp(self):
+        request_finished.disconnect(dispatch_uid='djangoat_flush_cache_frags')
+        self.addCleanup(request_finished.connect, flush_cache_frags_in_background, dispatch_uid='djangoat_flush_cache_frags')
+        self.addCleanup(flush_cache_frags)
+        get_fragment_cache().clear()
+        calls.clear()
+
+    def test_compares_stored_hashes_only(self):
+        etag = self.client.get('/etag/')['ETag']
+        with patch('djangoat.cache.decode_cache_frag', side_effect=AssertionError('content was decoded')):
+            response = self.client.get('/etag/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response['ETag'], calls), (304, etag, ['etag_page']))
+        flush_cache_frags()
+        CacheFrag.objects.filter(name='etag').clear()
+        response = self.client.get('/etag/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.content), (200, b'2'))
+        self.assertNotEqual(response['ETag'], etag)
+
+
+
+class CacheFragFormatTests(SimpleTestCase):
+    def test_round_trips_plain_and_compressed_content(self):
+        for value in ('short', 'long ' * 1000):
+            items = encode_cache_frag('key', value, 0.5, 123.0)
+            self.assertEqual(list(items), ['key'])
+            self.assertEqual(decode_cache_frag(items['key']), (value, 0.5, 123.0))
+        self.assertLess(len(encode_cache_frag('key', 'long ' * 1000)['key']), 1000)
+
+    def test_splits_large_content_into_chunks(self):
+        cache = get_fragment_cache()
+        value = ''.join(chr(ord('a') + i % 26) * (i % 7) for i in range(2000))
+        with patch.dict(DJANGOAT_CACHE_FRAG, compress_min=10 ** 9, max_item_size=1000):
+            self.assertGreater(store_cache_frag(cache, 'chunked', value, 60), len(value))
+        self.assertIsNone(decode_cache_frag(cache.get('chunked')))  # the rest can't be fetched without the cache
+        self.assertEqual(fetch_cache_frag(cache, 'chunked'), (value, 0, None))
+        cache.delete('chunked.1')
+        self.assertIsNone(fetch_cache_frag(cache, 'chunked'))
+
+    def test_treats_other_values_as_missing(self):
+        for data in (None, 'plain', ('content', 0, None), (200, {}, b'page'), b'', b'\x09' + encode_cache_frag('k', 'x')['k'][1:]):
+            self.assertIsNone(decode_cache_frag(data))
+
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    MIDDLEWARE=[
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.middleware.csrf.CsrfViewMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+    ],
+)
+class CacheFragPageTests(TestCase):
+    def setUp(self):
+        # Write queued CacheFrag records in this thread, which alone can see the test database
+        request_finished.disconnect(dispatch_uid='djangoat_flush_cache_frags')
+        self.addCleanup(request_finished.connect, flush_cache_frags_in_background, dispatch_uid='djangoat_flush_cache_frags')
+        self.addCleanup(flush_cache_frags)
+        get_fragment_cache().clear()
+        calls.clear()
+
+    def test_caches_plain_page(self):
+        self.assertEqual(self.client.get('/plain/').content, b'plain')
+        self.assertEqual(self.client.get('/plain/').content, b'plain')
+        self.assertEqual(calls, ['plain_page'])
+
+    def test_keeps_charset_and_headers(self):
+        self.client.get('/latin/')
+        response = self.client.get('/latin/')
+        self.assertEqual(calls, ['latin_page'])
+        self.assertEqual((response.content, response['X-Page']), ('café'.encode('latin-1'), 'latin'))
+
+    def test_ignores_values_of_other_shapes(self):
+        self.client.get('/plain/')
+        key = make_template_fragment_key('plain_page', ['', getattr(settings, 'SITE_ID', None) or '', '/plain/'])
+        get_fragment_cache().set(key, (200, {}, b'stored by hand'))
+        self.assertEqual(self.client.get('/plain/').content, b'plain')
+        self.assertEqual(calls, ['plain_page', 'plain_page'])
+
+    def test_skips_page_that_is_not_text(self):
+        self.assertEqual(self.client.get('/binary/').content, b'\xff\xfe\x00')
+        self.client.get('/binary/')
+        self.assertEqual(calls, ['binary_page', 'binary_page'])
+
+    def test_skips_page_with_csrf_form(self):
+        Client().get('/form/')
+        client = Client(enforce_csrf_checks=True)
+        response = client.get('/form/')
+        self.assertEqual(calls, ['form_page', 'form_page'])
+        self.assertIn('csrftoken', response.cookies)
+        token = response.content.decode().split('name="csrfmiddlewaretoken" value="')[1].split('"')[0]
+        self.assertEqual(client.post('/form/', {'csrfmiddlewaretoken': token}).status_code, 200)
+
+    def test_skips_page_reading_session(self):
+        self.client.get('/session/')
+        self.client.get('/session/')
+        self.assertEqual(calls, ['session_page', 'session_page'])
+
+
+
+class CacheFragTests(TestCase):
+    def setUp(self):
+        request_finished.disconnect(dispatch_uid='djangoat_flush_cache_frags')
+        self.addCleanup(request_finished.connect, flush_cache_frags_in_background, dispatch_uid='djangoat_flush_cache_frags')
+        self.addCleanup(flush_cache_frags)
+        get_fragment_cache().clear()
+
+    def render(self, source, context=None):
+        return engines['django'].from_string('{% load djangoat %}' + source).render(context)
+
+    def stored_key(self, name):
+        # Returns the key under which the content of a fragment with no site, user, or vary_on values is stored
+        return get_stored_keys([(make_template_fragment_key(name, ['', '']), get_generation_keys(name))])[0]
+
+    def test_clear_deletes_chunks(self):
+        cf = CacheFrag.objects.create(key=make_template_fragment_key('chunked', ['', '']), name='chunked')
+        cache = get_fragment_cache()
+        stored_key = self.stored_key('chunked')
+        with patch.dict(DJANGOAT_CACHE_FRAG, compress_min=10 ** 9, max_item_size=1000):
+            store_cache_frag(cache, stored_key, 'x' * 2500, None)
+        self.assertEqual(len(cache.get_many([stored_key] + [f'{stored_key}.{i}' for i in range(3)])), 4)
+        CacheFrag.objects.filter(key=cf.key).clear()
+        self.assertEqual(cache.get_many([stored_key] + [f'{stored_key}.{i}' for i in range(3)]), {})
+
+    def test_invalidates_generations(self):
+        source = '{% cachefrag 60 generation %}{{ n }}{% endcachefrag %}'
+        with patch.dict(DJANGOAT_CACHE_FRAG, generations=('name',)):
+            self.assertEqual(self.render(source, {'n': 1}), '1')
+            self.assertEqual(self.render(source, {'n': 2}), '1')
+            flush_cache_frags()
+            self.assertEqual(CacheFrag.objects.filter(name='generation').count(), 1)  # registered on first render
+            key = self.stored_key('generation')
+            CacheFrag.objects.filter(name='generation').invalidate()
+            self.assertNotEqual(self.stored_key('generation'), key)
+            self.assertEqual(self.render(source, {'n': 3}), '3')
+
+    def test_prefetches_fragments_with_one_get_many(self):
+        source = (
+            '{% cachefrag_prefetch %}{% cachefrag 60 prefetch_a %}a{{ n }}{% endcachefrag %}'
+            '{% cachefrag 60 prefetch_b %}b{{ n }}{% endcachefrag %}{% endcachefrag_prefetch %}'
+        )
+        self.assertEqual(self.render(source, {'n': 1}), 'a1b1')
+        cache = get_fragment_cache()
+        with patch('djangoat.templatetags.djangoat.fetch_cache_frag', side_effect=AssertionError('fetched one at a time')):
+            with patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+                self.assertEqual(self.render(source, {'n': 2}), 'a1b1')
+        get_many.assert_called_once()
+
+    def test_regenerates_early_behind_a_lock(self):
+        cache = get_fragment_cache()
+        key = self.stored_key('xfetch')
+        source = '{% cachefrag 60 xfetch lock=5 %}{{ n }}{% endcachefrag %}'
+        store_cache_frag(cache, key, 'old', 60, 10, time.time() + 5)  # took 10 seconds to render and expires in 5
+        with patch('djangoat.templatetags.djangoat.random.random', return_value=0):  # too far from expiry to regenerate
+            self.assertEqual(self.render(source, {'n': 'new'}), 'old')
+        with patch('djangoat.templatetags.djangoat.random.random', return_value=0.9):  # close enough to regenerate
+            cache.add(key + '.lock', 1)  # but another worker already is
+            self.assertEqual(self.render(source, {'n': 'new'}), 'old')
+            cache.delete(key + '.lock')
+            self.assertEqual(self.render(source, {'n': 'new'}), 'new')
+        self.assertIsNone(cache.get(key + '.lock'))
+        self.assertEqual(fetch_cache_frag(cache, key)[0], 'new')
+
+    @override_settings(DEBUG=True)
+    def test_renders_quietly_without_timeout(self):
+        output = StringIO()
+        with redirect_stdout(output):
+            self.assertEqual(self.render('{% cachefrag None forever %}{{ n }}{% endcachefrag %}', {'n': 1}), '1')
+            self.assertEqual(self.render('{% cachefrag None forever %}{{ n }}{% endcachefrag %}', {'n': 2}), '1')
+        self.assertEqual(output.getvalue(), '')
+
+    def test_renders_without_waiting_long_for_a_lock(self):
+        cache = get_fragment_cache()
+        key = self.stored_key('locked')
+        cache.add(key + '.lock', 1)
+        with patch.dict(DJANGOAT_CACHE_FRAG, lock_wait=0.1, lock_poll=0.05):
+            self.assertEqual(self.render('{% cachefrag 60 locked lock=5 %}{{ n }}{% endcachefrag %}', {'n': 1}), '1')
+        self.assertIsNone(fetch_cache_frag(cache, key))  # left for the lock holder to store
+
+    def test_serves_stale_content_while_regenerating(self):
+        cache = get_fragment_cache()
+        key = self.stored_key('stale')
+        store_cache_frag(cache, key, 'old', 120, 0, time.time() - 1)
+        tasks = []
+        with patch('djangoat.templatetags.djangoat.submit_cache_frag_task', side_effect=lambda *args: tasks.append(args) or True):
+            self.assertEqual(self.render('{% cachefrag 60 stale stale=60 %}{{ n }}{% endcachefrag %}', {'n': 'new'}), 'old')
+            self.assertEqual(self.render('{% cachefrag 60 stale stale=60 %}{{ n }}{% endcachefrag %}', {'n': 'new'}), 'old')
+        self.assertEqual(len(tasks), 1)  # the second request found regeneration already under way
+        func, *args = tasks[0]
+        func(*args)
+        self.assertIsNone(cache.get(key + '.lock'))
+        self.assertEqual(fetch_cache_frag(cache, key)[0], 'new')
+
+
+
+class ExportJobTests(TransactionTestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        media_settings = override_settings(MEDIA_ROOT=media)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        get_user_model().objects.create(username='a', email='a@example.com')
+        get_user_model().objects.create(username='b', email='b@example.com')
+
+    def export(self, queryset, fields, backend):
+        # Queues an export and waits for it to finish, returning the job and the contents of its file
+        job = queue_export_job('users', queryset, fields, backend=backend)
+        deadline = time.time() + 10
+        while job.status not in (ExportJob.DONE, ExportJob.FAILED) and time.time() < deadline:
+            time.sleep(0.05)
+            job.refresh_from_db()
+        self.assertEqual(job.status, ExportJob.DONE, job.error)
+        with job.file.open('rb') as f:
+            return job, f.read().decode()
+
+    def test_exports_from_the_database_backend_by_command(self):
+        job = queue_export_job('users', get_user_model().objects.order_by('username'), ('username', 'email'), backend='database')
+        self.assertEqual(ExportJob.objects.get(pk=job.pk).status, ExportJob.PENDING)  # left for the command
+        call_command('run_export_jobs', once=True)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.rows), (ExportJob.DONE, 2))
+        with job.file.open('rb') as f:
+            self.assertEqual(f.read().decode(), 'Username,Email\r\na,a@example.com\r\nb,b@example.com\r\n')
+
+    def test_exports_values_list_querysets_in_a_thread(self):
+        users = get_user_model().objects.order_by('username')
+        expected = 'Username,Email\r\na,a@example.com\r\nb,b@example.com\r\n'
+        for queryset in (users.values_list('username', 'email'), users.values('username', 'email'), users):
+            job, content = self.export(queryset, ('username', 'email'), 'thread')
+            self.assertEqual(content, expected)
+            self.assertEqual((job.rows, job.total), (2, 2))
+
+    def test_refuses_arguments_that_cannot_be_pickled_for_other_processes(self):
+        with self.assertRaises(ValueError):
+            queue_export_job('users', get_user_model().objects.all(), (lambda u: [u.username], ['Username']), backend='process')
+        self.assertFalse(ExportJob.objects.exists())
+
+
+
+class GetCsvRowsFromQuerysetTests(TestCase):
+    def setUp(self):
+        groups = [Group.objects.create(name=name) for name in ('x', 'y')]
+        for username in ('a', 'b', 'c'):
+            get_user_model().objects.create(username=username).groups.set(groups)
+
+    def test_does_not_prefetch_chained_relations(self):
+        users = get_user_model().objects.order_by('username')
+        with self.assertNumQueries(4):
+            rows = get_csv_rows_from_queryset(users, (lambda u: [u.groups.all().order_by('name').first().name], ['Group']))
+        self.assertEqual(rows, [['Group'], ['x'], ['x'], ['x']])
+
+    def test_prefetches_relations_fetched_whole(self):
+        users = get_user_model().objects.order_by('username')
+        with self.assertNumQueries(2):
+            rows = get_csv_rows_from_queryset(users, (lambda u: [', '.join(g.name for g in u.groups.all())], ['Groups']))
+        self.assertEqual(rows, [['Groups'], ['x, y'], ['x, y'], ['x, y']])
+
+
+
+class LargeTableCacheFragAdminTests(TestCase):
+    def test_searches_only_indexed_columns(self):
+        user = get_user_model().objects.create(username='bob')
+        CacheFrag.objects.create(key='a', name='nav', user=user)
+        CacheFrag.objects.create(key='b', name='bob-footer')
+        CacheFrag.objects.create(key='c', name='sidebar')
+        admin = LargeTableCacheFragAdmin(CacheFrag, site)
+        queryset = admin.get_search_results(None, CacheFrag.objects.all(), 'bob')[0]
+        self.assertNotIn('JOIN', str(queryset.query))
+        self.assertEqual(sorted(queryset.values_list('key', flat=True)), ['a', 'b'])
+        self.assertEqual(list(admin.get_search_results(None, CacheFrag.objects.all(), str(user.pk))[0]), [CacheFrag.objects.get(key='a')])
+
+
+
+@override_settings(TEMPLATES=[{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'OPTIONS': {'loaders': [('django.template.loaders.locmem.Loader', {
+        'page.html': (
+            '{% load djangoat %}{% cachefrag 60 outer %}[{% nocache %}{{ name }}{% endnocache %}'
+            '{% cachefrag 60 inner %}({% nocache %}{{ name }}!{% endnocache %}){% endcachefrag %}'
+            '{% include "included.html" %}]{% endcachefrag %}'
+        ),
+        'included.html': '{% load djangoat %}{% cachefrag 60 included %}<{% nocache %}{{ name }}?{% endnocache %}>{% endcachefrag %}',
+    })]},
+}])
+class NoCacheTests(TestCase):
+    def setUp(self):
+        request_finished.disconnect(dispatch_uid='djangoat_flush_cache_frags')
+        self.addCleanup(request_finished.connect, flush_cache_frags_in_background, dispatch_uid='djangoat_flush_cache_frags')
+        self.addCleanup(flush_cache_frags)
+        get_fragment_cache().clear()
+
+    def test_fills_nested_and_included_holes(self):
+        self.assertEqual(loader.render_to_string('page.html', {'name': 'a'}), '[a(a!)<a?>]')
+        self.assertEqual(loader.render_to_string('page.html', {'name': 'b'}), '[b(b!)<b?>]')
+        self.assertEqual(loader.render_to_string('included.html', {'name': 'c'}), '<c?>')
+
+    def test_fills_included_holes_before_included_template_is_loaded(self):
+        loader.render_to_string('page.html', {'name': 'a'})
+        NOCACHE_NODES.clear()  # as in a new process, where only the cached outer fragment has been seen
+        self.assertEqual(loader.render_to_string('page.html', {'name': 'b'}), '[b(b!)<b?>]')
+
+
+
+class PruneCacheFragsTests(TestCase):
+    def test_deletes_records_not_accessed_recently(self):
+        old = timezone.now() - timedelta(days=40)
+        CacheFrag.objects.create(key='accessed', name='accessed', date_accessed=old)
+        CacheFrag.objects.create(key='set', name='set', date_set=old)
+        CacheFrag.objects.create(key='recent', name='recent', date_accessed=timezone.now())
+        CacheFrag.objects.create(key='unknown', name='unknown')
+        output = StringIO()
+        call_command('prune_cache_frags', days=30, sleep=0, dry_run=True, stdout=output)
+        self.assertEqual(CacheFrag.objects.count(), 4)
+        call_command('prune_cache_frags', days=30, sleep=0, stdout=output)
+        self.assertEqual(sorted(CacheFrag.objects.values_list('key', flat=True)), ['recent', 'unknown'])
+        call_command('prune_cache_frags', days=30, sleep=0, include_unknown=True, stdout=output)
+        self.assertEqual(list(CacheFrag.objects.values_list('key', flat=True)), ['recent'])
+        self.assertEqual(output.getvalue(), '2 records would be deleted.\nDeleted 2 records.\nDeleted 1 records.\n')
+
+
+
+class SharedMemoryCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def get_cache(self, name='fragments', size=4096):
+        return SharedMemoryCache(os.path.join(self.dir, name), {'OPTIONS': {'MAX_ENTRIES': 64, 'SIZE': size}})
+
+    def test_requires_location(self):
+        with self.assertRaises(ImproperlyConfigured):
+            SharedMemoryCache('', {})
+
+    def test_refuses_symlinks_and_shared_files(self):
+        target = os.path.join(self.dir, 'target')
+        open(target, 'wb').close()
+        os.chmod(target, 0o600)
+        os.symlink(target, os.path.join(self.dir, 'link'))
+        with self.assertRaises(ImproperlyConfigured):
+            self.get_cache('link').get('a')
+        os.chmod(target, 0o666)
+        with self.assertRaises(ImproperlyConfigured):
+            self.get_cache('target').get('a')
+
+    def test_incr_updates_counters_in_place(self):
+        cache = self.get_cache(size=256)
+        cache.set('fragment', 'x' * 100)
+        cache.set('counter', 0)
+        for _ in range(200):
+            cache.incr('counter')
+        self.assertEqual(cache.get('counter'), 200)
+        self.assertEqual(cache.get('fragment'), 'x' * 100)
+
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    MIDDLEWARE=[
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+    ],
+)
+class WarmCacheFragsTests(TransactionTestCase):
+    def setUp(self):
+        get_fragment_cache().clear()
+        calls.clear()
+
+    def test_warms_user_fragments_without_logging_in(self):
+        user = get_user_model().objects.create(username='warmed')
+        CacheFrag.objects.create(key='a', name='recorded', user=user, path='/account/')
+        CacheFrag.objects.create(key='b', name='recorded', user=user, path='/account/?delete=1')
+        call_command('warm_cache_frags', users=True, stdout=StringIO())
+        self.assertEqual(calls, ['account_page'])  # not the path with a query string
+        user.refresh_from_db()
+        self.assertIsNone(user.last_login)
+        self.assertFalse(Session.objects.exists())
+        self.assertTrue(CacheFrag.objects.filter(name='account', user=user).exists())  # written before returning
@@ -3,6 +3,7 @@ import calendar
 import csv
 import datetime
 import difflib
+import dis
 import json
 import random
 # import requests
@@ -12,6 +13,7 @@ import types
 # # from easy_thumbnails.files import get_thumbnailer
 # from functools import update_wrapper
 from io import BytesIO, StringIO
+from operator import attrgetter, itemgetter, methodcaller
 # from PIL import Image, ImageOps
 from tempfile import NamedTemporaryFile
 
@@ -23,8 +25,9 @@ from django.core.files import File
 # from django.contrib.postgres.aggregates import StringAgg
 
 # from django.contrib.redirects.models import Redirect
-from django.db.models import F
-from django.http.response import HttpResponse
+from django.db.models import F, Model
+from django.db.models.query import ModelIterable, ValuesIterable
+from django.http.response import HttpResponse, StreamingHttpResponse
 from django.template import loader
 from django.utils.html import strip_tags
 # from django.utils.safestring import mark_safe
@@ -141,7 +144,7 @@ def get_csv_file(filename, rows, dialect=csv.excel, keys=None, add_headers=True)
 
 
 
-def get_csv_rows_from_queryset(queryset, fields, derived_fields=None, dynamic_columns=None, prettify_headers=True, agg_delimiter=', '):
+def get_csv_rows_from_queryset(queryset, fields, derived_fields=None, dynamic_columns=None, prettify_headers=True, agg_delimiter=', ', select=None, prefetch=None):
     """Returns a list of lists suitable for building a CSV file or spreadsheet.
 
     **BASIC USAGE**
@@ -295,6 +298,31 @@ def get_csv_rows_from_queryset(queryset, fields, derived_fields=None, dynamic_co
     the most straightforward and versatile, but it is also the least efficient, especially when each function call
     requires numerous queries. Generally, it should be used only as a last resort.
 
+    When fields are methods or properties, or when ``fields`` is a function, each row may query related objects.
+    To avoid a query per row, the relations named within these, and within any methods and properties of the model
+    they call, are loaded up front with ``select_related`` for foreign keys and one-to-one relations and with
+    ``prefetch_related`` for many-to-many and reverse foreign key relations. Relations of those related objects are
+    detected one level deeper. Since this detection only sees attribute names, relations reached in other ways, like
+    through ``getattr`` or a helper function, may be loaded by passing their lookups in ``select`` and ``prefetch``:
+
+    ..  code-block:: python
+
+        get_csv_rows_from_queryset(
+            user_queryset,
+            ["username", "get_company_name"],
+            select=["profile__company"],
+            prefetch=["groups"],
+        )
+
+    Many-valued relations are only prefetched when fetched whole and used as they are, as in
+    :python:`self.groups.all()`, since calls like ``filter`` or ``count``, and chains like
+    :python:`self.groups.all().first()`, query for each row even when prefetched. Methods inherited from Django's
+    ``Model`` class, like ``save``, are not examined. To turn detection off, pass False for ``select``, ``prefetch``,
+    or both.
+
+    Since this returns every row at once, large exports should use `iter_csv_rows_from_queryset`_ instead, which takes
+    the same arguments but yields rows as records are fetched.
+
     :param queryset: the queryset from which to retrieve ``values``
     :param fields: a tuple or list of fields or pseudo-fields with whose values to populate columns
     :param derived_fields: a function that takes `queryset` and returns a dictionary of derived field results
@@ -304,89 +332,38 @@ def get_csv_rows_from_queryset(queryset, fields, derived_fields=None, dynamic_co
     :param prettify_headers: when a header is not explicitly provided, set this to True to split the field by "__",
         title case the last string, and replace any underscores therein with spaces, and return the result as a header
     :param agg_delimiter: the delimiter to use when aggregating many-to-many values into a string
+    :param select: lookups to pass to ``select_related``, in addition to those detected, when records are instances;
+        False to load none
+    :param prefetch: lookups to pass to ``prefetch_related``, in addition to those detected, when records are
+        instances; False to load none
     :return: a list of lists, ready to be fed into `get_csv_content`_ or anything that makes use of it
     """
-    if not queryset:
-        return []
-    if dynamic_columns:
-        dch, dcr = dynamic_columns(queryset)  # dynamic header list / per-primary-key value lists
-    else:
-        dch, dcr = [], {}
-    f = fields[0]
-    if isinstance(f, types.FunctionType):  # for (FUNCTION, HEADERS), use the passed function to derive each row
-        headers, rows = fields[1], [f(d) + dcr.get(d.pk, []) for d in queryset]
-    else:
-        df = derived_fields(queryset) if derived_fields else {}
-        headers = []
-        maps = {}
-        aafields = {}
-        for i, f in enumerate(fields):  # derive headers
-            if isinstance(f, str):
-                headers.append(f.split('__')[-1].replace('_', ' ').title().lstrip() if prettify_headers else f)
-            else:
-                fields[i] = f[0]
-                headers.append(f[1])
-                if len(f) > 2:  # mapping was included for this field
-                    maps[f[0]] = dict(f[2])
-        for i, f in enumerate(fields):  # check for fields needing annotation
-            if f[0] != '_' and '__' in f:
-                if f[-1] == '+':  # many-to-many annotation
-                    f = f[:-1]
-                    fields[i] = f
-                    aafields[f] = StringAgg(f, agg_delimiter, distinct=True),
-                else:  # foreign key annotation
-                    aafields[f] = F(f)
-        if aafields:  # add auto-annotations
-            queryset = queryset.annotate(**aafields)
-        rows = []
-        qs = list(queryset)  # need a list to quickly test for dict / instance below
-        if isinstance(qs[0], dict):  # results are in dict form as with "values" / "annotate"
-            if df:
-                for d in qs:
-                    row = []
-                    for f in fields:
-                        v = d.get(f, None)
-                        if v is None:
-                            m = df.get(f, None)  # get the derived id / value map for this field, if one exists
-                            if m:
-                                v = m.get(d.pk, None)
-                        m = maps.get(f, None)
-                        row.append('' if v is None else (m.get(v, v) if m else v))
-                    rows.append(row + dcr.get(d.pk, []))
-            else:
-                for d in qs:
-                    row = []
-                    for f in fields:
-                        v = d.get(f, None)
-                        m = maps.get(f, None)
-                        row.append('' if v is None else (m.get(v, v) if m else v))
-                    rows.append(row + dcr.get(d.pk, []))
-        else:
-            if df:
-                for d in qs:
-                    row = []
-                    for f in fields:
-                        v = getattr(d, f, None)
-                        if v is None:
-                            m = df.get(f, None)  # get the derived id / value dict for this field, if one exists
-                            if m:
-                                v = m.get(d.pk, None)
-                        elif callable(v):  # get the value of bound methods
-                            v = v()
-                        m = maps.get(f, None)
-                        row.append('' if v is None else (m.get(v, v) if m else v))
-                    rows.append(row + dcr.get(d.pk, []))
-            else:
-                for d in qs:
-                    row = []
-                    for f in fields:
-                        v = getattr(d, f, None)
-                        if callable(v):  # get the value of bound methods
-                            v = v()
-                        m = maps.get(f, None)
-                        row.append('' if v is None else (m.get(v, v) if m else v))
-                    rows.append(row + dcr.get(d.pk, []))
-    return [headers + dch] + rows
+    return list(iter_csv_rows_from_queryset(
+        queryset, fields, derived_fields, dynamic_columns, prettify_headers, agg_delimiter, select=select, prefetch=prefetch
+    ))
+
+
+
+def get_csv_stream(filename, rows, dialect=csv.excel, keys=None, add_headers=True):
+    """Returns a CSV file download response that is written as it is sent.
+
+    `get_csv_file`_ builds the entire file in memory before sending any of it, which for large exports means holding
+    the rows, the CSV text, and the response body all at once while the user waits. This response instead writes
+    rows as it is consumed (see `iter_csv_content`_), so that memory use stays flat and the download begins right away.
+
+    :param filename: the name of the CSV file, without the ".csv" extension
+    :param rows: an iterable of lists or dicts, in the forms accepted by `get_csv_content`_; when this is a generator,
+        rows are produced only as they're sent
+    :param dialect: the dialect in which to write the CSV
+    :param keys: when ``rows`` holds dicts or OrderedDicts, the keys of the values to include in the output
+    :param add_headers: if True, when ``rows`` holds dicts or OrderedDicts, add a header row using dict keys
+    :return: a streaming CSV file download
+    """
+    return StreamingHttpResponse(
+        iter_csv_content(rows, dialect, keys, add_headers),
+        content_type='text/csv',
+        headers={'Content-Disposition': f'attachment; filename="{filename}.csv"'}
+    )
 
 
 
@@ -778,6 +755,289 @@ def get_xlsx_file(filename, rows, keys=None, add_headers=True):
 
 
 
+def iter_csv_content(rows, dialect=csv.excel, keys=None, add_headers=True, chunk_size=65536):
+    """Yields the data in ``rows`` as CSV text, a chunk at a time.
+
+    Rows are written to a buffer that is yielded and emptied whenever it reaches ``chunk_size`` characters, except
+    for the first row, which is yielded at once so that downloads start without delay. Only one chunk is ever held
+    in memory.
+
+    :param rows: an iterable of lists or dicts, in the forms accepted by `get_csv_content`_
+    :param dialect: the dialect in which to write the CSV
+    :param keys: when ``rows`` holds dicts or OrderedDicts, use these keys to derive values; if none are provided,
+        derive ``keys`` from the first entry in ``rows``
+    :param add_headers: if True, when ``rows`` holds dicts or OrderedDicts, add a header row using dict keys
+    :param chunk_size: the number of characters to gather before yielding
+    :return: a generator of strings
+    """
+    rows = iter(rows)
+    row = next(rows, None)
+    if row is None:
+        return
+    f = StringIO()
+    writer = csv.writer(f, dialect)
+    if not isinstance(row, (list, tuple)):  # transform dicts into lists as they arrive
+        keys = keys or list(row.keys())
+        if add_headers:
+            writer.writerow(keys)
+        rows = ([r[k] for k in keys] for r in rows)
+        row = [row[k] for k in keys]
+    writer.writerow(row)
+    yield f.getvalue()
+    f.seek(0)
+    f.truncate()
+    for row in rows:
+        writer.writerow(row)
+        if f.tell() >= chunk_size:
+            yield f.getvalue()
+            f.seek(0)
+            f.truncate()
+    if f.tell():
+        yield f.getvalue()
+
+
+
+def iter_csv_rows_from_queryset(queryset, fields, derived_fields=None, dynamic_columns=None, prettify_headers=True, agg_delimiter=', ', chunk_size=2000, select=None, prefetch=None):
+    """Yields the rows of `get_csv_rows_from_queryset`_ one at a time, fetching records in chunks.
+
+    All arguments but ``chunk_size`` are the same as for that function, which see. Rather than loading the whole
+    queryset, records are read with ``iterator``, which uses a server-side cursor on PostgreSQL, so that memory use
+    depends on ``chunk_size`` rather than on the number of records. The queryset is evaluated only once, and when
+    every field is a concrete, non-relational field, an annotation, or a derived field, values are fetched as tuples
+    rather than as model instances. As before, nothing is yielded, not even headers, when there are no records.
+
+    Note that ``derived_fields`` and ``dynamic_columns`` functions receive the queryset and may evaluate it themselves,
+    and that relations loaded with ``prefetch_related`` are fetched anew for each chunk.
+
+    :param chunk_size: the number of records to fetch from the database at a time
+    :return: a generator of lists, ready to be fed into `get_csv_stream`_ or `iter_csv_content`_
+    """
+    if dynamic_columns:
+        dch, dcr = dynamic_columns(queryset)  # dynamic header list / per-primary-key value lists
+    else:
+        dch, dcr = [], {}
+    f = fields[0]
+    if isinstance(f, types.FunctionType):  # for (FUNCTION, HEADERS), use the passed function to derive each row
+        headers = fields[1]
+        queryset = _get_related_queryset(queryset, [], [f], select, prefetch)
+        rows = (f(d) + dcr.get(d.pk, []) for d in queryset.iterator(chunk_size))
+    else:
+        df = derived_fields(queryset) if derived_fields else {}
+        if queryset._iterable_class not in (ModelIterable, ValuesIterable):  # read "values_list" rows as dicts
+            queryset = queryset.values(*queryset._fields)
+        fields = list(fields)  # copied, since members are replaced below
+        headers = []
+        maps = {}
+        aafields = {}
+        for i, f in enumerate(fields):  # derive headers
+            if isinstance(f, str):
+                headers.append(f.split('__')[-1].replace('_', ' ').title().lstrip() if prettify_headers else f)
+            else:
+                fields[i] = f[0]
+                headers.append(f[1])
+                if len(f) > 2:  # mapping was included for this field
+                    maps[f[0]] = dict(f[2])
+        for i, f in enumerate(fields):  # check for fields needing annotation
+            if f[0] != '_' and '__' in f:
+                if f[-1] == '+':  # many-to-many annotation
+                    from django.contrib.postgres.aggregates import StringAgg
+                    f = f[:-1]
+                    fields[i] = f
+                    aafields[f] = StringAgg(f, agg_delimiter, distinct=True)
+                else:  # foreign key annotation
+                    aafields[f] = F(f)
+        if aafields:  # add auto-annotations
+            queryset = queryset.annotate(**aafields)
+        rows = (row + dcr.get(pk, []) for row, pk in _iter_csv_values(queryset, fields, df, maps, chunk_size, select, prefetch))
+    rows = iter(rows)
+    row = next(rows, None)
+    if row is not None:
+        yield headers + dch
+        yield row
+        yield from rows
+
+
+
+def _get_csv_row_builder(fields, get_values, df, maps):
+    """Returns a function that takes a record and its primary key and returns a row of cell values.
+
+    ``get_values`` takes a record and returns the raw value of each field, with None for fields whose values are only
+    derived. Rather than checking every cell for derived values and display maps, only the fields having them are
+    revisited once the row is built.
+    """
+    specials = tuple(
+        (i, df.get(f, None) or None, maps.get(f, None) or None)
+        for i, f in enumerate(fields) if df.get(f, None) or maps.get(f, None)
+    )
+    if not specials:
+        return lambda r, pk: ['' if v is None else v for v in get_values(r)]
+
+    def build(r, pk):
+        values = get_values(r)
+        row = ['' if v is None else v for v in values]
+        for i, derived, m in specials:
+            v = values[i]
+            if v is None and derived:
+                v = derived.get(pk, None)
+            if v is not None:
+                row[i] = m.get(v, v) if m else v
+        return row
+    return build
+
+
+
+def _get_code_names(func):
+    # Returns the names of the attributes and globals used by a function, including any functions, lambdas, and
+    # comprehensions defined within it, along with the names of those attributes on which it calls "all" and uses the
+    # result as is, as in "self.groups.all()" but not "self.groups.all().first()", which a prefetch wouldn't serve
+    names, listed = set(), set()
+    codes = [func.__code__]
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes.extend(c for c in code.co_consts if isinstance(c, types.CodeType))
+        previous = None  # the attribute loaded by the previous instruction, if any
+        fetched = None  # the attribute on which "all" was just called, until we see what's done with the result
+        for instruction in dis.get_instructions(code):
+            if fetched and instruction.opname in ('PRECALL', 'CALL', 'CALL_METHOD', 'CALL_FUNCTION'):
+                continue
+            if fetched and instruction.opname not in ('LOAD_ATTR', 'LOAD_METHOD'):  # not chained to another call
+                listed.add(fetched)
+            fetched = None
+            if instruction.opname in ('LOAD_ATTR', 'LOAD_METHOD'):
+                if instruction.argval == 'all' and previous:
+                    fetched, previous = previous, None
+                else:
+                    previous = instruction.argval
+            else:
+                previous = None
+        if fetched:
+            listed.add(fetched)
+    return names, listed
+
+
+
+def _get_model_function(model, name):
+    # Returns the function behind a method or property of a model, unless it's inherited from Django's Model class
+    for cls in model.__mro__:
+        if name in cls.__dict__:
+            if cls in Model.__mro__:
+                return None
+            attr = cls.__dict__[name]
+            for a in ('fget', 'func', '__func__'):  # unwrap properties, cached properties, and class and static methods
+                attr = getattr(attr, a, attr)
+            return attr if isinstance(attr, types.FunctionType) else None
+    return None
+
+
+
+def _get_related_lookups(model, names, listed, prefix='', depth=2):
+    """Returns the ``select_related`` and ``prefetch_related`` lookups for the relations of ``model`` among ``names``.
+
+    The names used by any methods and properties of the model among ``names`` are added to them, so that relations
+    used indirectly are found. For each single-valued relation found, the relations of the related model are looked
+    for among the same names, down to ``depth`` levels. Many-valued relations are only prefetched when they're among
+    ``listed``, being used as in "self.groups.all()", since calls like ``filter`` or ``count``, and chains like
+    "self.groups.all().first()", would query anyway.
+    """
+    names, listed = set(names), set(listed)
+    pending = list(names)
+    while pending:  # add the names used by methods and properties
+        func = _get_model_function(model, pending.pop())
+        if func is not None:
+            new, new_listed = _get_code_names(func)
+            listed.update(new_listed)
+            new -= names
+            names.update(new)
+            pending.extend(new)
+    select, prefetch = set(), set()
+    for f in model._meta.get_fields():
+        if not f.is_relation:
+            continue
+        name = f.name if f.concrete or not f.auto_created else f.get_accessor_name()
+        if name not in names:
+            continue
+        if (f.many_to_one or f.one_to_one) and (f.concrete or f.auto_created):  # loadable with a join
+            select.add(prefix + name)
+            if depth > 1:
+                s, p = _get_related_lookups(f.related_model, names, listed, prefix + name + '__', depth - 1)
+                select.update(s)
+                prefetch.update(p)
+        elif name in listed:  # many-to-many, reverse foreign key, or generic relations
+            prefetch.add(prefix + name)
+    return select, prefetch
+
+
+
+def _get_related_queryset(queryset, fields, funcs, select=None, prefetch=None):
+    # Returns the queryset with the relations used by the named fields and functions of an export loaded up front;
+    # a "select" or "prefetch" of False turns off detection of the like kind of relation
+    names, listed = set(fields), set()
+    for func in funcs:
+        n, l = _get_code_names(func)
+        names.update(n)
+        listed.update(l)
+    s, p = _get_related_lookups(queryset.model, names, listed)
+    s = set() if select is False else s | set(select or ())
+    p = set() if prefetch is False else p | set(prefetch or ())
+    if s:
+        queryset = queryset.select_related(*sorted(s))
+    if p:
+        queryset = queryset.prefetch_related(*sorted(p))
+    return queryset
+
+
+
+def _get_values_getter(getter, n):
+    # Returns a function returning a sequence of the values gotten by a multi-field itemgetter or attrgetter, which
+    # returns a bare value rather than a tuple for a single field
+    if n == 1:
+        return lambda r: (getter(r),)
+    return getter
+
+
+
+def _iter_csv_values(queryset, fields, df, maps, chunk_size, select=None, prefetch=None):
+    # Yields the formatted values of ``fields`` and the primary key for each record, for "iter_csv_rows_from_queryset"
+    model = queryset.model
+    selectable = {f.attname for f in model._meta.concrete_fields}
+    selectable.update(f.name for f in model._meta.concrete_fields if not f.is_relation)
+    selectable.update(queryset.query.annotations)
+    if queryset._iterable_class is ModelIterable and all(f in selectable or f in df for f in fields):
+        columns = [f for f in fields if f in selectable]
+        if len(columns) == len(fields):
+            get_values = _get_values_getter(itemgetter(*range(len(fields))), len(fields))
+        else:
+            positions = [columns.index(f) if f in selectable else None for f in fields]
+            get_values = lambda t: [None if i is None else t[i] for i in positions]
+        records = queryset.values_list(*columns, 'pk').iterator(chunk_size)
+        get_pk = itemgetter(-1)
+    elif queryset._iterable_class is ModelIterable:
+        getters = []
+        for f in fields:
+            if f in selectable:
+                getters.append(attrgetter(f))
+            elif callable(getattr(model, f, None)):  # a method
+                getters.append(methodcaller(f))
+            else:  # anything else, like a property, a related object, or a derived field
+                def get(d, f=f):
+                    v = getattr(d, f, None)
+                    return v() if callable(v) else v
+                getters.append(get)
+        get_values = lambda d: [g(d) for g in getters]
+        records = _get_related_queryset(queryset, fields, [], select, prefetch).iterator(chunk_size)
+        get_pk = attrgetter('pk')
+    else:  # results are in dict form as with "values" / "values_list" / "annotate"
+        get_values = lambda d: [d.get(f, None) for f in fields]
+        records = queryset.iterator(chunk_size)
+        get_pk = lambda d: d.get('pk', d.get('id', None))
+    build = _get_csv_row_builder(fields, get_values, df, maps)
+    for r in records:
+        pk = get_pk(r)
+        yield build(r, pk), pk
+
+
+
 def send_mail(to, subject, message, files=None, **kwargs):
     """Send an email to the specified recipient.
 
@@ -42,16 +42,67 @@ html_static_path = ['_static']
 
 # Global settings
 rst_epilog = """
+.. _arender_to_string: cache.html#djangoat.cache.arender_to_string
+.. _bump_generations: cache.html#djangoat.cache.bump_generations
+.. _cache_frag_etag: decorators.html#djangoat.decorators.cache_frag_etag
+.. _cache_frag_page: decorators.html#djangoat.decorators.cache_frag_page
 .. _cachefrag: models.html#djangoat.models.CacheFrag
 .. _cachefrag tag: templatetags.html#djangoat.templatetags.djangoat.cachefrag
+.. _cachefrag_prefetch tag: templatetags.html#djangoat.templatetags.djangoat.cachefrag_prefetch
+.. _cachefragadmin: admin.html#djangoat.admin.CacheFragAdmin
+.. _cachefragdependency: models.html#djangoat.models.CacheFragDependency
+.. _cachefragqueryset.invalidate: models.html#djangoat.models.CacheFragQuerySet.invalidate
+.. _cachefragregistry: models.html#djangoat.models.CacheFragRegistry
+.. _clear: models.html#djangoat.models.CacheFragQuerySet.clear
+.. _csv_export_action: admin.html#djangoat.admin.csv_export_action
 .. _data tag: templatetags.html#djangoat.templatetags.djangoat.data
 .. _dataf filter: templatetags.html#djangoat.templatetags.djangoat.dataf
+.. _delete_cache_frags: cache.html#djangoat.cache.delete_cache_frags
+.. _encode_cache_frag: cache.html#djangoat.cache.encode_cache_frag
+.. _estimatedcountpaginator: admin.html#djangoat.admin.EstimatedCountPaginator
+.. _evict: models.html#djangoat.models.CacheFragRegistry.evict
+.. _ExportBackend: exports.html#djangoat.exports.ExportBackend
+.. _ExportJob: models.html#djangoat.models.ExportJob
+.. _ExportJobAdmin: admin.html#djangoat.admin.ExportJobAdmin
+.. _fetch_cache_frag_etag: cache.html#djangoat.cache.fetch_cache_frag_etag
 .. _file: https://docs.djangoproject.com/en/dev/ref/files/file/#the-file-class
 .. _filefield: https://docs.djangoproject.com/en/dev/ref/models/fields/#filefield
+.. _flush_cache_frag_accesses: cache.html#djangoat.cache.flush_cache_frag_accesses
+.. _flush_cache_frag_stats: cache.html#djangoat.cache.flush_cache_frag_stats
+.. _flush_cache_frags: cache.html#djangoat.cache.flush_cache_frags
+.. _get_cache_frag_etag: cache.html#djangoat.cache.get_cache_frag_etag
+.. _get_cache_frag_stats: cache.html#djangoat.cache.get_cache_frag_stats
 .. _get_csv_content: utils.html#djangoat.utils.get_csv_content
+.. _get_csv_file: utils.html#djangoat.utils.get_csv_file
 .. _get_csv_rows_from_queryset: utils.html#djangoat.utils.get_csv_rows_from_queryset
+.. _get_csv_stream: utils.html#djangoat.utils.get_csv_stream
+.. _get_dependencies: cache.html#djangoat.cache.get_dependencies
+.. _get_generation_keys: cache.html#djangoat.cache.get_generation_keys
+.. _get_generations: cache.html#djangoat.cache.get_generations
+.. _get_vary_on_token: cache.html#djangoat.cache.get_vary_on_token
+.. _invalidate: models.html#djangoat.models.CacheFragQuerySet.invalidate
+.. _invalidate_dependents: cache.html#djangoat.cache.invalidate_dependents
+.. _iter_csv_content: utils.html#djangoat.utils.iter_csv_content
+.. _iter_csv_rows_from_queryset: utils.html#djangoat.utils.iter_csv_rows_from_queryset
 .. _jsonfield: https://docs.djangoproject.com/en/dev/topics/db/queries/#querying-jsonfield
+.. _localcachefrags: cache.html#djangoat.cache.LocalCacheFrags
+.. _memory_usage: models.html#djangoat.models.CacheFragRegistry.memory_usage
+.. _nocache tag: templatetags.html#djangoat.templatetags.djangoat.nocache
+.. _prune_cache_frags command: commands.html#djangoat.management.commands.prune_cache_frags.Command
+.. _queue_cache_frag: cache.html#djangoat.cache.queue_cache_frag
+.. _queue_export_job: exports.html#djangoat.exports.queue_export_job
+.. _record_cache_frag_access: cache.html#djangoat.cache.record_cache_frag_access
+.. _record_cache_frag_hit: cache.html#djangoat.cache.record_cache_frag_hit
+.. _record_cache_frag_miss: cache.html#djangoat.cache.record_cache_frag_miss
+.. _record_etag_fragment: cache.html#djangoat.cache.record_etag_fragment
 .. _requests api: https://github.com/psf/requests/blob/main/src/requests/api.py
 .. _retrieve_remote_file: utils.html#djangoat.utils.retrieve_remote_file
+.. _run_export_job: exports.html#djangoat.exports.run_export_job
+.. _run_export_jobs command: commands.html#djangoat.management.commands.run_export_jobs.Command
+.. _SharedMemoryCache: backends.html#djangoat.backends.SharedMemoryCache
+.. _store_cache_frag: cache.html#djangoat.cache.store_cache_frag
+.. _submit_cache_frag_task: cache.html#djangoat.cache.submit_cache_frag_task
 .. _thumb_url tag: templatetags.html#djangoat.templatetags.djangoat.thumb_url
+.. _usercachefrag tag: templatetags.html#djangoat.templatetags.djangoat.usercachefrag
+.. _warm_cache_frags command: commands.html#djangoat.management.commands.warm_cache_frags.Command
 """
\ No newline at end of file